@@ -0,0 +1,78 @@
+"""
+Measures how long the gokit command line tools take to start, e.g. to print
+--help or reject a bad argument, and whether they load the networking stack
+(requests) to do it. Each case runs in a fresh interpreter, as it does for
+users. Example:
+
+    python bench/bench_startup.py --repeat 20
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.dirname(bench_dir)
+
+# Command line of each case, after the Python executable
+CASES = {
+    'python': ['-c', 'pass'],
+    'import gokit_sync': ['-c', 'import gokit_sync'],
+    'gokit_sync --help': [os.path.join(root_dir, 'gokit_sync.py'), '--help'],
+    'gokit_sync bad args': [os.path.join(root_dir, 'gokit_sync.py'), 'datasets.txt', 'key', '--workers', 'x'],
+    'gokit_sync mirror --help': [os.path.join(root_dir, 'gokit_sync.py'), 'mirror', '--help'],
+    'get_datasets --help': [os.path.join(root_dir, 'get_datasets.py'), '--help'],
+}
+
+# Modules that should not be loaded until a sync starts
+HEAVY_MODULES = ['requests', 'aiohttp', 'multiprocessing', 'http.server']
+
+
+def run_case(name, repeat):
+    """
+    Run a case repeat times.
+    :return: dict of measurements, times in milliseconds
+    """
+    cmd = [sys.executable] + CASES[name]
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=root_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    # One more run to list the modules imported
+    out = subprocess.run([sys.executable, '-X', 'importtime'] + CASES[name], cwd=root_dir,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr.decode('utf8', 'replace')
+    imported = set(line.split('|')[-1].strip() for line in out.splitlines() if line.startswith('import time:'))
+    return {'case': name, 'min_ms': round(min(times), 1), 'median_ms': round(statistics.median(times), 1),
+            'heavy': [m for m in HEAVY_MODULES if m in imported]}
+
+
+def print_table(results):
+    print('%-22s %9s %10s  %s' % ('case', 'min ms', 'median ms', 'heavy modules loaded'))
+    for r in results:
+        print('%-22s %9.1f %10.1f  %s' % (r['case'], r['min_ms'], r['median_ms'],
+                                          ', '.join(r['heavy']) or '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of the gokit command line tools.')
+    parser.add_argument('--case', action='append', choices=sorted(CASES),
+                        help='Case to run, can be repeated (default: all).')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Runs of each case, the min and median are reported (default: 10).')
+    parser.add_argument('--json', help='Also write the results to this JSON file.')
+    args = parser.parse_args()
+
+    results = [run_case(name, max(args.repeat, 1)) for name in args.case or list(CASES)]
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Benchmarks gokit against a local fake GIS Hub (see fake_hub.py), so that sync
+throughput can be measured without touching the production site.
+
+Each scenario runs in its own process, so that peak memory is measured per
+scenario. Example:
+
+    python bench/bench_sync.py --workers 8
+    python bench/bench_sync.py --scenario few-huge --segments 4 --json results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+MB = 1024 * 1024
+
+# FakeHub settings for each scenario
+SCENARIOS = {
+    'many-small': {'datasets': 300, 'file_size': 64 * 1024, 'latency': 0.02},
+    'few-huge': {'datasets': 3, 'file_size': 200 * MB, 'latency': 0.02, 'bandwidth': 20 * MB},
+    'flaky': {'datasets': 100, 'file_size': 256 * 1024, 'latency': 0.02, 'fail_rate': 0.05,
+              'drop_rate': 0.1},
+    'overlap': {'datasets': 100, 'file_size': 1024 * 1024, 'latency': 0.02, 'shared_rate': 0.5},
+}
+
+
+def peak_rss_mb():
+    # Peak resident memory of this process, not available on Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return round(peak / (MB if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def run_scenario(name, workers, engine, segments, scale):
+    """
+    Sync every dataset of a scenario from a fresh fake hub into a temp folder,
+    then list the group with get_datasets.
+    :return: dict of measurements
+    """
+    from fake_hub import FakeHub
+    import settings
+    import gokit_sync
+    import get_datasets
+    from lib import ckanapi
+
+    options = dict(SCENARIOS[name])
+    options['datasets'] = max(int(options['datasets'] * scale), 1)
+    options['file_size'] = max(int(options['file_size'] * scale), 1)
+    hub = FakeHub(group='bench', **options).start()
+    settings.ghub_api_url_base = hub.url + '/api/3/action'
+    logging.disable(logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(prefix='gokit-bench-')
+    ds_file = os.path.join(work_dir, 'datasets.txt')
+    with open(ds_file, 'w') as f:
+        f.write('\n'.join(sorted(hub.packages)) + '\n')
+
+    gokit_sync.download_segments = segments
+    ckanapi.configure_session(pool_size=max(workers * segments, ckanapi.http_pool_size))
+    ckanapi.set_api_key('bench')
+    start = time.time()
+    summary = gokit_sync.sync(ds_file, workers=workers, engine=engine)
+    sync_secs = time.time() - start
+    sync_calls = hub.api_calls
+    sync_bytes = hub.bytes_sent
+
+    os.chdir(work_dir)
+    start = time.time()
+    get_datasets.get_datasets_in_group('bench', 'bench')
+    list_secs = time.time() - start
+    hub.stop()
+
+    return {
+        'scenario': name,
+        'datasets': options['datasets'],
+        'synced': len(summary[gokit_sync.SYNCED]),
+        'failed': len(summary[gokit_sync.FAILED]),
+        'seconds': round(sync_secs, 3),
+        'datasets_per_sec': round(len(summary[gokit_sync.SYNCED]) / sync_secs, 2),
+        'mb_per_sec': round(sync_bytes / float(MB) / sync_secs, 2),
+        'mb_transferred': round(sync_bytes / float(MB), 2),
+        'api_calls': sync_calls,
+        'group_list_seconds': round(list_secs, 3),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def print_table(results):
+    columns = ['scenario', 'datasets', 'synced', 'failed', 'seconds', 'datasets_per_sec',
+               'mb_per_sec', 'api_calls', 'group_list_seconds', 'peak_rss_mb']
+    widths = [max(len(c), 10) for c in columns]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for result in results:
+        print('  '.join(str(result.get(c)).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gokit against a local fake GIS Hub.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run, can be repeated (default: all).')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--segments', type=int, default=1)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply dataset counts and file sizes, e.g. 0.1 for a quick run.')
+    parser.add_argument('--json', help='Also write the results to this JSON file.')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        # Child process: run a single scenario, print its results as JSON
+        result = run_scenario(args.run_one, args.workers, args.engine, args.segments, args.scale)
+        print(json.dumps(result))
+        return
+
+    results = []
+    for name in args.scenario or sorted(SCENARIOS):
+        cmd = [sys.executable, os.path.realpath(__file__), '--run-one', name,
+               '--workers', str(args.workers), '--engine', args.engine,
+               '--segments', str(args.segments), '--scale', str(args.scale)]
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.decode('utf8')
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
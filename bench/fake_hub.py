@@ -0,0 +1,417 @@
+"""
+A local stand-in for the GIS Hub CKAN API and its S3 file downloads, used to
+test and benchmark gokit without touching the production site.
+"""
+
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping connections is part of the test scenarios
+        pass
+
+
+class FakeHub(object):
+    """
+    Holds the fake catalog and server settings.
+    :param datasets: number of datasets to generate
+    :param file_size: size in bytes of the zip attached to each dataset
+    :param latency: seconds of delay added to every request
+    :param bandwidth: bytes/sec cap per download stream, 0 for unlimited
+    :param fail_rate: fraction of requests answered with a 503
+    :param group: name of the group all datasets belong to
+    :param drop_rate: fraction of downloads cut off part way through
+    :param shared_rate: fraction of datasets whose zip is a copy of the zip
+    of the first dataset
+    :param url_ttl: if set, download URLs are signed like S3 URLs and refused
+    once older than this many seconds
+    """
+
+    def __init__(self, datasets=10, file_size=1024 * 1024, latency=0.0, bandwidth=0,
+                 fail_rate=0.0, group='bench', drop_rate=0.0, shared_rate=0.0,
+                 url_ttl=0):
+        self.latency = latency
+        self.url_ttl = url_ttl
+        self.bandwidth = bandwidth
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.api_calls = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.packages = {}
+        self.resources = {}
+        self.files = {}
+        self.blobs = {}
+        self.tables = {}
+        self.server = None
+        self.thread = None
+        self.port = None
+        modified = '2026-01-01T00:00:00.000000'
+        for i in range(datasets):
+            name = 'bench-dataset-%04d' % i
+            res_id = hashlib.md5(name.encode()).hexdigest()
+            filename = '%s.zip' % name
+            # Same contents and ETag as the first zip, for every 1/shared_rate dataset
+            content_id = res_id
+            if i and shared_rate and int(i * shared_rate) != int((i - 1) * shared_rate):
+                content_id = hashlib.md5(b'bench-dataset-0000').hexdigest()
+            self.files[res_id] = (filename, file_size, content_id)
+            res = {'id': res_id, 'package_id': name, 'title': 'Data for %s' % name,
+                   'name': filename, 'url_type': 'upload', 'format': 'ZIP',
+                   'size': file_size, 'last_modified': modified, 'created': modified,
+                   'url': None, 'position': 0}
+            placeholder = {'id': res_id + '-layer', 'package_id': name, 'title': 'Layer',
+                           'name': 'layer', 'url_type': None, 'format': 'SHP',
+                           'bbox': '-130.0,48.0,-122.0,55.0', 'url': '', 'position': 1,
+                           'attribute': json.dumps([{'name': 'depth', 'type': 'float'}])}
+            self.resources[res_id] = res
+            self.resources[placeholder['id']] = placeholder
+            self.packages[name] = {
+                'id': name, 'name': name, 'title': 'Benchmark dataset %s' % i,
+                'notes': 'Generated dataset', 'metadata_modified': modified,
+                'metadata_created': modified, 'keywords': 'bench, test',
+                'groups': [{'name': group}], 'resources': [res, placeholder],
+                'organization': {'name': 'bench-org'}}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.port
+
+    def set_zip(self, res_id, members):
+        """
+        Serve a real zip file for a resource instead of generated bytes, e.g.
+        to test --extract and --delta. Call again with changed members to
+        publish a new version of the resource.
+        :param res_id: resource id
+        :param members: dict of member name to bytes, stored uncompressed
+        :return: the zip file bytes
+        """
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zf:
+            for name in sorted(members):
+                zf.writestr(zipfile.ZipInfo(name, (2026, 1, 1, 0, 0, 0)), members[name])
+        data = buf.getvalue()
+        content_id = hashlib.md5(data).hexdigest()
+        modified = datetime.utcnow().isoformat()
+        with self.lock:
+            self.blobs[content_id] = data
+            self.files[res_id] = (self.files[res_id][0], len(data), content_id)
+            res = self.resources[res_id]
+            res.update({'size': len(data), 'last_modified': modified})
+            self.packages[res['package_id']]['metadata_modified'] = modified
+        return data
+
+    def add_table(self, name, rows, columns=('site', 'depth', 'notes')):
+        """
+        Attach a DataStore table (datastore_active, no uploaded file) to a
+        dataset, to test exports with --datastore.
+        :param name: dataset name
+        :param rows: number of rows to generate
+        :param columns: column names
+        :return: resource id, which is also the table name
+        """
+        res_id = hashlib.md5(('%s-table-%s' % (name, len(self.tables))).encode()).hexdigest()
+        pkg = self.packages[name]
+        res = {'id': res_id, 'package_id': name, 'title': 'Table for %s' % name, 'name': 'table',
+               'url_type': None, 'format': 'CSV', 'datastore_active': True,
+               'url': '%s/datastore/dump/%s' % ('http://example.com', res_id), 'position': len(pkg['resources'])}
+        with self.lock:
+            self.resources[res_id] = res
+            pkg['resources'].append(res)
+            self.tables[res_id] = {'columns': list(columns), 'rows': [], 'next_id': 1}
+        self.append_rows(res_id, rows)
+        return res_id
+
+    def append_rows(self, res_id, rows):
+        with self.lock:
+            table = self.tables[res_id]
+            for _ in range(rows):
+                _id = table['next_id']
+                table['next_id'] += 1
+                record = {'_id': _id}
+                for i, column in enumerate(table['columns']):
+                    record[column] = _id * (i + 1) * 0.5 if i % 3 == 1 else \
+                        None if i % 3 == 2 and _id % 7 == 0 else 'row %s, "%s"' % (_id, column)
+                table['rows'].append(record)
+
+    def delete_rows(self, res_id, ids):
+        with self.lock:
+            table = self.tables[res_id]
+            table['rows'] = [r for r in table['rows'] if r['_id'] not in set(ids)]
+
+    def query_table(self, sql):
+        """
+        Answer the datastore_search_sql queries that gokit sends. Other SQL is
+        refused, as CKAN refuses what it cannot parse.
+        :return: result dict, or None for an unsupported query
+        """
+        match = re.match(r'SELECT \* FROM "([\w-]+)" LIMIT 0$', sql)
+        if match and match.group(1) in self.tables:
+            fields = [{'id': '_id', 'type': 'int'}, {'id': '_full_text', 'type': 'tsvector'}]
+            fields += [{'id': c, 'type': 'text'} for c in self.tables[match.group(1)]['columns']]
+            return {'records': [], 'fields': fields, 'sql': sql}
+        match = re.match(r'SELECT min\(_id\) AS low, max\(_id\) AS high, count\(\*\) AS total '
+                         r'FROM "([\w-]+)"(?: WHERE _id <= (\d+))?$', sql)
+        if match and match.group(1) in self.tables:
+            upto = int(match.group(2)) if match.group(2) else None
+            with self.lock:
+                ids = [r['_id'] for r in self.tables[match.group(1)]['rows'] if upto is None or r['_id'] <= upto]
+            return {'records': [{'low': min(ids) if ids else None, 'high': max(ids) if ids else None,
+                                 'total': len(ids)}], 'fields': [], 'sql': sql}
+        match = re.match(r'SELECT (.+) FROM "([\w-]+)" WHERE _id > (-?\d+) AND _id <= (\d+) '
+                         r'ORDER BY _id LIMIT (\d+)$', sql)
+        if match and match.group(2) in self.tables:
+            columns = [c.strip('" ') for c in match.group(1).split(',')]
+            after, upto, limit = int(match.group(3)), int(match.group(4)), int(match.group(5))
+            with self.lock:
+                rows = [r for r in self.tables[match.group(2)]['rows'] if after < r['_id'] <= upto][:limit]
+            return {'records': [dict((c, r.get(c)) for c in columns) for r in rows], 'fields': [], 'sql': sql}
+        return None
+
+    def file_bytes(self, content_id, start, end):
+        if content_id in self.blobs:
+            return self.blobs[content_id][start:end + 1]
+        # Deterministic file contents, so downloads can be verified
+        block = hashlib.sha256(content_id.encode()).digest() * 128
+        out = bytearray()
+        pos = start
+        while pos <= end:
+            offset = pos % len(block)
+            chunk = block[offset:offset + end - pos + 1]
+            out += chunk
+            pos += len(chunk)
+        return bytes(out)
+
+    def package(self, name):
+        pkg = self.packages.get(name)
+        if not pkg:
+            return None
+        pkg = json.loads(json.dumps(pkg))
+        for res in pkg['resources']:
+            if res['url_type'] == 'upload':
+                res['url'] = '%s/files/%s/%s' % (self.url, res['id'], self.files[res['id']][0])
+                if self.url_ttl:
+                    res['url'] += '?X-Amz-Date=%s&X-Amz-Expires=%s' % (
+                        datetime.utcnow().strftime('%Y%m%dT%H%M%SZ'), self.url_ttl)
+        return pkg
+
+    def search(self, params):
+        fq = params.get('fq', '') + ' ' + params.get('q', '')
+        rows = int(params.get('rows', 10))
+        start = int(params.get('start', 0))
+        names = sorted(self.packages)
+        match = re.search(r'name:\(([^)]*)\)', fq)
+        if match:
+            wanted = set(n.strip('" ') for n in match.group(1).split(' OR '))
+            names = [n for n in names if n in wanted]
+        match = re.search(r'groups:("?)([\w-]+)\1', fq)
+        if match:
+            names = [n for n in names
+                     if match.group(2) in [g['name'] for g in self.packages[n]['groups']]]
+        match = re.search(r'metadata_modified:\[(\S+) TO', fq)
+        if match and match.group(1) != '*':
+            since = match.group(1).rstrip('Z')
+            names = [n for n in names if self.packages[n]['metadata_modified'] >= since]
+        # Sort on a date field then id, as iter_package_search asks for
+        field = params.get('sort', 'name asc').split()[0]
+        if field.startswith('metadata_'):
+            names.sort(key=lambda n: (self.packages[n][field][:23], self.packages[n]['id']))
+        # Results after a dataset, see ckanapi.keyset_filter
+        match = re.search(r'\((\w+):\{(\S+) TO \*\] OR \(\w+:\[\S+ TO \S+\] AND id:\{(\S+) TO \*\]\)\)', fq)
+        if match:
+            field, value, last_id = match.group(1), match.group(2).rstrip('Z'), match.group(3)
+            names = [n for n in names if (self.packages[n][field][:23], self.packages[n]['id']) > (value, last_id)]
+        results = [self.package(n) for n in names[start:start + rows]]
+        return {'count': len(names), 'results': results, 'facets': {}, 'sort': 'name asc'}
+
+    def start(self, port=0):
+        hub = self
+
+        class Handler(HubHandler):
+            pass
+        Handler.hub = hub
+        self.server = QuietServer(('127.0.0.1', port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class HubHandler(BaseHTTPRequestHandler):
+    hub = None
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            with self.hub.lock:
+                self.hub.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def params(self):
+        parsed = urlparse(self.path)
+        params = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            try:
+                params.update(json.loads(body) or {})
+            except ValueError:
+                pass
+        return parsed.path, params
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self, head=False):
+        hub = self.hub
+        time.sleep(hub.latency)
+        path, params = self.params()
+        if hub.fail_rate and random.random() < hub.fail_rate:
+            return self.send_json(503, {'success': False, 'error': 'Service unavailable'})
+        if path.startswith('/files/'):
+            if hub.url_ttl and ('X-Amz-Date' not in params or datetime.strptime(
+                    params['X-Amz-Date'], '%Y%m%dT%H%M%SZ') + timedelta(seconds=hub.url_ttl) < datetime.utcnow()):
+                return self.send_json(403, {'error': 'Request has expired'})
+            return self.send_file(path, head)
+        with hub.lock:
+            hub.api_calls += 1
+        action = path.rsplit('/', 1)[-1]
+        if action == 'package_show':
+            pkg = hub.package(params.get('id'))
+            if not pkg:
+                return self.send_json(404, {'success': False, 'error': {'message': 'Not found', '__type': 'Not Found Error'}})
+            return self.send_json(200, {'success': True, 'result': pkg})
+        if action == 'resource_show':
+            res = hub.resources.get(params.get('id'))
+            if not res:
+                return self.send_json(404, {'success': False, 'error': {'message': 'Not found', '__type': 'Not Found Error'}})
+            return self.send_json(200, {'success': True, 'result': hub.package(res['package_id'])[
+                'resources'][res['position']]})
+        if action == 'package_search':
+            return self.send_json(200, {'success': True, 'result': hub.search(params)})
+        if action == 'datastore_search_sql':
+            result = hub.query_table(params.get('sql') or '')
+            if result is None:
+                return self.send_json(409, {'success': False, 'error': {'sql': 'Unsupported query'}})
+            return self.send_json(200, {'help': '', 'success': True, 'result': result})
+        return self.send_json(400, {'success': False, 'error': 'Unknown action %s' % action})
+
+    def send_file(self, path, head):
+        hub = self.hub
+        parts = path.split('/')
+        res_id = parts[2]
+        if res_id not in hub.files:
+            return self.send_json(404, {'error': 'No such file'})
+        filename, size, content_id = hub.files[res_id]
+        etag = '"%s-%s"' % (content_id[:8], size)
+        if content_id in hub.blobs:
+            # Zips from set_zip() have the ETag of a single part upload to S3, the MD5 of the file
+            etag = '"%s"' % content_id
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range_header and (not if_range or if_range == etag):
+            match = re.match(r'bytes=(\d*)-(\d*)', range_header)
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            else:
+                start = max(size - int(match.group(2)), 0)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(1767225600, usegmt=True))
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+        self.end_headers()
+        if head:
+            return
+        chunk = 64 * 1024
+        pos = start
+        began = time.time()
+        sent = 0
+        drop_at = None
+        if hub.drop_rate and random.random() < hub.drop_rate:
+            drop_at = random.randint(0, end - start)
+        try:
+            while pos <= end:
+                if drop_at is not None and sent >= drop_at:
+                    self.close_connection = True
+                    break
+                data = hub.file_bytes(content_id, pos, min(pos + chunk, end + 1) - 1)
+                self.wfile.write(data)
+                pos += len(data)
+                sent += len(data)
+                with hub.lock:
+                    hub.bytes_sent += len(data)
+                if hub.bandwidth:
+                    ahead = sent / float(hub.bandwidth) - (time.time() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a fake GIS Hub for testing gokit by hand.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--datasets', type=int, default=10)
+    parser.add_argument('--file-size', type=int, default=1024 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=int, default=0)
+    args = parser.parse_args()
+    hub = FakeHub(datasets=args.datasets, file_size=args.file_size, latency=args.latency,
+                  bandwidth=args.bandwidth).start(args.port)
+    print('Fake GIS Hub running at %s' % hub.url)
+    hub.thread.join()
+
+
+if __name__ == '__main__':
+    main()
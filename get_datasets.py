@@ -2,35 +2,46 @@ import settings
 import os
 import sys
 import argparse
-from lib import ckanapi
 
 logger = settings.setup_logger('get_datasets')
+ckanapi = settings.lazy_import('lib.ckanapi')
 base_dir = os.path.dirname(os.path.realpath(__file__))
 
 
 def get_datasets_in_group(apikey, group_name):
     """
     Writes a text file containing the names of all datasets in a CKAN group.
+    Names are written as the pages of the group listing arrive, so any size
+    of group is listed in flat memory.
     :param apikey: user's API key in CKAN
     :param group_name: name of the group
-    :return: None
+    :return: number of datasets written, None if the group could not be listed
     """
     # Set API key in ckanapi module.
-    ckanapi.ghub_headers = {'Authorization': apikey}
+    ckanapi.set_api_key(apikey)
 
-    # Get group information.
-    spill_datasets = ckanapi.list_datasets_in_group(group_name)
+    # Create datasets.txt file at same level, with group name appended
+    datasets_txt = os.path.join(os.getcwd(), 'datasets-%s.txt' % group_name)
+    logger.info('Listing datasets in group %s...' % group_name)
+    count = 0
+    try:
+        # Written to a temp file, so a failed listing never leaves a partial list
+        with open(datasets_txt + '.tmp', 'w') as ds_file:
+            for ds in ckanapi.iter_datasets_in_group(group_name):
+                ds_file.write("%s\n" % ds.get('name'))
+                count += 1
+    except ckanapi.SearchError as e:
+        logger.error('Could not list the datasets of group %s: %s' % (group_name, e))
+        os.remove(datasets_txt + '.tmp')
+        return None
 
-    if spill_datasets:  # List is not empty
-        # Get list of dataset names.
-        dataset_names = [ds.get('name') for ds in spill_datasets]
-
-        # Create datasets.txt file at same level, with group name appended
-        datasets_txt = os.path.join(os.getcwd(), 'datasets-%s.txt' % group_name)
-
-        with open(datasets_txt, 'w') as ds_file:
-            for ds_name in dataset_names:
-                ds_file.write("%s\n" % ds_name)
+    if not count:
+        logger.warning('No datasets for group "%s". are you sure this group exists?' % group_name)
+        os.remove(datasets_txt + '.tmp')
+        return 0
+    os.replace(datasets_txt + '.tmp', datasets_txt)
+    logger.info('Wrote %s dataset names to %s' % (count, datasets_txt))
+    return count
 
 
 def main():
@@ -40,13 +51,21 @@ def main():
                         help='Your API key from the GIS Hub.')
     parser.add_argument('group_name',
                         help='Name of group from the GIS Hub to get dataset names from.')
+    parser.add_argument('--cache-ttl', type=float, default=0,
+                        help='Seconds to reuse cached GIS Hub responses without asking the server (default: 0).')
+    parser.add_argument('--offline', action='store_true',
+                        help='Do not connect to the GIS Hub, only use cached responses.')
 
     # Ensure arguments contains api key and group name.
     if len(sys.argv) < 3:
         parser.print_help()
         parser.exit()
     args = parser.parse_args()
-    get_datasets_in_group(args.apikey, args.group_name)
+    # Cache group listings next to the output file
+    ckanapi.configure_cache(os.path.join(os.getcwd(), '.gokit_cache'), ttl=args.cache_ttl,
+                            offline_mode=args.offline)
+    if get_datasets_in_group(args.apikey, args.group_name) is None:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,387 @@
+"""
+An asyncio implementation of the gokit sync pipeline, selected with
+`gokit_sync.py --engine async`. One process can keep hundreds of metadata
+requests and downloads in flight, bounded by a semaphore per host. Metadata
+and manifest handling, the API response cache and segmented downloads are
+shared with gokit_sync, and file writes run in an executor so the event loop
+never blocks, so both engines leave the same files in the downloads folder.
+"""
+
+import asyncio
+import contextvars
+import copy
+import functools
+import json
+import os
+import time
+import traceback
+import zipfile
+from urllib.parse import urlencode, urljoin, urlparse
+
+import aiohttp
+import requests
+
+import settings
+import gokit_sync
+from lib import ckanapi
+from lib import metrics
+from lib.ratelimit import download_bandwidth
+from lib.store import AlreadyStored, StreamHash, etag_key, parse_hash
+
+logger = settings.setup_logger('gokit_async')
+
+# Default number of datasets in flight, and of requests in flight per host
+WORKERS = 100
+API_LIMIT = 50
+DOWNLOAD_LIMIT = 8
+
+# Redirects followed by hand when downloading, see AsyncSync.open_download
+MAX_REDIRECTS = 5
+
+
+class AsyncSync(object):
+    """
+    Syncs datasets into a downloads folder using one aiohttp session.
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :param api_limit: max concurrent requests to the CKAN API
+    :param download_limit: max concurrent downloads per file host
+    :param store: ContentStore that downloads are kept in, or None
+    """
+
+    def __init__(self, downloads_folder, manifest, api_limit=API_LIMIT, download_limit=DOWNLOAD_LIMIT,
+                 store=None):
+        self.downloads_folder = downloads_folder
+        self.manifest = manifest
+        self.store = store
+        self.api_limit = api_limit
+        self.download_limit = download_limit
+        self.semaphores = {}
+        self.session = None
+
+    def semaphore(self, kind, url):
+        # One semaphore per (kind, host), so API calls and downloads never wait on each other
+        key = (kind, urlparse(url).netloc)
+        if key not in self.semaphores:
+            limit = self.api_limit if kind == 'api' else self.download_limit
+            self.semaphores[key] = asyncio.BoundedSemaphore(limit)
+        return self.semaphores[key]
+
+    async def run_in_executor(self, func, *args):
+        # Run in the executor with this task's context, so metrics go to the right dataset
+        call = functools.partial(contextvars.copy_context().run, func, *args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    async def api_get(self, api_action, params):
+        """
+        GET a CKAN API action, with the same retry policy, shared rate
+        limiter and response cache as ckanapi.api_request.
+        :param api_action: an Enum option from ApiAction
+        :param params: dict of query parameters
+        :return: JSON response as a dict, or an error dict
+        """
+        url = settings.ghub_api_url_base + api_action.value + '?' + urlencode(params)
+        entry = await self.run_in_executor(ckanapi.cache_get, url)
+        if entry and time.time() - entry['stored'] < ckanapi.cache_ttl:
+            logger.debug('Using cached response for %s' % url)
+            return entry['body']
+        # Revalidate the cached response, if any
+        headers = dict(ckanapi.ghub_headers)
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        async with self.semaphore('api', url):
+            for attempt in range(ckanapi.max_retries + 1):
+                await asyncio.sleep(ckanapi.rate_limiter.reserve())
+                last_attempt = attempt == ckanapi.max_retries
+                try:
+                    with metrics.phase('api'):
+                        async with self.session.get(url, headers=headers) as r:
+                            body = await r.read()
+                            metrics.add_bytes('api', len(body))
+                    if r.status == 304 and entry:
+                        ckanapi.rate_limiter.succeeded()
+                        await self.run_in_executor(ckanapi.cache_put, url, r.headers, None, entry)
+                        return entry['body']
+                    if r.status not in ckanapi.RETRY_STATUSES or last_attempt:
+                        if r.status != 200:
+                            logger.warning('Error %s for %s' % (r.status, url))
+                            return json.loads(body)
+                        ckanapi.rate_limiter.succeeded()
+                        resp = json.loads(body)
+                        await self.run_in_executor(ckanapi.cache_put, url, r.headers, resp)
+                        return resp
+                    delay = ckanapi.get_retry_after(r.headers)
+                    if delay is None:
+                        delay = ckanapi.backoff_delay(attempt)
+                    if r.status in [429, 503]:
+                        ckanapi.rate_limiter.throttle(delay)
+                    logger.warning('Error %s from CKAN API, retrying in %.1f secs' % (r.status, delay))
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if last_attempt:
+                        logger.error('Exception in GET request to CKAN API: %s' % e)
+                        return ckanapi.make_error(e.__class__.__name__)
+                    delay = ckanapi.backoff_delay(attempt)
+                    logger.warning('%s from CKAN API, retrying in %.1f secs' % (e.__class__.__name__, delay))
+                except (aiohttp.ClientError, ValueError) as e:
+                    logger.error('Exception in GET request to CKAN API: %s' % e)
+                    return ckanapi.make_error(e.__class__.__name__)
+                metrics.add_retry('api')
+                await asyncio.sleep(delay)
+
+    async def get_dataset(self, name):
+        resp = await self.api_get(ckanapi.ApiAction.package_show, {'id': name})
+        return ckanapi.get_result(resp)
+
+    async def get_datasets_bulk(self, names, chunk_size=ckanapi.BULK_CHUNK_SIZE):
+        # Same lookup as ckanapi.get_datasets_bulk, with all chunks in flight at once
+        async def search(chunk):
+            fq = 'name:(%s)' % ' OR '.join('"%s"' % name for name in chunk)
+            found = []
+            start = 0
+            while True:
+                resp = await self.api_get(ckanapi.ApiAction.package_search, {
+                    'fq': fq, 'include_private': 'True', 'rows': chunk_size, 'start': start})
+                result = resp.get('result')
+                if type(result) is not dict:
+                    logger.warning('Bulk metadata request failed: %s' % resp)
+                    return found
+                results = result.get('results') or []
+                found.extend(results)
+                start += len(results)
+                if not results or start >= result.get('count', 0):
+                    return found
+
+        chunks = [names[i:i + chunk_size] for i in range(0, len(names), chunk_size)]
+        datasets = {}
+        for found in await asyncio.gather(*[search(chunk) for chunk in chunks]):
+            for ds in found:
+                datasets[ds.get('name')] = ds
+        logger.info('Found metadata for %s of %s datasets in bulk' % (len(datasets), len(names)))
+        return datasets
+
+    async def open_download(self, url, headers):
+        """
+        Start a download, following redirects by hand so the API key is only
+        ever sent to the GIS Hub and not to S3.
+        :return: aiohttp response, to be released by the caller
+        """
+        hub_host = urlparse(url).netloc
+        for _ in range(MAX_REDIRECTS):
+            request_headers = dict(headers)
+            if urlparse(url).netloc == hub_host:
+                request_headers.update(ckanapi.ghub_headers)
+            r = await self.session.get(url, headers=request_headers, allow_redirects=False)
+            if r.status not in (301, 302, 303, 307, 308):
+                return r
+            url = urljoin(url, r.headers['Location'])
+            r.release()
+        raise aiohttp.TooManyRedirects(r.request_info, r.history)
+
+    async def fetch_to_part(self, url, part_file, new_hash):
+        # Async version of gokit_sync.fetch_to_part, with the same .part and resume handling
+        info_file = part_file + '.json'
+        info = await self.run_in_executor(gokit_sync.read_part_info, info_file)
+        validator = info.get('etag') or info.get('last_modified')
+        if 'pieces' in info:
+            validator = None
+        offset = 0
+        headers = {'Accept-Encoding': 'identity'}
+        if os.path.exists(part_file) and validator:
+            offset = os.path.getsize(part_file)
+            headers.update({'Range': 'bytes=%s-' % offset, 'If-Range': validator})
+
+        r = await self.open_download(url, headers)
+        try:
+            if r.status == 416:
+                await self.run_in_executor(os.remove, part_file)
+                raise gokit_sync.IncompleteDownload('Partial download does not match the server copy')
+            r.raise_for_status()
+            content_range = r.headers.get('Content-Range', '')
+            if r.status == 206 and content_range.startswith('bytes %s-' % offset):
+                logger.info('Resuming download at %s bytes' % offset)
+                mode = 'ab'
+                sha256 = await self.run_in_executor(gokit_sync.hash_file, part_file, new_hash())
+            elif r.status != 200:
+                await self.run_in_executor(gokit_sync.remove_part, part_file)
+                raise gokit_sync.IncompleteDownload('Unexpected response %s (%s) when resuming at %s bytes' % (
+                    r.status, content_range or 'no Content-Range', offset))
+            else:
+                stored = self.store and not new_hash().expected and self.store.lookup(
+                    etag_key(r.headers.get('ETag'), r.headers.get('Content-Length')))
+                if stored:
+                    raise AlreadyStored(stored)
+                if offset:
+                    logger.info('Partial download is out of date, starting again')
+                offset = 0
+                mode = 'wb'
+                sha256 = new_hash()
+                await self.run_in_executor(gokit_sync.write_part_info, info_file,
+                                           gokit_sync.get_validators(r.headers))
+
+            expected = r.headers.get('Content-Length')
+            expected = offset + int(expected) if expected else None
+            received = offset
+            f = await self.run_in_executor(open, part_file, mode)
+            try:
+                buffer = bytearray()
+                async for chunk in r.content.iter_chunked(gokit_sync.CHUNK_SIZE):
+                    buffer += chunk
+                    received += len(chunk)
+                    metrics.add_bytes('download', len(chunk))
+                    wait = download_bandwidth.reserve(len(chunk))
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    if len(buffer) >= gokit_sync.CHUNK_SIZE:
+                        await self.run_in_executor(write_chunk, f, sha256, bytes(buffer))
+                        buffer = bytearray()
+                if buffer:
+                    await self.run_in_executor(write_chunk, f, sha256, bytes(buffer))
+            finally:
+                await self.run_in_executor(f.close)
+        finally:
+            r.release()
+
+        if expected is not None and received != expected:
+            raise gokit_sync.IncompleteDownload('Received %s of %s bytes' % (received, expected))
+        return sha256
+
+    async def download_file(self, url, title, res_hash=None, res=None):
+        # Same behaviour as gokit_sync.download_file, on the event loop. If the
+        # resource dict is given, its URL is renewed once a download slot is free.
+        dl_target = gokit_sync.get_download_target(url, self.downloads_folder)
+        part_file = dl_target + '.part'
+        ckan_key = gokit_sync.get_ckan_key(res_hash)
+        stored = self.store and self.store.lookup(ckan_key)
+        if stored:
+            return await self.run_in_executor(gokit_sync.link_stored, stored, dl_target, part_file,
+                                              self.store, title)
+        logger.info('Downloading data file %s for resource %s' % (os.path.basename(dl_target), title))
+        new_hash = functools.partial(StreamHash, parse_hash(res_hash))
+        async with self.semaphore('download', url):
+            if res:
+                url = await self.run_in_executor(gokit_sync.resolve_url, res)
+            with metrics.phase('download'):
+                digest = None
+                if gokit_sync.delta_zips and await self.run_in_executor(zipfile.is_zipfile, dl_target):
+                    # Range requests through the shared requests session, off the event loop
+                    digest = await self.run_in_executor(gokit_sync.fetch_delta_zip, url, dl_target,
+                                                        part_file, new_hash)
+                    if digest and not digest.matches():
+                        await self.run_in_executor(gokit_sync.remove_part, part_file)
+                        digest = None
+                for attempt in range(1, gokit_sync.DOWNLOAD_ATTEMPTS + 1):
+                    if digest:
+                        break
+                    try:
+                        if gokit_sync.download_segments > 1:
+                            # Parallel ranges through the shared requests session, off the event loop
+                            etag_store = None if new_hash().expected else self.store
+                            result = await self.run_in_executor(gokit_sync.fetch, url, part_file, new_hash,
+                                                                etag_store)
+                        else:
+                            result = await self.fetch_to_part(url, part_file, new_hash)
+                        await self.run_in_executor(gokit_sync.check_download, part_file, result, title)
+                        digest = result
+                    except AlreadyStored as e:
+                        return await self.run_in_executor(gokit_sync.link_stored, e.sha256, dl_target,
+                                                          part_file, self.store, title)
+                    except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError,
+                            asyncio.TimeoutError, gokit_sync.IncompleteDownload,
+                            requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                            requests.exceptions.Timeout) as e:
+                        if attempt == gokit_sync.DOWNLOAD_ATTEMPTS:
+                            logger.error('Download of %s failed, it will be resumed on the next sync' % title)
+                            raise
+                        logger.warning('Download of %s interrupted (%s), resuming...' % (title, e))
+                        metrics.add_retry('download')
+        sha256 = digest.hexdigest()
+        await self.run_in_executor(gokit_sync.save_download, part_file, dl_target, sha256, self.store, ckan_key)
+        logger.info('Saved %s' % dl_target)
+        return sha256
+
+    async def sync_dataset(self, dataset_name, ds_meta=None):
+        logger.info('Syncing dataset: %s' % dataset_name)
+        if ds_meta is None:
+            ds_meta = await self.get_dataset(dataset_name)
+        hub_meta = copy.deepcopy(ds_meta) if gokit_sync.mirror_folder and ds_meta else None
+        tables = gokit_sync.list_tables(ds_meta)
+        outcome, ds_meta, downloads = await self.run_in_executor(
+            gokit_sync.prepare_dataset, dataset_name, ds_meta, self.downloads_folder, self.manifest)
+        shas = await asyncio.gather(*[self.download_file(res.get('url'), res.get('title'), res.get('hash'), res)
+                                      for res in downloads])
+        for res, sha256 in zip(downloads, shas):
+            dl_target = gokit_sync.get_download_target(res.get('url'), self.downloads_folder)
+            self.manifest.set_resource(dataset_name, res, dl_target, sha256, ds_meta)
+        if tables:
+            await self.run_in_executor(gokit_sync.export_tables, dataset_name, tables, self.downloads_folder,
+                                       self.manifest)
+        await self.run_in_executor(self.manifest.save)
+        if hub_meta:
+            await self.run_in_executor(gokit_sync.publish_metadata, dataset_name, hub_meta)
+        return outcome
+
+    async def sync_worker(self, dataset_name, ds_meta, limit):
+        async with limit:
+            try:
+                with metrics.dataset(dataset_name):
+                    return await self.sync_dataset(dataset_name, ds_meta)
+            except Exception:
+                logger.error('Failed to sync dataset: %s' % dataset_name)
+                logger.error(traceback.format_exc())
+                return gokit_sync.FAILED
+
+    async def run(self, ds_list, workers, priorities=None, ds_metas=None):
+        """
+        Sync a list of datasets, up to workers datasets at a time, in the
+        order given by gokit_sync.schedule. Metadata missing from ds_metas is
+        fetched in bulk.
+        :return: summary dict, as returned by gokit_sync.sync
+        """
+        timeout = ckanapi.http_timeout
+        if type(timeout) is not tuple:
+            timeout = (timeout, timeout)
+        connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+        async with aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])) as session:
+            self.session = session
+            ds_metas = dict(ds_metas or {})
+            missing = [name for name in ds_list if name not in ds_metas]
+            if missing:
+                ds_metas.update(await self.get_datasets_bulk(missing))
+            ds_list = gokit_sync.schedule(ds_list, ds_metas, priorities)
+            limit = asyncio.Semaphore(workers)
+            outcomes = await asyncio.gather(*[self.sync_worker(name, ds_metas.get(name), limit)
+                                              for name in ds_list])
+        summary = gokit_sync.new_summary()
+        for name, outcome in zip(ds_list, outcomes):
+            summary[outcome].append(name)
+        return summary
+
+
+def write_chunk(f, sha256, chunk):
+    f.write(chunk)
+    sha256.update(chunk)
+
+
+def sync(ds_list, downloads_folder, manifest, workers=WORKERS, api_limit=API_LIMIT,
+         download_limit=DOWNLOAD_LIMIT, store=None, priorities=None, ds_metas=None):
+    """
+    Run the async engine to completion.
+    :param ds_list: list of dataset names
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :param workers: number of datasets to sync at once
+    :param api_limit: max concurrent requests to the CKAN API
+    :param download_limit: max concurrent downloads per file host
+    :param store: ContentStore that downloads are kept in
+    :param priorities: dict of dataset priorities, see gokit_sync.read_dataset_file
+    :param ds_metas: metadata already fetched, by dataset name
+    :return: summary dict
+    """
+    logger.info('Syncing with the async engine, %s datasets at a time' % workers)
+    engine = AsyncSync(downloads_folder, manifest, api_limit=api_limit, download_limit=download_limit,
+                       store=store)
+    return asyncio.run(engine.run(ds_list, workers, priorities, ds_metas))
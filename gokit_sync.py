@@ -2,10 +2,28 @@ import settings
 import os
 import sys
 import errno
+import hashlib
+import contextvars
+import copy
+import functools
 import json
-import requests
-from urllib.parse import urlparse
-from lib import ckanapi
+import re
+import shutil
+import threading
+import time
+import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+from lib import metrics
+from lib.ratelimit import download_bandwidth
+from lib.store import AlreadyStored, ContentStore, StreamHash, etag_key, parse_hash
+
+# The networking stack (requests) is only loaded once a sync starts, so that
+# the CLI starts quickly and --help returns straight away
+ckanapi = settings.lazy_import('lib.ckanapi')
+requests = settings.lazy_import('requests')
 
 logger = settings.setup_logger('gokit')
 base_dir = os.path.dirname(os.path.realpath(__file__))
@@ -37,9 +55,73 @@ DS_INTERNALS = ['relationships_as_object', 'private', 'num_tags', 'license_title
 RES_INTERNALS = ['cache_last_updated', 'package_id', 'datastore_active', 'state',
                      'cache_url', 'mimetype_inner', 'revision_id', 'resource_type']
 
+# Bytes read from the network per write when downloading files
+CHUNK_SIZE = 1024 * 1024
+
+# Folder in the downloads folder for cached GIS Hub API responses
+CACHE_FOLDER = '.gokit_cache'
+
+# Times an interrupted download is resumed before giving up on it
+DOWNLOAD_ATTEMPTS = 3
+
+# Files of at least SEGMENT_THRESHOLD bytes are downloaded as several byte
+# ranges at once, up to download_segments in parallel. Ranges are at most
+# SEGMENT_MAX_SIZE, so an interrupted download only repeats the unfinished ones.
+download_segments = 1
+SEGMENT_THRESHOLD = 64 * 1024 * 1024
+SEGMENT_MAX_SIZE = 64 * 1024 * 1024
+
+# Fetch only the changed members of zip files that are already downloaded, see fetch_delta_zip()
+delta_zips = False
+
+# Seconds that watch polls look back before the high-water mark, see find_changed()
+WATCH_OVERLAP = 60
+
+# Signed download URLs expiring within this many seconds are renewed before downloading
+URL_REFRESH_MARGIN = 300
+
+# Processes used to unpack zip files with --extract, None for one per core
+extract_processes = None
+
+# Seconds between two checks of the GIS Hub for changed datasets, when mirroring
+MIRROR_INTERVAL = 300
+
+# Folder that `gokit_sync mirror` serves dataset metadata from, None when not mirroring
+mirror_folder = None
+
+# Export DataStore tables to files in this format ('csv' or 'ndjson'), None to skip them
+datastore_format = None
+
+# Disk space left free after a sync, for metadata, logs and unpacking. See disk_free()
+DISK_RESERVE = 256 * 1024 * 1024
+
+# Download URLs probed for their size at once when planning a sync
+PROBE_WORKERS = 8
+
+# Outcome of syncing a single dataset, used as keys in the sync summary
+SYNCED = 'synced'
+NO_METADATA = 'no_metadata'
+NO_RESOURCES = 'no_resources'
+FAILED = 'failed'
+NO_SPACE = 'no_space'
+OUTCOMES = [SYNCED, NO_METADATA, NO_RESOURCES, FAILED, NO_SPACE]
+
+
+def new_summary():
+    # Sync summary with no datasets yet, mapping each outcome to a list of names
+    return dict((outcome, []) for outcome in OUTCOMES)
+
 
-def read_dataset_list(ds_file):
+def read_dataset_file(ds_file):
+    """
+    Read the list of datasets to sync. Each line holds a dataset name,
+    optionally followed by a priority (0 by default). Datasets with a higher
+    priority are synced first. Lines starting with # are ignored.
+    :param ds_file: text file with one dataset per line
+    :return: tuple of the list of dataset names, and a dict of priorities
+    """
     ds_list = []
+    priorities = {}
     # If the file contains no path, assume it's at this level
     if not os.path.isabs(ds_file):
         ds_file = os.path.join(settings.base_dir, ds_file)
@@ -51,12 +133,95 @@ def read_dataset_list(ds_file):
     with open(ds_file) as f:
         # Read the list of datasets
         for line in f.readlines():
-            ds = line.strip()
-            if len(ds) > 0:
-                ds_list.append(ds)
+            parts = re.split(r'[\s,]+', line.strip())
+            ds = parts[0]
+            if len(ds) == 0 or ds.startswith('#'):
+                continue
+            ds_list.append(ds)
+            if len(parts) > 1:
+                try:
+                    priorities[ds] = int(parts[1])
+                except ValueError:
+                    logger.warning('Ignoring priority %s of dataset %s, it is not a number' % (parts[1], ds))
 
     logger.info('You are syncing %s datasets' % len(ds_list))
-    return ds_list
+    return ds_list, priorities
+
+
+def resource_size(res):
+    # Size of a resource from its CKAN metadata, None if unknown
+    try:
+        return int(res.get('size'))
+    except (TypeError, ValueError):
+        return None
+
+
+def size_order(size):
+    # Sort key putting small files first, and files of unknown size last
+    return (size is None, size or 0)
+
+
+def estimate_size(ds_meta):
+    # Bytes to download for a dataset, from the sizes in its metadata. None if unknown.
+    sizes = [resource_size(res) for res in (ds_meta or {}).get('resources') or []
+             if res.get('url_type') == 'upload']
+    if not sizes or None in sizes:
+        return None
+    return sum(sizes)
+
+
+def schedule(ds_list, ds_metas, priorities=None):
+    """
+    Order datasets for syncing: by priority from the dataset file, then the
+    smallest downloads first, so that a large optional file does not hold up
+    the small ones behind it.
+    :param ds_list: list of dataset names, in file order
+    :param ds_metas: dict of dataset metadata by name, from get_datasets_bulk
+    :param priorities: dict of dataset priorities by name, 0 if missing
+    :return: list of dataset names
+    """
+    priorities = priorities or {}
+    order = sorted(range(len(ds_list)), key=lambda i: (
+        -priorities.get(ds_list[i], 0), size_order(estimate_size(ds_metas.get(ds_list[i]))), i))
+    return [ds_list[i] for i in order]
+
+
+def url_expiry(url):
+    """
+    Expiry time of a signed S3 URL (AWS signature version 2 or 4).
+    :param url: download URL
+    :return: expiry as a Unix timestamp, or None if the URL is not signed
+    """
+    params = parse_qs(urlparse(url or '').query)
+    try:
+        if 'X-Amz-Date' in params and 'X-Amz-Expires' in params:
+            signed = datetime.strptime(params['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+            return signed.timestamp() + int(params['X-Amz-Expires'][0])
+        if 'Expires' in params:
+            return int(params['Expires'][0])
+    except ValueError:
+        logger.warning('Cannot read the expiry time of URL %s' % url)
+    return None
+
+
+def resolve_url(res):
+    """
+    Download URL of a resource, asking the GIS Hub for a new one with
+    resource_show if the signed URL has expired or is about to.
+    :param res: resource dict from CKAN, its url is updated
+    :return: URL to download
+    """
+    url = res.get('url')
+    expiry = url_expiry(url)
+    if expiry is None or expiry - time.time() > URL_REFRESH_MARGIN:
+        return url
+    logger.info('Download URL of %s has expired, getting a new one' % res.get('title'))
+    fresh = ckanapi.get_resource(res.get('id'))
+    if fresh and fresh.get('url'):
+        res['url'] = fresh['url']
+    else:
+        logger.warning('Could not get a new download URL for %s' % res.get('title'))
+    return res.get('url')
 
 
 def setup_downloads_folder(ds_file):
@@ -100,96 +265,834 @@ def remove_internal_fields(ds_meta):
     return ds_meta
 
 
-def format_output(output_lines, content):
-    # Check if content is a nested json
+def write_text_value(f, field_name, content):
+    """
+    Write the value of a field to the metadata text file. Composite fields
+    (JSON strings holding a dict or a list of dicts) are parsed once and
+    written one 'key: value' line per entry.
+    :param f: open text file
+    :param field_name: name of the field, for logging
+    :param content: value of the field
+    :return: None
+    """
+    if type(content) is str and content.lstrip()[:1] in ('[', '{'):
+        parsed = ckanapi.read_composite_field(content, field_name, strict=False)
+        if parsed is not content:
+            for entry in parsed if type(parsed) is list else [parsed]:
+                if type(entry) is dict:
+                    for k, v in entry.items():
+                        f.write('\t%s: %s\n' % (k, v))
+                else:
+                    f.write('\t%s\n' % entry)
+            return
+    # Content is text, write to output
+    f.write('\t%s\n' % content)
+
+
+def write_text_fields(f, output_fields, data):
+    for field in output_fields:
+        f.write('%s:\n' % field)
+        content = data.get(field)
+        if content:
+            write_text_value(f, field, content)
+
+
+def write_text_output(f, ds_meta):
+    # Fields in relevant order, written as they are read
+    f.write('------- Dataset-level Metadata ------- \n')
+    write_text_fields(f, DS_FIELDS, ds_meta)
+    f.write('------- End of Dataset-level Metadata ------- \n')
+    f.write('\n')
+    f.write('------- Resource-level Metadata (for files, layers in uploaded data) ------- \n')
+    for resource in ds_meta.get('resources'):
+        write_text_fields(f, RES_FIELDS, resource)
+    f.write('------- End of Resource-level Metadata ------- \n')
+    f.write('\n')
+
+
+def write_json_output(f, ds_meta):
+    # Encode in chunks, so the whole document is never held in memory
+    for chunk in json.JSONEncoder(indent=2).iterencode(ds_meta):
+        f.write(chunk)
+
+
+@metrics.timed('disk')
+def save_metadata(downloads_folder, dataset_name, ds_meta):
+    """
+    Save the metadata of a dataset to <name>.metadata.json and
+    <name>.metadata.txt. Both are streamed to a temp file and renamed into
+    place, so a failed write never leaves a truncated metadata file.
+    :param downloads_folder: local folder for downloaded files
+    :param dataset_name: name of the dataset
+    :param ds_meta: metadata of the dataset, with internal fields removed
+    :return: None
+    """
+    for ext, writer in [('json', write_json_output), ('txt', write_text_output)]:
+        metadata_file = os.path.join(downloads_folder, '%s.metadata.%s' % (dataset_name, ext))
+        with open(metadata_file + '.tmp', 'w', encoding='utf8', buffering=CHUNK_SIZE) as f:
+            writer(f, ds_meta)
+        os.replace(metadata_file + '.tmp', metadata_file)
+        metrics.add_bytes('disk', os.path.getsize(metadata_file))
+        logger.info('Metadata saved to %s' % metadata_file)
+
+
+def get_download_target(url, downloads_folder):
+    # Downloaded files keep the name they have in the resource URL
+    url_parsed = urlparse(url)
+    remote_file = os.path.basename(url_parsed.path)
+    return os.path.join(downloads_folder, remote_file)
+
+
+class IncompleteDownload(IOError):
+    # Raised when a download ends before all bytes were received
+    pass
+
+
+class ChecksumMismatch(IncompleteDownload):
+    # Raised when a download does not match the hash of the resource in CKAN
+    pass
+
+
+def hash_file(path, sha256=None):
+    # Update a sha256 hash with the contents of a file
+    sha256 = sha256 or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256
+
+
+def read_part_info(info_file):
+    # Validators of the server copy that a partial download was started from
     try:
-        content = json.loads(content)
-        # Check type
-        if type(content) is list:
-            for entry in content:
-                for k, v in entry.items():
-                    format_output(output_lines, '%s: %s' % (k, v))
-        elif type(content) is dict:
-            for k, v in content.items():
-                format_output(output_lines, '%s: %s' % (k, v))
+        with open(info_file, encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def get_validators(headers):
+    validators = {'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+    # Weak ETags cannot be used to resume with If-Range
+    if validators['etag'] and validators['etag'].startswith('W/'):
+        validators['etag'] = None
+    return validators
+
+
+def write_part_info(info_file, info):
+    with open(info_file, 'w', encoding='utf8') as f:
+        json.dump(info, f)
+
+
+def fetch_to_part(url, part_file, new_hash=hashlib.sha256, store=None):
+    """
+    Stream a URL into a .part file. If a partial download from an earlier
+    attempt exists, request only the missing bytes with a Range request. The
+    If-Range validator makes the server send the whole file instead when its
+    copy changed since the partial download was started.
+    :param url: download URL
+    :param part_file: temporary file the download is written to
+    :param new_hash: returns a new hash object, updated as the file streams in
+    :param store: ContentStore, checked for the ETag of the download before
+    the body is read. Raises AlreadyStored if found.
+    :return: hash object of the complete .part file
+    """
+    info_file = part_file + '.json'
+    info = read_part_info(info_file)
+    validator = info.get('etag') or info.get('last_modified')
+    if 'pieces' in info:
+        # Left over from a segmented download
+        validator = None
+    offset = 0
+    # Ask for raw bytes, so that byte ranges and sizes match the file on the server
+    headers = {'Accept-Encoding': 'identity'}
+    if os.path.exists(part_file) and validator:
+        offset = os.path.getsize(part_file)
+        headers.update({'Range': 'bytes=%s-' % offset, 'If-Range': validator})
+
+    with ckanapi.http_request('get', url, stream=True, headers=headers) as r:
+        if r.status_code == 416:
+            # Partial file is larger than the server copy, it is no use
+            os.remove(part_file)
+            raise IncompleteDownload('Partial download does not match the server copy')
+        r.raise_for_status()
+        content_range = r.headers.get('Content-Range', '')
+        if r.status_code == 206 and content_range.startswith('bytes %s-' % offset):
+            logger.info('Resuming download at %s bytes' % offset)
+            mode = 'ab'
+            sha256 = hash_file(part_file, new_hash())
+        elif r.status_code != 200:
+            # Any other range would be saved as if it were the whole file
+            remove_part(part_file)
+            raise IncompleteDownload('Unexpected response %s (%s) when resuming at %s bytes' % (
+                r.status_code, content_range or 'no Content-Range', offset))
         else:
-            logger.warning('Unexpected type')
+            stored = store and store.lookup(etag_key(r.headers.get('ETag'), r.headers.get('Content-Length')))
+            if stored:
+                raise AlreadyStored(stored)
+            if offset:
+                logger.info('Partial download is out of date, starting again')
+            offset = 0
+            mode = 'wb'
+            sha256 = new_hash()
+            write_part_info(info_file, get_validators(r.headers))
 
-    except (TypeError, json.JSONDecodeError):
-        # Content is text, write to output
-        output_lines.append('\t%s\n' % str(content))
+        expected = r.headers.get('Content-Length')
+        expected = offset + int(expected) if expected else None
+        received = offset
+        with open(part_file, mode) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                sha256.update(chunk)
+                received += len(chunk)
+                metrics.add_bytes('download', len(chunk))
+                download_bandwidth.acquire(len(chunk))
 
-    return output_lines
+    if expected is not None and received != expected:
+        raise IncompleteDownload('Received %s of %s bytes' % (received, expected))
+    return sha256
 
 
-def get_formatted_output(output_fields, data, output_lines):
-    for field in output_fields:
-        output_lines.append('%s:\n' % field)
-        content = data.get(field)
-        if content:
-            output_lines = format_output(output_lines, content)
-    return output_lines
+def probe_download(url):
+    """
+    Find the size of a download and whether the server accepts byte ranges,
+    following the redirect from the GIS Hub to S3.
+    :param url: download URL
+    :return: dict with the final url, size, ranges flag and validators, or
+    None if the server could not tell us
+    """
+    headers = {'Accept-Encoding': 'identity'}
+    try:
+        r = ckanapi.http_request('head', url, headers=headers, allow_redirects=True)
+        if r.status_code != 200 or not r.headers.get('Content-Length'):
+            # Signed S3 URLs are only valid for GET, so ask for the first byte instead
+            headers['Range'] = 'bytes=0-0'
+            r = ckanapi.http_request('get', url, headers=headers, stream=True)
+            r.close()
+    except requests.exceptions.RequestException:
+        logger.warning('Could not probe download URL: %s' % url)
+        return None
+
+    probe = get_validators(r.headers)
+    probe['url'] = r.url
+    if r.status_code == 206 and '/' in r.headers.get('Content-Range', ''):
+        probe['size'] = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+        probe['ranges'] = True
+    elif r.status_code == 200 and r.headers.get('Content-Length'):
+        probe['size'] = int(r.headers['Content-Length'])
+        probe['ranges'] = r.headers.get('Accept-Ranges') == 'bytes'
+    else:
+        return None
+    return probe
 
 
-def save_text_output(downloads_folder, dataset_name, ds_meta):
-    # Save fields in relevant order to metadata text file
-    metadata_file = os.path.join(downloads_folder, '%s.metadata.txt' % dataset_name)
-    output_lines = []
-    for level in ['ds_fields', 'res_fields']:
+def get_download_headers(url, final_url):
+    # The API key must not be sent to S3 once the GIS Hub has redirected us there
+    headers = {'Accept-Encoding': 'identity'}
+    if urlparse(url).netloc != urlparse(final_url).netloc:
+        headers['Authorization'] = None
+    return headers
+
+
+def split_ranges(size, segments):
+    # Split size bytes into inclusive (start, end) ranges
+    piece_size = min(-(-size // segments), SEGMENT_MAX_SIZE)
+    return [(start, min(start + piece_size, size) - 1) for start in range(0, size, piece_size)]
+
+
+def fetch_segmented(url, probe, part_file, segments, new_hash=hashlib.sha256):
+    """
+    Download a file as several byte ranges at once. The .part file is
+    preallocated to the full size and each range is written at its offset.
+    Finished ranges are recorded next to the .part file, so that a later
+    attempt only fetches the rest, as long as the server copy is unchanged.
+    :param url: download URL
+    :param probe: result of probe_download() for the URL
+    :param part_file: temporary file the download is written to
+    :param segments: number of ranges to download in parallel
+    :param new_hash: returns a new hash object. Ranges arrive out of order, so
+    the file is hashed once complete.
+    :return: hash object of the complete .part file
+    """
+    info_file = part_file + '.json'
+    size = probe['size']
+    validators = {'etag': probe['etag'], 'last_modified': probe['last_modified']}
+    validator = validators['etag'] or validators['last_modified']
+    info = read_part_info(info_file)
+    resumable = (validator and 'pieces' in info and info.get('size') == size and
+                 all(info.get(k) == v for k, v in validators.items()) and
+                 os.path.exists(part_file) and os.path.getsize(part_file) == size)
+    if not resumable:
+        if os.path.exists(part_file):
+            logger.info('Partial download is out of date, starting again')
+        info = dict(validators, size=size, pieces=[])
+        with open(part_file, 'wb') as f:
+            f.truncate(size)
+        write_part_info(info_file, info)
+
+    done = set(tuple(piece) for piece in info['pieces'])
+    todo = [piece for piece in split_ranges(size, segments) if piece not in done]
+    logger.info('Downloading %s bytes in %s ranges, %s at a time' % (size, len(todo), segments))
+    headers = get_download_headers(url, probe['url'])
+    if validator:
+        headers['If-Range'] = validator
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def fetch_piece(piece):
+        start, end = piece
+        piece_headers = dict(headers, Range='bytes=%s-%s' % piece)
+        received = 0
+        with ckanapi.http_request('get', probe['url'], stream=True, headers=piece_headers) as r:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise IncompleteDownload('Server sent the whole file instead of a range')
+            with open(part_file, 'r+b') as f:
+                f.seek(start)
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    if stop.is_set():
+                        raise IncompleteDownload('Download stopped')
+                    f.write(chunk)
+                    received += len(chunk)
+                    metrics.add_bytes('download', len(chunk))
+                    download_bandwidth.acquire(len(chunk))
+        if received != end - start + 1:
+            raise IncompleteDownload('Received %s of %s bytes' % (received, end - start + 1))
+        with lock:
+            info['pieces'].append(list(piece))
+            write_part_info(info_file, info)
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        # Ranges count towards the metrics of the dataset being synced
+        futures = [pool.submit(contextvars.copy_context().run, fetch_piece, piece) for piece in todo]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            # Let the other ranges stop early, they will be resumed on the next attempt
+            stop.set()
+            raise
+    return hash_file(part_file, new_hash())
+
+
+def fetch(url, part_file, new_hash=hashlib.sha256, store=None):
+    # Download to the .part file, in parallel ranges if the file is large enough
+    if download_segments > 1:
+        probe = probe_download(url)
+        stored = probe and store and store.lookup(etag_key(probe['etag'], probe['size']))
+        if stored:
+            raise AlreadyStored(stored)
+        if probe and probe['ranges'] and probe['size'] >= SEGMENT_THRESHOLD:
+            return fetch_segmented(url, probe, part_file, download_segments, new_hash)
+    return fetch_to_part(url, part_file, new_hash, store)
+
+
+def fetch_delta_zip(url, local_zip, part_file, new_hash):
+    """
+    Download a new version of a zip by fetching only the members that changed
+    since the local copy, see lib/zipdelta.py.
+    :param url: download URL
+    :param local_zip: previous version of the file
+    :param part_file: temporary file the new version is written to
+    :param new_hash: returns a new hash object
+    :return: hash object of the complete .part file, or None if the file must
+    be downloaded in full
+    """
+    from lib import zipdelta
+    # The new version of a small zip costs little more to fetch whole than its central directory
+    if os.path.getsize(local_zip) < zipdelta.DELTA_MIN_SIZE:
+        return None
+    probe = probe_download(url)
+    if not probe or not probe['ranges']:
+        return None
+    digest = new_hash()
+    try:
+        fetched = zipdelta.fetch_delta(probe, get_download_headers(url, probe['url']), local_zip,
+                                       part_file, digest)
+    except (zipdelta.DeltaError, requests.exceptions.RequestException) as e:
+        logger.warning('Delta download failed (%s), downloading the whole file' % e)
+        fetched = None
+    if fetched is None:
+        remove_part(part_file)
+        return None
+    logger.info('Fetched %s of %s bytes, the rest was copied from the local copy' % (fetched, probe['size']))
+    write_part_info(part_file + '.json', {'etag': probe['etag'], 'last_modified': probe['last_modified']})
+    return digest
 
-        if level == 'ds_fields':
-            output_lines.append('------- Dataset-level Metadata ------- \n')
-            output_lines = get_formatted_output(DS_FIELDS, ds_meta, output_lines)
-            output_lines.append('------- End of Dataset-level Metadata ------- \n')
-            output_lines.append('\n')
-        elif level == 'res_fields':
-            output_lines.append('------- Resource-level Metadata (for files, layers in uploaded data) ------- \n')
-            for resource in ds_meta.get('resources'):
-                output_lines = get_formatted_output(RES_FIELDS, resource, output_lines)
-            output_lines.append('------- End of Resource-level Metadata ------- \n')
-            output_lines.append('\n')
 
-    logger.info('Writing metadata to text file: %s' % metadata_file)
-    with open(metadata_file, 'w', encoding='utf8') as metatext:
-        metatext.writelines(output_lines)
+def remove_part(part_file):
+    # Remove a .part file and its validators
+    for path in [part_file, part_file + '.json']:
+        if os.path.exists(path):
+            os.remove(path)
 
 
-def save_json_output(downloads_folder, dataset_name, ds_meta):
-    # Dump json file first
-    metadata_file = os.path.join(downloads_folder, '%s.metadata.json' % dataset_name)
-    with open(metadata_file, 'w', encoding='utf8') as f:
-        json.dump(ds_meta, f, indent=2)
-    logger.info('Metadata saved to %s' % metadata_file)
+def check_download(part_file, digest, title):
+    # Raise ChecksumMismatch if the download does not match the hash in CKAN
+    if not digest.matches():
+        remove_part(part_file)
+        raise ChecksumMismatch('%s does not match the hash in CKAN, downloading again' % title)
 
 
-def download_file(url, downloads_folder, title):
+def save_download(part_file, dl_target, sha256, store=None, ckan_key=None):
+    """
+    Move a complete .part file into place, through the store if there is one.
+    :param part_file: the complete download
+    :param dl_target: path of the file in the downloads folder
+    :param sha256: hex digest of the download
+    :param store: ContentStore of the downloads folder, or None
+    :param ckan_key: index key of the hash in CKAN, see parse_hash()
+    :return: None
+    """
+    if store:
+        info = read_part_info(part_file + '.json')
+        keys = [ckan_key, etag_key(info.get('etag'), os.path.getsize(part_file))]
+        store.add(part_file, sha256, dl_target, keys)
+    else:
+        os.replace(part_file, dl_target)
+    remove_part(part_file)
+
+
+def link_stored(sha256, dl_target, part_file, store, title):
+    # A download that is in the store already: link it into place and drop any partial download
+    logger.info('Data file for resource %s is a copy of a stored file, linking it' % title)
+    store.link(sha256, dl_target)
+    remove_part(part_file)
+    return sha256
+
+
+def get_ckan_key(res_hash):
+    # Store index key of the hash of a resource in CKAN, or None
+    expected = parse_hash(res_hash)
+    return '%s:%s' % expected if expected else None
+
+
+@metrics.timed('download')
+def download_file(url, downloads_folder, title, store=None, res_hash=None):
     """
     Download the resource file directly from S3 URL, without using the
-    Amazon S3 boto module (so we don't need to reveal API keys).
+    Amazon S3 boto module (so we don't need to reveal API keys). The file is
+    written to a .part file first and only renamed into place once complete,
+    so an interrupted download never leaves a truncated file behind. The next
+    attempt (or the next sync) resumes it where it stopped.
     :param url: a signed download URL to the resource on S3
     :param downloads_folder: local folder for downloaded files
     :param title: title of the resource in CKAN containing the
     downloadable zip archive for the dataset
-    :return: None
+    :param store: ContentStore of the downloads folder. Files already in the
+    store are linked into place instead of downloaded again.
+    :param res_hash: hash field of the resource in CKAN, checked against the
+    download if set
+    :return: sha256 hex digest of the downloaded file
     """
-    url_parsed = urlparse(url)
-    remote_file = os.path.basename(url_parsed.path)
-    logger.info('Downloading data file %s for resource %s' % (remote_file, title))
-    r = requests.get(url, stream=True, headers=ckanapi.ghub_headers)
-    dl_target = os.path.join(downloads_folder, remote_file)
+    dl_target = get_download_target(url, downloads_folder)
+    part_file = dl_target + '.part'
+    ckan_key = get_ckan_key(res_hash)
+    stored = store and store.lookup(ckan_key)
+    if stored:
+        return link_stored(stored, dl_target, part_file, store, title)
+    logger.info('Downloading data file %s for resource %s' % (os.path.basename(dl_target), title))
     logger.info('Saving download to: %s' % dl_target)
-    with open(dl_target, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=128):
-            f.write(chunk)
+    new_hash = functools.partial(StreamHash, parse_hash(res_hash))
+    # With a hash in CKAN, only a stored file with that hash will do, not one with the same ETag
+    etag_store = None if ckan_key else store
+    digest = None
+    if delta_zips and zipfile.is_zipfile(dl_target):
+        digest = fetch_delta_zip(url, dl_target, part_file, new_hash)
+        if digest and not digest.matches():
+            logger.warning('Delta download of %s does not match the hash in CKAN, downloading all of it' % title)
+            remove_part(part_file)
+            digest = None
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        if digest:
+            break
+        try:
+            result = fetch(url, part_file, new_hash, etag_store)
+            check_download(part_file, result, title)
+            digest = result
+        except AlreadyStored as e:
+            return link_stored(e.sha256, dl_target, part_file, store, title)
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout, IncompleteDownload) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                logger.error('Download of %s failed, it will be resumed on the next sync' % title)
+                raise
+            logger.warning('Download of %s interrupted (%s), resuming...' % (title, e))
+            metrics.add_retry('download')
+
+    sha256 = digest.hexdigest()
+    save_download(part_file, dl_target, sha256, store, ckan_key)
     logger.info('Saved')
+    return sha256
 
 
-def sync(ds_file):
+def prepare_dataset(dataset_name, ds_meta, downloads_folder, manifest):
+    """
+    Check the metadata of a dataset, save it to the downloads folder unless
+    it is unchanged, and list the uploaded resources that need downloading.
+    :param dataset_name: name of the dataset on the GIS Hub
+    :param ds_meta: metadata of the dataset from CKAN
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :return: tuple of the sync outcome, the cleaned metadata, and a list of
+    resources to download
+    """
+    logger.debug(ds_meta)
+    if not ds_meta:
+        logger.warning('No metadata for %s. Are you sure this dataset exists?' % dataset_name)
+        return NO_METADATA, ds_meta, []
+
+    # List resources in metadata, find any with a url_type = 'upload'
+    resources = ds_meta.get('resources')
+    if not type(resources) is list or len(resources) == 0:
+        logger.warning('Dataset %s has no resources.' % dataset_name)
+        return NO_RESOURCES, ds_meta, []
+
+    # Cleanup metadata and save to downloads folder, unless it is unchanged
+    ds_meta = remove_internal_fields(ds_meta)
+    metadata_files = [os.path.join(downloads_folder, '%s.metadata.%s' % (dataset_name, ext))
+                      for ext in ['json', 'txt']]
+    if manifest.metadata_changed(dataset_name, ds_meta, metadata_files):
+        save_metadata(downloads_folder, dataset_name, ds_meta)
+        manifest.set_metadata(dataset_name, ds_meta)
+    else:
+        logger.info('Metadata for %s is unchanged' % dataset_name)
+
+    logger.info('Checking %s resources' % len(resources))
+    return SYNCED, ds_meta, list_downloads(dataset_name, resources, ds_meta, downloads_folder, manifest)
+
+
+def list_downloads(dataset_name, resources, ds_meta, downloads_folder, manifest, verbose=True):
+    """
+    List the uploaded resources of a dataset that changed since the last
+    sync, small files first.
+    :param dataset_name: name of the dataset on the GIS Hub
+    :param resources: resources of the dataset from CKAN, before
+    remove_internal_fields drops the uploads
+    :param ds_meta: metadata of the dataset from CKAN
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :param verbose: log files without access and files that are up to date
+    :return: list of resource dicts
+    """
+    downloads = []
+    for res in resources:
+        if res.get('url_type') == 'upload':
+            url = res.get('url')
+            if not url:
+                if verbose:
+                    logger.warning('You do not have access to the data for: %s' % dataset_name)
+                    logger.warning('Please contact the dataset owner.')
+                continue
+            dl_target = get_download_target(url, downloads_folder)
+            if not manifest.resource_changed(dataset_name, res, dl_target, ds_meta):
+                if verbose:
+                    logger.info('Data file for resource %s is up to date' % res.get('title'))
+                continue
+            downloads.append(res)
+    # Small files first
+    downloads.sort(key=lambda res: size_order(resource_size(res)))
+    return downloads
+
+
+def transfer_size(res, downloads_folder, store, probe=None):
+    """
+    Bytes left to download for a resource: none if the store already holds
+    it (but the size of the copy on drives without hardlinks), and only the
+    rest of the file if an interrupted download left a .part file behind.
+    :param res: resource dict from CKAN
+    :param downloads_folder: local folder for downloaded files
+    :param store: ContentStore of the downloads folder
+    :param probe: result of probe_download() for the resource URL, if any
+    :return: size in bytes, or None if neither the server nor CKAN knows it
+    """
+    stored = store.lookup(get_ckan_key(res.get('hash')))
+    if stored:
+        return 0 if store.hardlinks else os.path.getsize(store.object_path(stored))
+    size = (probe or {}).get('size') or resource_size(res)
+    if size is None:
+        return None
+    part_file = get_download_target(res['url'], downloads_folder) + '.part'
+    if os.path.exists(part_file):
+        size -= min(os.path.getsize(part_file), size)
+    return size
+
+
+def plan_sync(ds_list, downloads_folder, manifest, store, priorities=None, ds_metas=None):
+    """
+    Work out what a sync of a list of datasets will download, without
+    downloading or writing anything. Files are counted at their size in
+    CKAN. Only files that CKAN has no size for are asked of the file server,
+    PROBE_WORKERS URLs at a time. Datasets the bulk search did not return
+    are looked up PROBE_WORKERS at a time too.
+    :param ds_list: list of dataset names
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :param store: ContentStore of the downloads folder
+    :param priorities: dict of dataset priorities by name
+    :param ds_metas: metadata already fetched, by dataset name
+    :return: tuple of the metadata of the datasets by name, for the sync to
+    reuse ({} for datasets that were not found, none for those whose lookup
+    failed, so the sync tries again), and the plan: one dict per dataset, in
+    schedule() order, with the number of files to download, their total
+    bytes and the number of files of unknown size
+    """
+    ds_metas = dict(ds_metas or {})
+    missing = [name for name in ds_list if name not in ds_metas]
+    if missing:
+        ds_metas.update(ckanapi.get_datasets_bulk(missing))
+    missing = [name for name in ds_list if name not in ds_metas]
+    if missing:
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+            for name, ds_meta in zip(missing, pool.map(ckanapi.find_dataset, missing)):
+                # Empty metadata records that the dataset was looked up and not found. Offline,
+                # looking it up again would not find it either
+                if ds_meta is not None or ckanapi.offline:
+                    ds_metas[name] = ds_meta or {}
+    ds_list = schedule(ds_list, ds_metas, priorities)
+
+    downloads = {}
+    for name in ds_list:
+        ds_meta = ds_metas.get(name)
+        resources = (ds_meta or {}).get('resources') or []
+        downloads[name] = list_downloads(name, resources, ds_meta, downloads_folder, manifest, verbose=False)
+    # Files already in the store are not downloaded, so their size does not matter
+    urls = [res['url'] for name in ds_list for res in downloads[name]
+            if resource_size(res) is None and not store.lookup(get_ckan_key(res.get('hash')))]
+    probes = {}
+    if urls and not ckanapi.offline:
+        logger.info('Checking the size of %s files to download' % len(urls))
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as pool:
+            probes = dict(zip(urls, pool.map(probe_download, urls)))
+
+    plan = []
+    for name in ds_list:
+        sizes = [transfer_size(res, downloads_folder, store, probes.get(res['url'])) for res in downloads[name]]
+        plan.append({'name': name,
+                     'files': len([size for size in sizes if size != 0]),
+                     'bytes': sum(size for size in sizes if size),
+                     'unknown': sizes.count(None)})
+    return ds_metas, plan
+
+
+def disk_free(folder):
+    # Bytes free on the disk of a folder for a sync to use, after DISK_RESERVE
+    return max(shutil.disk_usage(folder).free - DISK_RESERVE, 0)
+
+
+def fit_plan(plan, free):
+    """
+    Trim a sync plan to the free disk space. Datasets are taken in plan
+    order, i.e. highest priority first, as long as they fit, so a large
+    dataset that does not fit leaves room for smaller ones after it.
+    :param plan: plan from plan_sync()
+    :param free: bytes free, from disk_free()
+    :return: tuple of the names of the datasets that fit and of those left out
+    """
+    fits, left_out = [], []
+    for ds in plan:
+        if ds['bytes'] <= free:
+            fits.append(ds['name'])
+            free -= ds['bytes']
+        else:
+            left_out.append(ds['name'])
+    return fits, left_out
+
+
+def format_bytes(size):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return ('%d %s' if unit == 'bytes' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+
+
+def log_plan(plan, free, left_out=()):
+    """
+    Log the bytes to download for each dataset of a plan, the total and the
+    disk space free for them.
+    :param plan: plan from plan_sync()
+    :param free: bytes free, from disk_free()
+    :param left_out: names of the datasets that do not fit, from fit_plan()
+    :return: None
+    """
+    logger.info('')
+    logger.info('      >>>>   Sync Plan   <<<<         ')
+    for ds in plan:
+        if not ds['files']:
+            continue
+        note = ''
+        if ds['unknown']:
+            note += ', %s of unknown size' % ds['unknown']
+        if ds['name'] in left_out:
+            note += ', does not fit'
+        logger.info('%s: %s files, %s%s' % (ds['name'], ds['files'], format_bytes(ds['bytes']), note))
+    total = sum(ds['bytes'] for ds in plan)
+    files = sum(ds['files'] for ds in plan)
+    unknown = sum(ds['unknown'] for ds in plan)
+    logger.info('To download: %s files in %s datasets, %s' % (
+        files, len([ds for ds in plan if ds['files']]), format_bytes(total)))
+    if unknown:
+        logger.warning('%s files are of unknown size and not counted' % unknown)
+    logger.info('Free disk space: %s (keeping %s spare)' % (format_bytes(free), format_bytes(DISK_RESERVE)))
+    if left_out:
+        logger.warning('Not enough disk space for: %s' % ', '.join(left_out))
+
+
+def list_tables(ds_meta):
+    """
+    DataStore tables of a dataset to export, when datastore_format is set.
+    Tables loaded from an uploaded file are left out, the file itself is
+    downloaded. Call before remove_internal_fields, which drops
+    datastore_active.
+    :param ds_meta: dataset dict from CKAN
+    :return: list of resource dicts
+    """
+    if not datastore_format or not ds_meta:
+        return []
+    return [res for res in ds_meta.get('resources') or []
+            if res.get('datastore_active') in (True, 'true', 'True') and res.get('url_type') != 'upload']
+
+
+def get_table_target(downloads_folder, dataset_name, res_id):
+    # Local file a DataStore table is exported to
+    return os.path.join(downloads_folder, '%s.%s.%s' % (dataset_name, res_id, datastore_format))
+
+
+@metrics.timed('datastore')
+def export_tables(dataset_name, tables, downloads_folder, manifest):
+    """
+    Export the DataStore tables of a dataset to the downloads folder, only
+    fetching the rows added since the last export where possible. See
+    lib.datastore.
+    :param dataset_name: name of the dataset on the GIS Hub
+    :param tables: resource dicts, from list_tables()
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :return: None
+    """
+    from lib import datastore
+    for res in tables:
+        res_id = res.get('id')
+        target = get_table_target(downloads_folder, dataset_name, res_id)
+        state = None if manifest.force else manifest.get_table(dataset_name, res_id)
+        logger.info('Exporting DataStore table %s to %s' % (res.get('name') or res_id, target))
+        state = datastore.export_table(res_id, target, datastore_format, state)
+        manifest.set_table(dataset_name, res_id, target, state)
+        logger.info('Exported %s rows' % state['rows'])
+
+
+def publish_metadata(dataset_name, ds_meta):
+    """
+    Save the metadata of a dataset as the GIS Hub sent it, for the mirror
+    to serve. Called once the files of the dataset are downloaded, so that
+    mirror clients never see metadata newer than the files.
+    :param dataset_name: name of the dataset
+    :param ds_meta: dataset dict from CKAN, before remove_internal_fields
+    :return: None
+    """
+    os.makedirs(mirror_folder, exist_ok=True)
+    meta_file = os.path.join(mirror_folder, '%s.json' % dataset_name)
+    with open(meta_file + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(ds_meta, f)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+def sync_dataset(dataset_name, downloads_folder, manifest, ds_meta=None, store=None):
+    """
+    Sync a single dataset: fetch its metadata, save the metadata files and
+    download any uploaded resources that changed since the last sync.
+    :param dataset_name: name of the dataset on the GIS Hub
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :param ds_meta: metadata of the dataset if already fetched, {} if it was
+    looked up and not found, or None to fetch it with package_show
+    :param store: ContentStore that downloads are kept in
+    :return: outcome of the sync (SYNCED, NO_METADATA or NO_RESOURCES)
+    """
+    logger.info('')
+    logger.info('      >>>>   Starting Sync   <<<<         ')
+    logger.info('Syncing dataset: %s' % dataset_name)
+    # List all the resources for this dataset with download URLs
+    if ds_meta is None:
+        ds_meta = ckanapi.get_dataset(dataset_name)
+    # prepare_dataset cleans the metadata in place
+    hub_meta = copy.deepcopy(ds_meta) if mirror_folder and ds_meta else None
+    tables = list_tables(ds_meta)
+    outcome, ds_meta, downloads = prepare_dataset(dataset_name, ds_meta, downloads_folder, manifest)
+    if ckanapi.offline and downloads:
+        logger.warning('Offline, %s changed data files of %s were not downloaded' % (
+            len(downloads), dataset_name))
+        downloads = []
+    for res in downloads:
+        url = resolve_url(res)
+        sha256 = download_file(url, downloads_folder, res.get('title'), store, res.get('hash'))
+        dl_target = get_download_target(url, downloads_folder)
+        manifest.set_resource(dataset_name, res, dl_target, sha256, ds_meta)
+    if ckanapi.offline and tables:
+        logger.warning('Offline, the DataStore tables of %s were not exported' % dataset_name)
+    elif tables:
+        export_tables(dataset_name, tables, downloads_folder, manifest)
+    manifest.save()
+    if hub_meta:
+        publish_metadata(dataset_name, hub_meta)
+    return outcome
+
+
+def sync_worker(dataset_name, downloads_folder, manifest, ds_meta=None, store=None):
+    """
+    Run sync_dataset in a worker thread. The thread is renamed after the
+    dataset while it works, so that interleaved log lines from several
+    workers can be told apart.
+    :return: outcome of the sync, FAILED if an exception was raised
+    """
+    thread = threading.current_thread()
+    thread_name = thread.name
+    thread.name = dataset_name
+    try:
+        with metrics.dataset(dataset_name):
+            return sync_dataset(dataset_name, downloads_folder, manifest, ds_meta, store)
+    except Exception:
+        logger.error('Failed to sync dataset: %s' % dataset_name)
+        logger.error(traceback.format_exc())
+        return FAILED
+    finally:
+        thread.name = thread_name
+
+
+def log_summary(summary):
+    logger.info('')
+    logger.info('      >>>>   Sync Summary   <<<<         ')
+    logger.info('Synced: %s datasets' % len(summary[SYNCED]))
+    if summary[NO_METADATA]:
+        logger.warning('No metadata found for: %s' % ', '.join(summary[NO_METADATA]))
+    if summary[NO_RESOURCES]:
+        logger.warning('No resources found for: %s' % ', '.join(summary[NO_RESOURCES]))
+    if summary[FAILED]:
+        logger.error('Failed to sync: %s' % ', '.join(summary[FAILED]))
+    if summary[NO_SPACE]:
+        logger.error('Not synced for lack of disk space: %s' % ', '.join(summary[NO_SPACE]))
+
+
+def sync(ds_file, workers=1, force=False, engine='threads', engine_options=None, extract=False,
+         group=None, watch_interval=None, if_no_space='stop'):
     """
     Synchronize a list of input datasets from the CKAN site to the user's
-    download folder.
+    download folder. Only datasets and files that changed since the last
+    sync are written, unless force is set.
     :param ds_file: text file containining dataset names, one per line
-    :return: None
+    :param workers: number of datasets to sync in parallel
+    :param force: download everything again, ignoring the sync manifest
+    :param engine: 'threads', or 'async' to use the asyncio engine in gokit_async
+    :param engine_options: extra keyword arguments for gokit_async.sync
+    :param extract: unpack downloaded zip files into a folder per dataset
+    :param group: also sync every dataset in this GIS Hub group
+    :param watch_interval: keep running after the first sync, polling the GIS
+    Hub for changed datasets every watch_interval seconds, until interrupted
+    :param if_no_space: when the downloads of a pass do not fit in the free
+    disk space: 'stop' to download nothing, 'trim' to leave out the lowest
+    priority datasets, or 'ignore' to sync without checking, see plan_sync()
+    :return: summary dict of the last sync, mapping each sync outcome to a
+    list of dataset names
     """
 
     # Set the log file to same location as ds_file
@@ -197,45 +1100,407 @@ def sync(ds_file):
     settings.add_disk_log(logger, logfile)
 
     logger.info('Starting GoKit sync')
+    downloads_folder, manifest, store = open_downloads_folder(ds_file, force)
+
+    logger.info('Connecting to GIS Hub...')
+    options = {'workers': workers, 'engine': engine, 'engine_options': engine_options, 'extract': extract,
+               'if_no_space': if_no_space}
+    summary = sync_pass(ds_file, downloads_folder, manifest, store, group=group, **options)
+    if not watch_interval:
+        return summary
 
-    # Setup downloads folder and cache
+    # Only the first pass honours force, later ones sync what changed
+    manifest.force = False
+    logger.info('Watching for changes every %s seconds, press Ctrl+C to stop' % watch_interval)
+    try:
+        while True:
+            time.sleep(watch_interval)
+            summary = sync_pass(ds_file, downloads_folder, manifest, store, group=group, watch=True,
+                                retry=summary[FAILED] + summary[NO_SPACE], **options)
+    except KeyboardInterrupt:
+        logger.info('Stopped watching')
+    return summary
+
+
+def open_downloads_folder(ds_file, force=False):
+    """
+    Set up the downloads folder, manifest and cache next to a dataset file.
+    :param ds_file: text file with the datasets to sync
+    :param force: download everything again, ignoring the sync manifest
+    :return: tuple of the downloads folder, its SyncManifest and ContentStore
+    """
     downloads_folder = setup_downloads_folder(ds_file)
+    from lib.manifest import SyncManifest
+    manifest = SyncManifest(downloads_folder, force=force)
+    store = ContentStore(downloads_folder)
+    ckanapi.configure_cache(os.path.join(downloads_folder, CACHE_FOLDER))
+    return downloads_folder, manifest, store
 
-    logger.info('Connecting to GIS Hub...')
-    ds_list = read_dataset_list(ds_file)
-    for dataset_name in ds_list:
 
-        logger.info('')
-        logger.info('      >>>>   Starting Sync   <<<<         ')
-        logger.info('Syncing dataset: %s' % dataset_name)
-        # List all the resources for this dataset with download URLs
-        ds_meta = ckanapi.get_dataset(dataset_name)
-        logger.debug(ds_meta)
-        if not ds_meta:
-            logger.warning('No metadata for %s. Are you sure this dataset exists?' % dataset_name)
-            continue
+def plan(ds_file, force=False, group=None):
+    """
+    Report what a sync would download, per dataset and in total, and
+    whether it fits in the free disk space. Nothing is downloaded.
+    :param ds_file: text file with the datasets to sync
+    :param force: plan to download everything again
+    :param group: also plan for every dataset in this GIS Hub group
+    :return: True if the sync fits in the free disk space
+    """
+    logfile = os.path.join(os.path.dirname(ds_file), 'gokit_sync.log')
+    settings.add_disk_log(logger, logfile)
+    logger.info('Planning GoKit sync')
+    downloads_folder, manifest, store = open_downloads_folder(ds_file, force)
+    ds_list, priorities, ds_metas = read_sync_list(ds_file, group)
+    ds_metas, ds_plan = plan_sync(ds_list, downloads_folder, manifest, store, priorities, ds_metas)
+    free = disk_free(downloads_folder)
+    left_out = fit_plan(ds_plan, free)[1]
+    log_plan(ds_plan, free, left_out)
+    return not left_out
 
-        # List resources in metadata, find any with a url_type = 'upload'
-        resources = ds_meta.get('resources')
-        if not type(resources) is list or len(resources) == 0:
-            logger.warning('Dataset %s has no resources.' % dataset_name)
-            continue
 
-        # Cleanup metadata and save to downloads folder
-        ds_meta = remove_internal_fields(ds_meta)
-        save_json_output(downloads_folder, dataset_name, ds_meta)
-        save_text_output(downloads_folder, dataset_name, ds_meta)
+def read_sync_list(ds_file, group=None):
+    """
+    Datasets to sync: the ones in the dataset file, re-read each time, and
+    those in the group.
+    :param ds_file: text file with the datasets to sync
+    :param group: GIS Hub group whose datasets are synced too
+    :return: tuple of the list of dataset names, their priorities by name,
+    and the metadata of the group datasets by name (None without a group)
+    """
+    ds_list, priorities = read_dataset_file(ds_file)
+    ds_metas = None
+    if group:
+        group_metas = dict((ds.get('name'), ds) for ds in ckanapi.list_datasets_in_group(group) or [])
+        logger.info('Group %s has %s datasets' % (group, len(group_metas)))
+        ds_list = ds_list + [name for name in group_metas if name not in ds_list]
+        ds_metas = group_metas
+    return ds_list, priorities, ds_metas
+
+
+def find_changed(ds_list, manifest, group=None):
+    """
+    Datasets to sync on a watch poll: the ones modified on the GIS Hub since
+    the high-water mark of the manifest, found with one package_search, plus
+    any in the list that were never synced.
+    :param ds_list: names of the datasets in the dataset file
+    :param manifest: SyncManifest of the downloads folder
+    :param group: GIS Hub group whose datasets are synced too
+    :return: tuple of the list of dataset names to sync and the dict of their
+    metadata from the search, or (None, None) if the search failed
+    """
+    since = manifest.high_water()
+    if not since:
+        return ds_list, {}
+    # Look back a little, in case the search index was behind the last time
+    since = (datetime.fromisoformat(since) - timedelta(seconds=WATCH_OVERLAP)).isoformat()
+    ds_metas = ckanapi.get_datasets_modified_since(since, ds_list, group)
+    if ds_metas is None:
+        return None, None
+    changed = [name for name, ds in ds_metas.items()
+               if ds.get('metadata_modified') != manifest.synced_version(name)]
+    new = [name for name in ds_list if name not in ds_metas and manifest.synced_version(name) is None]
+    return changed + new, ds_metas
+
+
+def sync_pass(ds_file, downloads_folder, manifest, store, workers=1, engine='threads', engine_options=None,
+              extract=False, group=None, watch=False, retry=(), if_no_space='stop'):
+    """
+    One sync of the datasets in the dataset file (re-read each time) and
+    group, or on a watch poll only of those that changed.
+    :param watch: only sync datasets changed since the last pass, see find_changed()
+    :param retry: names of datasets that failed on the last pass, synced again
+    :param if_no_space: 'stop', 'trim' or 'ignore', see sync()
+    :return: summary dict
+    """
+    metrics.reset()
+    if watch:
+        ds_list, priorities = read_dataset_file(ds_file)
+        names, ds_metas = find_changed(ds_list, manifest, group)
+        if names is None:
+            logger.warning('Could not check the GIS Hub for changes, trying again later')
+            names, ds_metas = [], {}
+        ds_list = names + [name for name in retry if name not in names]
+        if not ds_list:
+            logger.info('No datasets changed on the GIS Hub')
+            return new_summary()
+        logger.info('%s datasets changed on the GIS Hub' % len(ds_list))
+    else:
+        ds_list, priorities, ds_metas = read_sync_list(ds_file, group)
+
+    # Check that the downloads fit on the disk before starting any of them
+    left_out = []
+    if if_no_space != 'ignore' and not ckanapi.offline:
+        ds_metas, ds_plan = plan_sync(ds_list, downloads_folder, manifest, store, priorities, ds_metas)
+        free = disk_free(downloads_folder)
+        ds_list, left_out = fit_plan(ds_plan, free)
+        if left_out:
+            log_plan(ds_plan, free, left_out)
+            if if_no_space == 'stop':
+                logger.error('Not enough disk space for this sync, nothing was downloaded. '
+                             'Free up some space, or use --if-no-space trim to sync what fits.')
+                ds_list, left_out = [], [ds['name'] for ds in ds_plan]
+            else:
+                logger.warning('Syncing the datasets that fit, by priority')
+
+    if engine == 'async':
+        import gokit_async
+        summary = gokit_async.sync(ds_list, downloads_folder, manifest, workers, store=store,
+                                   priorities=priorities, ds_metas=ds_metas, **(engine_options or {}))
+    else:
+        summary = sync_threads(ds_list, downloads_folder, manifest, store, workers, priorities, ds_metas)
+    summary[NO_SPACE] = left_out
+
+    # Drop stored files that no dataset links to any more
+    store.prune()
+    if extract:
+        extract_stage(summary, downloads_folder, manifest)
+    log_summary(summary)
+    # Index the metadata for gokit_sync search
+    update_catalog(downloads_folder)
+    # Timing and throughput of this run, next to the log file
+    metrics.export(os.path.dirname(ds_file), summary)
+    return summary
+
+
+def sync_threads(ds_list, downloads_folder, manifest, store, workers=1, priorities=None, ds_metas=None):
+    """
+    Sync a list of datasets with worker threads, in the order given by
+    schedule().
+    :param ds_metas: metadata already fetched, by dataset name, see plan_sync()
+    :return: summary dict, mapping each sync outcome to a list of dataset names
+    """
+    # Fetch metadata for the rest of the list in a few requests
+    ds_metas = dict(ds_metas or {})
+    missing = [name for name in ds_list if name not in ds_metas]
+    if missing:
+        ds_metas.update(ckanapi.get_datasets_bulk(missing))
+    ds_list = schedule(ds_list, ds_metas, priorities)
+    summary = new_summary()
+
+    if workers > 1:
+        logger.info('Syncing with %s workers' % workers)
+        # Tag each log line with the dataset being synced
+        settings.set_log_format(settings.worker_fmt)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(sync_worker, dataset_name, downloads_folder, manifest,
+                                       ds_metas.get(dataset_name), store): dataset_name
+                           for dataset_name in ds_list}
+                for future in as_completed(futures):
+                    summary[future.result()].append(futures[future])
+        finally:
+            settings.set_log_format(settings.screen_fmt)
+    else:
+        for dataset_name in ds_list:
+            outcome = sync_worker(dataset_name, downloads_folder, manifest, ds_metas.get(dataset_name), store)
+            summary[outcome].append(dataset_name)
+    return summary
+
+
+def extract_stage(summary, downloads_folder, manifest):
+    """
+    Unpack the zip files of every synced dataset into a folder named after
+    the dataset, writing only the members that changed. Datasets whose
+    archives cannot be extracted are moved to the FAILED outcome.
+    :param summary: summary dict of the sync
+    :param downloads_folder: local folder for downloaded files
+    :param manifest: SyncManifest of the downloads folder
+    :return: None
+    """
+    from lib.extract import extract_archives, get_extract_folder
+    archives = []
+    for dataset_name in summary[SYNCED]:
+        for res in manifest.get_dataset(dataset_name)['resources'].values():
+            zip_path = os.path.join(downloads_folder, res['file'])
+            if zipfile.is_zipfile(zip_path):
+                archives.append((dataset_name, zip_path, get_extract_folder(downloads_folder, dataset_name)))
+    if not archives:
+        return
+    with metrics.phase('extract'):
+        extracted, failed = extract_archives(archives, extract_processes)
+    metrics.add_bytes('extract', extracted)
+    for dataset_name in failed:
+        summary[SYNCED].remove(dataset_name)
+        summary[FAILED].append(dataset_name)
+
+
+@metrics.timed('disk')
+def update_catalog(downloads_folder):
+    # Bring the local search catalog up to date with the metadata files, see lib.catalog
+    from lib import catalog
+    return catalog.update_catalog(downloads_folder, DS_FIELDS, RES_FIELDS)
 
-        logger.info('Checking %s resources' % len(resources))
-        for res in resources:
-            if res.get('url_type') == 'upload':
-                url = res.get('url')
-                if not url:
-                    logger.warning('You do not have access to the data for: %s' % dataset_name)
-                    logger.warning('Please contact the dataset owner.')
-                    continue
-                title = res.get('title')
-                download_file(url, downloads_folder, title)
+
+def format_bbox(bbox):
+    return ','.join('%g' % v for v in bbox)
+
+
+def search_main():
+    import argparse
+    parser = argparse.ArgumentParser(prog='gokit_sync search',
+                                     description='Search the metadata of the synced datasets, without a connection.')
+    parser.add_argument('datasets',
+                        help='Full path to the text file with the list of datasets that were synced.')
+    parser.add_argument('words', nargs='*',
+                        help='Words that must all appear in a dataset or layer. End a word with * to match '
+                             'words starting with it.')
+    parser.add_argument('--bbox', default=None, metavar='MINX,MINY,MAXX,MAXY',
+                        help='Only datasets and layers whose bounding box intersects this one, in degrees.')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='Max number of results (default: 20).')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    argv = sys.argv[2:]
+    # Western longitudes are negative, and argparse takes '-125,...' for an option
+    for i, arg in enumerate(argv[:-1]):
+        if arg == '--bbox':
+            argv[i:i + 2] = ['--bbox=' + argv[i + 1]]
+            break
+    args = parser.parse_args(argv)
+    from lib import catalog
+    bbox = None
+    if args.bbox:
+        bbox = catalog.parse_bbox(args.bbox)
+        if not bbox:
+            parser.error('--bbox must be four numbers: MINX,MINY,MAXX,MAXY')
+    if not args.words and not bbox:
+        parser.error('Give words to search for, or --bbox')
+    downloads_folder = os.path.join(os.path.dirname(os.path.abspath(args.datasets)), 'downloads')
+    if not os.path.isdir(downloads_folder):
+        parser.error('No downloads folder at %s, nothing was synced yet' % downloads_folder)
+    # Pick up metadata synced since the last update, usually nothing to do
+    if catalog.update_catalog(downloads_folder, DS_FIELDS, RES_FIELDS) is None:
+        sys.exit(1)
+    results = catalog.search(downloads_folder, ' '.join(args.words), bbox, max(args.limit, 1))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        if r['res_id']:
+            print('%s  layer: %s%s' % (r['dataset'], r['title'], ' (%s)' % r['format'] if r['format'] else ''))
+        else:
+            print('%s  %s' % (r['dataset'], r['title']))
+        if r['bbox']:
+            print('    bbox: %s' % format_bbox(r['bbox']))
+        if r['snippet']:
+            print('    %s' % ' '.join(r['snippet'].split()))
+    if not results:
+        print('No matches')
+
+
+def verify(ds_file, processes=None, crc=True):
+    """
+    Check that the files synced into the downloads folder next to a dataset
+    file are intact: present, with the size and sha256 recorded in the sync
+    manifest, and for zip archives with every member matching its CRC.
+    Nothing is downloaded.
+    :param ds_file: text file with the datasets that were synced
+    :param processes: number of worker processes, default one per core
+    :param crc: also test the members of zip archives
+    :return: list of (path, problem) tuples, empty if every file is intact
+    """
+    downloads_folder = os.path.join(os.path.dirname(ds_file), 'downloads')
+    if not os.path.isdir(downloads_folder):
+        logger.error('No downloads folder at %s, nothing was synced yet' % downloads_folder)
+        return [(downloads_folder, 'missing')]
+    from lib.manifest import SyncManifest
+    from lib import integrity
+    files = [{'path': os.path.join(downloads_folder, file_name), 'size': size, 'sha256': sha256}
+             for _, file_name, size, sha256 in SyncManifest(downloads_folder).synced_files() if file_name]
+    logger.info('Verifying %s files in %s' % (len(files), downloads_folder))
+    problems = integrity.verify_files(files, processes, crc)
+    for path, problem in problems:
+        logger.error('%s: %s' % (path, problem))
+    if problems:
+        logger.error('%s files are corrupt or missing, run a sync with --force to download them again' %
+                     len(set(path for path, _ in problems)))
+    else:
+        logger.info('All files are intact')
+    return problems
+
+
+def verify_main():
+    import argparse
+    parser = argparse.ArgumentParser(prog='gokit_sync verify',
+                                     description='Check that the synced files in the downloads folder are intact.')
+    parser.add_argument('datasets',
+                        help='Full path to the text file with the list of datasets that were synced.')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Processes used to check files (default: one per CPU core).')
+    parser.add_argument('--no-crc', action='store_true',
+                        help='Only check sizes and checksums, do not test the files inside zip archives.')
+    args = parser.parse_args(sys.argv[2:])
+    ds_file = os.path.abspath(args.datasets)
+    settings.add_disk_log(logger, os.path.join(os.path.dirname(ds_file), 'gokit_sync.log'))
+    if verify(ds_file, processes=args.processes, crc=not args.no_crc):
+        sys.exit(1)
+
+
+def run_mirror(ds_file, host='127.0.0.1', port=8080, access_keys=None, interval=MIRROR_INTERVAL,
+               **sync_options):
+    """
+    Serve a mirror of the datasets in a dataset file, see lib.mirror, and
+    keep it in sync with the GIS Hub until interrupted. Datasets are served
+    once their files are downloaded.
+    :param ds_file: text file with the datasets to mirror, see read_dataset_file
+    :param host: address to listen on
+    :param port: port to listen on
+    :param access_keys: keys that clients must use as their API key. Without
+    any, only public datasets and files are served.
+    :param interval: seconds between two checks of the GIS Hub for changes
+    :param sync_options: other keyword arguments for sync()
+    :return: summary of the last sync
+    """
+    from lib import mirror
+    global mirror_folder
+    downloads_folder = setup_downloads_folder(ds_file)
+    mirror_folder = mirror.get_mirror_folder(downloads_folder)
+    try:
+        server = mirror.serve(downloads_folder, host, port, access_keys)
+    except OSError as e:
+        logger.error('Cannot serve the mirror on port %s: %s' % (port, e))
+        sys.exit(1)
+    try:
+        return sync(ds_file, watch_interval=interval, **sync_options)
+    finally:
+        server.shutdown()
+
+
+def mirror_main():
+    import argparse
+    parser = argparse.ArgumentParser(prog='gokit_sync mirror',
+                                     description='Mirror GIS Hub datasets for gokit_sync clients on the local network.')
+    parser.add_argument('datasets',
+                        help='Full path to a text file with a list of datasets to mirror.')
+    parser.add_argument('apikey',
+                        help='Your API key from the GIS Hub.')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to serve the mirror on (default: 8080).')
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help='Address to serve the mirror on (default: 127.0.0.1, this machine only). '
+                             'Use 0.0.0.0 to serve the local network.')
+    parser.add_argument('--interval', type=float, default=MIRROR_INTERVAL,
+                        help='Seconds between checks of the GIS Hub for changed datasets (default: %s).' %
+                             MIRROR_INTERVAL)
+    parser.add_argument('--access-key', action='append', default=None,
+                        help='Only serve clients using this key as their API key. Can be given more than once. '
+                             'Without one, private datasets and restricted files are not served.')
+    parser.add_argument('--group', default=None,
+                        help='Also mirror every dataset in this GIS Hub group.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of datasets to sync in parallel (default: 4).')
+    parser.add_argument('--hub', default=None, metavar='URL',
+                        help='GIS Hub address to mirror (default: %s).' % settings.hostname)
+    args = parser.parse_args(sys.argv[2:])
+    if args.hub:
+        settings.set_hostname(args.hub)
+
+    workers = max(args.workers, 1)
+    ckanapi.configure_session(pool_size=max(workers, ckanapi.http_pool_size))
+    ckanapi.set_api_key(args.apikey)
+    ckanapi.configure_retries(burst=workers)
+    run_mirror(os.path.abspath(args.datasets), host=args.bind, port=args.port, access_keys=args.access_key,
+               interval=max(args.interval, 1), workers=workers, group=args.group)
 
 
 def main():
@@ -245,6 +1510,50 @@ def main():
                         help='Full path to a text file with a list of datasets to sync.')
     parser.add_argument('apikey',
                         help='Your API key from the GIS Hub.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of datasets to sync in parallel (default: 1, or 100 with --engine async).')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help='Sync with worker threads (default) or with asyncio.')
+    parser.add_argument('--api-limit', type=int, default=None,
+                        help='With --engine async: max requests in flight to the GIS Hub API.')
+    parser.add_argument('--download-limit', type=int, default=None,
+                        help='With --engine async: max downloads in flight per file host.')
+    parser.add_argument('--segments', type=int, default=1,
+                        help='Download large files as this many parallel byte ranges (default: 1).')
+    parser.add_argument('--force', action='store_true',
+                        help='Download all data again, even if it has not changed since the last sync.')
+    parser.add_argument('--cache-ttl', type=float, default=0,
+                        help='Seconds to reuse cached GIS Hub responses without asking the server (default: 0).')
+    parser.add_argument('--offline', action='store_true',
+                        help='Do not connect to the GIS Hub, only refresh metadata files from the local cache.')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Seconds to wait for the GIS Hub before giving up on a request.')
+    parser.add_argument('--delta', action='store_true',
+                        help='When a zip file changes, download only the files inside it that changed.')
+    parser.add_argument('--extract', action='store_true',
+                        help='Unpack downloaded zip files into a folder per dataset, updating only changed files.')
+    parser.add_argument('--extract-processes', type=int, default=None,
+                        help='Processes used to unpack zip files (default: one per CPU core).')
+    parser.add_argument('--group', default=None,
+                        help='Also sync every dataset in this GIS Hub group.')
+    parser.add_argument('--watch', type=float, default=None, metavar='SECS',
+                        help='Keep running, checking the GIS Hub for changed datasets every SECS seconds.')
+    parser.add_argument('--hub', default=None, metavar='URL',
+                        help='Sync from this GIS Hub address, e.g. a gokit_sync mirror on the local network '
+                             '(default: %s).' % settings.hostname)
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='Max total download speed in KB/s, shared by all downloads (default: no limit).')
+    parser.add_argument('--api-rate', type=float, default=0,
+                        help='Max GIS Hub API requests per second, shared by all workers (default: no limit).')
+    parser.add_argument('--retries', type=int, default=None,
+                        help='Times a failed GIS Hub API request is retried (default: 5).')
+    parser.add_argument('--datastore', choices=['csv', 'ndjson'], default=None,
+                        help='Also export DataStore tables that have no uploaded file, to CSV or NDJSON files.')
+    parser.add_argument('--plan', action='store_true',
+                        help='Only report what a sync would download and whether it fits on the disk.')
+    parser.add_argument('--if-no-space', choices=['stop', 'trim', 'ignore'], default='stop',
+                        help='When the downloads do not fit in the free disk space: download nothing (default), '
+                             'leave out the lowest priority datasets, or sync anyway.')
 
     # Ensure arguments contains a file (with list of datasets)
     if len(sys.argv) < 3:
@@ -252,11 +1561,54 @@ def main():
         parser.exit()
     args = parser.parse_args()
     ds_file = args.datasets
+    if args.offline and args.engine == 'async':
+        parser.error('--offline is not supported with --engine async')
 
-    # Set API key in ckanapi module
-    ckanapi.ghub_headers = {'Authorization': args.apikey}
-    sync(ds_file)
+    if args.hub:
+        settings.set_hostname(args.hub)
+
+    # Size the connection pool for the workers, then set API key in ckanapi module
+    global download_segments, extract_processes, delta_zips, datastore_format
+    if args.workers is None:
+        args.workers = 100 if args.engine == 'async' else 1
+    workers = max(args.workers, 1)
+    download_segments = max(args.segments, 1)
+    pool_size = max(workers * download_segments, ckanapi.http_pool_size)
+    ckanapi.configure_session(pool_size=pool_size, timeout=args.timeout)
+    ckanapi.set_api_key(args.apikey)
+    ckanapi.configure_cache(None, ttl=args.cache_ttl, offline_mode=args.offline)
+    download_bandwidth.configure(rate=args.bandwidth * 1024, burst=args.bandwidth * 1024)
+    ckanapi.configure_retries(retries=args.retries, rate=args.api_rate, burst=max(workers, 1))
+    engine_options = {}
+    if args.api_limit:
+        engine_options['api_limit'] = args.api_limit
+    if args.download_limit:
+        engine_options['download_limit'] = args.download_limit
+    extract_processes = args.extract_processes
+    delta_zips = args.delta
+    datastore_format = args.datastore
+    if args.plan:
+        if not plan(ds_file, force=args.force, group=args.group):
+            sys.exit(1)
+        return
+    summary = sync(ds_file, workers=workers, force=args.force, engine=args.engine,
+                   engine_options=engine_options, extract=args.extract, group=args.group,
+                   watch_interval=args.watch, if_no_space=args.if_no_space)
+    if summary[FAILED] or summary[NO_SPACE]:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    main()
+    # Extraction runs in worker processes, which need this in a PyInstaller build.
+    # multiprocessing is slow to import, so only load it in those processes.
+    if '--multiprocessing-fork' in sys.argv:
+        import multiprocessing
+        multiprocessing.freeze_support()
+    if sys.argv[1:2] == ['verify']:
+        verify_main()
+    elif sys.argv[1:2] == ['search']:
+        search_main()
+    elif sys.argv[1:2] == ['mirror']:
+        mirror_main()
+    else:
+        main()
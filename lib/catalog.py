@@ -0,0 +1,296 @@
+"""
+A local SQLite catalog of the synced metadata, for finding datasets and
+layers offline. The text of every dataset and resource goes into a full-text
+index (FTS5) and their bounding boxes into a spatial index (R*Tree). Where
+the SQLite build lacks one of those modules, plain tables and LIKE or range
+queries are used instead, which are slower but give the same results.
+
+The catalog is built from the <name>.metadata.json files in the downloads
+folder, and brought up to date after each sync by re-reading only the files
+that changed since the last update.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import time
+import traceback
+from json import JSONDecodeError
+
+import settings
+
+logger = settings.setup_logger('catalog')
+
+CATALOG_FILE = '.gokit_catalog.sqlite'
+METADATA_SUFFIX = '.metadata.json'
+
+# Dataset fields indexed as keywords, weighted above the rest of the text
+KEYWORD_FIELDS = ['keywords', 'science_keywords', 'theme', 'topic_category', 'species_codes']
+
+# Fields with nothing worth searching for
+SKIP_FIELDS = ['url', 'map_preview_link', 'disclaimer_url', 'position', 'restricted']
+
+# Weights of the title, keywords and body columns when ranking matches
+RANK_WEIGHTS = (10.0, 5.0, 1.0)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS datasets (name TEXT PRIMARY KEY, title TEXT, metadata_modified TEXT, '
+    'file_mtime INTEGER, file_size INTEGER)',
+    'CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, dataset TEXT NOT NULL, res_id TEXT, '
+    'title TEXT, format TEXT, minx REAL, miny REAL, maxx REAL, maxy REAL)',
+    'CREATE INDEX IF NOT EXISTS entries_dataset ON entries (dataset)',
+]
+FTS_SCHEMA = ("CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(title, keywords, body, "
+              "tokenize='unicode61 remove_diacritics 2')")
+PLAIN_DOCS_SCHEMA = 'CREATE TABLE IF NOT EXISTS docs (rowid INTEGER PRIMARY KEY, title TEXT, keywords TEXT, body TEXT)'
+RTREE_SCHEMA = 'CREATE VIRTUAL TABLE IF NOT EXISTS boxes USING rtree(id, minx, maxx, miny, maxy)'
+PLAIN_BOXES_SCHEMA = 'CREATE INDEX IF NOT EXISTS entries_bbox ON entries (minx, maxx)'
+
+
+def get_catalog_file(downloads_folder):
+    return os.path.join(downloads_folder, CATALOG_FILE)
+
+
+def has_module(conn, name):
+    # True if the SQLite library was built with a module, e.g. 'FTS5' or 'RTREE'
+    options = [row[0] for row in conn.execute('PRAGMA compile_options')]
+    return 'ENABLE_%s' % name in options
+
+
+def open_catalog(downloads_folder):
+    """
+    Open the catalog of a downloads folder, creating it if needed.
+    :return: tuple of the sqlite3 connection and a dict saying whether the
+    fts5 and rtree indexes are used
+    """
+    conn = sqlite3.connect(get_catalog_file(downloads_folder))
+    modules = {'fts5': has_module(conn, 'FTS5'), 'rtree': has_module(conn, 'RTREE')}
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.execute(FTS_SCHEMA if modules['fts5'] else PLAIN_DOCS_SCHEMA)
+    conn.execute(RTREE_SCHEMA if modules['rtree'] else PLAIN_BOXES_SCHEMA)
+    conn.commit()
+    return conn, modules
+
+
+def field_text(value):
+    # Searchable text of a field value, including the values inside composite (JSON) fields
+    if type(value) is str and value.lstrip()[:1] in ('[', '{'):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return value
+    if type(value) is dict:
+        return ' '.join(field_text(v) for v in value.values())
+    if type(value) is list:
+        return ' '.join(field_text(v) for v in value)
+    if value is None or type(value) is bool:
+        return ''
+    return str(value)
+
+
+def fields_text(data, fields):
+    return ' '.join(field_text(data.get(field)) for field in fields if field not in SKIP_FIELDS and data.get(field))
+
+
+def parse_bbox(value):
+    """
+    Read a bounding box field: 'minx,miny,maxx,maxy' (commas or spaces), a
+    JSON list of four numbers, or a GeoJSON geometry.
+    :param value: value of the field
+    :return: (minx, miny, maxx, maxy) tuple, or None if it cannot be read
+    """
+    if type(value) is str:
+        text = value.strip()
+        if text[:1] in ('[', '{'):
+            try:
+                value = json.loads(text)
+            except ValueError:
+                return None
+        else:
+            value = [part for part in re.split(r'[\s,]+', text) if part]
+    if type(value) is dict:
+        # All the positions of a GeoJSON geometry
+        coords = value.get('coordinates')
+        while type(coords) is list and coords and type(coords[0]) is list and type(coords[0][0]) is list:
+            coords = [point for part in coords for point in part]
+        if type(coords) is list and coords and type(coords[0]) is not list:
+            coords = [coords]
+        try:
+            xs = [float(point[0]) for point in coords]
+            ys = [float(point[1]) for point in coords]
+        except (TypeError, ValueError, IndexError):
+            return None
+        return (min(xs), min(ys), max(xs), max(ys)) if xs else None
+    if type(value) is list and len(value) == 4:
+        try:
+            x1, y1, x2, y2 = [float(v) for v in value]
+        except (TypeError, ValueError):
+            return None
+        return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+    return None
+
+
+def union_bbox(boxes):
+    boxes = [box for box in boxes if box]
+    if not boxes:
+        return None
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def add_entry(conn, modules, dataset, res_id, title, fmt, bbox, keywords, body):
+    # Insert a dataset or resource into the entries, text and bbox indexes
+    box = bbox or (None, None, None, None)
+    cursor = conn.execute('INSERT INTO entries (dataset, res_id, title, format, minx, miny, maxx, maxy) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (dataset, res_id, title, fmt) + tuple(box))
+    entry_id = cursor.lastrowid
+    conn.execute('INSERT INTO docs (rowid, title, keywords, body) VALUES (?, ?, ?, ?)',
+                 (entry_id, title or '', keywords, body))
+    if bbox and modules['rtree']:
+        conn.execute('INSERT INTO boxes (id, minx, maxx, miny, maxy) VALUES (?, ?, ?, ?, ?)',
+                     (entry_id, bbox[0], bbox[2], bbox[1], bbox[3]))
+
+
+def remove_dataset(conn, modules, name):
+    ids = [row[0] for row in conn.execute('SELECT id FROM entries WHERE dataset = ?', (name,))]
+    for entry_id in ids:
+        conn.execute('DELETE FROM docs WHERE rowid = ?', (entry_id,))
+        if modules['rtree']:
+            conn.execute('DELETE FROM boxes WHERE id = ?', (entry_id,))
+    conn.execute('DELETE FROM entries WHERE dataset = ?', (name,))
+    conn.execute('DELETE FROM datasets WHERE name = ?', (name,))
+
+
+def add_dataset(conn, modules, name, ds_meta, signature, ds_fields, res_fields):
+    """
+    Index a dataset and its resources.
+    :param name: dataset name
+    :param ds_meta: metadata of the dataset, as saved by gokit_sync
+    :param signature: (mtime_ns, size) of its metadata file
+    :param ds_fields: dataset fields to index
+    :param res_fields: resource fields to index
+    :return: None
+    """
+    resources = ds_meta.get('resources') or []
+    res_boxes = [parse_bbox(res.get('bbox')) for res in resources]
+    ds_bbox = union_bbox([parse_bbox(ds_meta.get('bbox')), parse_bbox(ds_meta.get('spatial'))] + res_boxes)
+    title = ds_meta.get('title') or name
+    keywords = fields_text(ds_meta, KEYWORD_FIELDS)
+    body_fields = [f for f in ds_fields if f not in KEYWORD_FIELDS and f != 'title']
+    add_entry(conn, modules, name, None, title, None, ds_bbox, keywords, fields_text(ds_meta, body_fields))
+    for res, bbox in zip(resources, res_boxes):
+        res_title = res.get('layer_name') or res.get('title') or res.get('name')
+        body = '%s %s' % (title, fields_text(res, [f for f in res_fields if f != 'layer_name']))
+        add_entry(conn, modules, name, res.get('id'), res_title, res.get('format') or res.get('data_format'),
+                  bbox, '', body)
+    conn.execute('INSERT INTO datasets (name, title, metadata_modified, file_mtime, file_size) '
+                 'VALUES (?, ?, ?, ?, ?)', (name, title, ds_meta.get('metadata_modified')) + tuple(signature))
+
+
+def update_catalog(downloads_folder, ds_fields, res_fields):
+    """
+    Bring the catalog up to date with the metadata files in the downloads
+    folder: index the ones that are new or changed since the last update,
+    and drop the datasets whose metadata file is gone.
+    :param downloads_folder: local folder for downloaded files
+    :param ds_fields: dataset fields to index, e.g. gokit_sync.DS_FIELDS
+    :param res_fields: resource fields to index, e.g. gokit_sync.RES_FIELDS
+    :return: tuple of the number of datasets indexed and removed, or None if
+    the catalog could not be updated
+    """
+    started = time.time()
+    try:
+        conn, modules = open_catalog(downloads_folder)
+    except sqlite3.Error:
+        logger.error('Cannot open the catalog in %s' % downloads_folder)
+        logger.error(traceback.format_exc())
+        return None
+    try:
+        known = dict((row[0], (row[1], row[2])) for row in
+                     conn.execute('SELECT name, file_mtime, file_size FROM datasets'))
+        found = {}
+        for entry in os.scandir(downloads_folder):
+            if entry.name.endswith(METADATA_SUFFIX) and entry.is_file():
+                st = entry.stat()
+                found[entry.name[:-len(METADATA_SUFFIX)]] = (st.st_mtime_ns, st.st_size)
+        changed = [name for name in sorted(found) if known.get(name) != found[name]]
+        removed = [name for name in known if name not in found]
+        if not changed and not removed:
+            return 0, 0
+        # One transaction, so a search never sees a half updated catalog
+        with conn:
+            for name in removed:
+                remove_dataset(conn, modules, name)
+            for name in changed:
+                try:
+                    with open(os.path.join(downloads_folder, name + METADATA_SUFFIX), encoding='utf8') as f:
+                        ds_meta = json.load(f)
+                except (OSError, JSONDecodeError):
+                    logger.warning('Cannot read the metadata of %s, it is not in the catalog' % name)
+                    continue
+                remove_dataset(conn, modules, name)
+                add_dataset(conn, modules, name, ds_meta, found[name], ds_fields, res_fields)
+        logger.info('Catalog updated: %s datasets indexed, %s removed, in %.2f secs' % (
+            len(changed), len(removed), time.time() - started))
+        return len(changed), len(removed)
+    except (OSError, sqlite3.Error):
+        logger.error('Cannot update the catalog in %s' % downloads_folder)
+        logger.error(traceback.format_exc())
+        return None
+    finally:
+        conn.close()
+
+
+def match_query(text):
+    # FTS5 query matching all the words in text. A trailing * matches word prefixes.
+    terms = re.findall(r'[\w.-]+\*?', text, re.UNICODE)
+    return ' '.join('"%s"%s' % (term.rstrip('*'), '*' if term.endswith('*') else '') for term in terms)
+
+
+def search(downloads_folder, text='', bbox=None, limit=20):
+    """
+    Search the catalog for datasets and layers.
+    :param downloads_folder: local folder for downloaded files
+    :param text: words that must all appear in the entry, e.g. 'herring spawn*'
+    :param bbox: (minx, miny, maxx, maxy) the entry must intersect, or None
+    :param limit: max number of results
+    :return: list of dicts with the dataset name, the resource id (None for a
+    dataset), title, format, bbox and a snippet of the matching text, best
+    matches first
+    """
+    conn, modules = open_catalog(downloads_folder)
+    try:
+        where = []
+        params = []
+        rank = 'e.id'
+        snippet = "''"
+        if match_query(text) and modules['fts5']:
+            where.append('docs MATCH ?')
+            params.append(match_query(text))
+            rank = 'bm25(docs, %s, %s, %s)' % RANK_WEIGHTS
+            snippet = "snippet(docs, -1, '[', ']', '...', 10)"
+        else:
+            for term in re.findall(r'[\w.-]+', text, re.UNICODE):
+                where.append("(docs.title || ' ' || docs.keywords || ' ' || docs.body) LIKE ?")
+                params.append('%%%s%%' % term)
+        if bbox and modules['rtree']:
+            where.append('e.id IN (SELECT id FROM boxes WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?)')
+            params += [bbox[2], bbox[0], bbox[3], bbox[1]]
+        elif bbox:
+            where.append('e.minx <= ? AND e.maxx >= ? AND e.miny <= ? AND e.maxy >= ?')
+            params += [bbox[2], bbox[0], bbox[3], bbox[1]]
+        sql = ('SELECT e.dataset, e.res_id, e.title, e.format, e.minx, e.miny, e.maxx, e.maxy, %s '
+               'FROM docs JOIN entries e ON e.id = docs.rowid' % snippet)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY %s LIMIT ?' % rank
+        params.append(limit)
+        results = []
+        for row in conn.execute(sql, params):
+            results.append({'dataset': row[0], 'res_id': row[1], 'title': row[2], 'format': row[3],
+                            'bbox': list(row[4:8]) if row[4] is not None else None, 'snippet': row[8]})
+        return results
+    finally:
+        conn.close()
@@ -4,14 +4,26 @@ CKAN site. This wrapper is only intended to be used with the GIS Hub CKAN site.
 """
 
 import os
+import hashlib
 from enum import Enum
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import Timeout, ConnectionError, ConnectTimeout, RequestException
 from json import JSONDecodeError
 import json
 import traceback
 import settings
+from concurrent.futures import ThreadPoolExecutor
+from lib import fingerprints
+from lib import jsonstream
+from lib import metrics
+from lib.ratelimit import TokenBucket
+import threading
 import time
+import random
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 
 
 logger = settings.setup_logger('ckanapi')
@@ -21,9 +33,291 @@ data_folder = os.path.join(project_root, 'data')
 
 default_error = {'error': 'Server error'}
 
-# Empty for now, API key must be supplied by user at runtime
+# Number of dataset names looked up per package_search request
+BULK_CHUNK_SIZE = 50
+
+# Datasets per page when paging through package_search, see iter_package_search()
+PAGE_ROWS = 100
+
+# Empty for now, API key must be supplied by user at runtime, see set_api_key()
 ghub_headers = {}
 
+# HTTP session settings, see configure_session()
+http_pool_size = 10
+http_timeout = (10, 120)  # (connect, read) in seconds
+http_keep_alive = True
+
+_session = None
+_session_lock = threading.Lock()
+
+# On-disk cache of GET responses, see configure_cache(). Disabled until a folder is set.
+cache_folder = None
+cache_ttl = 0  # seconds a cached response is used without asking the server again
+cache_max_bytes = 256 * 1024 * 1024
+offline = False  # serve GET requests only from the cache
+
+_cache_lock = threading.Lock()
+_cache_bytes = 0
+
+# Retry policy for API calls, see configure_retries()
+RETRY_STATUSES = [429, 502, 503, 504]
+max_retries = 5
+backoff_base = 1.0  # seconds before the first retry, doubled on each attempt
+backoff_max = 300.0  # longest wait between two attempts, also caps Retry-After
+
+# Shared by all workers, no limit until configure_retries() sets a rate
+rate_limiter = TokenBucket()
+
+
+def configure_session(pool_size=None, timeout=None, keep_alive=None):
+    """
+    Change the settings of the shared HTTP session. The session is rebuilt on
+    next use, so this should be called before any requests are made.
+    :param pool_size: max number of pooled connections kept open per host
+    :param timeout: seconds to wait for the server, or a (connect, read) tuple
+    :param keep_alive: reuse connections between requests
+    :return: None
+    """
+    global _session, http_pool_size, http_timeout, http_keep_alive
+    if pool_size is not None:
+        http_pool_size = pool_size
+    if timeout is not None:
+        http_timeout = timeout
+    if keep_alive is not None:
+        http_keep_alive = keep_alive
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    """
+    Get the requests Session shared by all HTTP calls in gokit, creating it
+    on first use. Connections are pooled and kept alive, so repeated calls to
+    the GIS Hub and S3 do not pay a new TCP+TLS handshake each time.
+    :return: requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+            if not http_keep_alive:
+                session.headers.update({'Connection': 'close'})
+            session.headers.update(ghub_headers)
+            _session = session
+        return _session
+
+
+def set_api_key(apikey):
+    # Attach the user's API key to every request made through the session
+    global ghub_headers
+    ghub_headers = {'Authorization': apikey}
+    get_session().headers.update(ghub_headers)
+
+
+def http_request(method, url, **kwargs):
+    """
+    Send an HTTP request through the shared session, with the default timeout.
+    :param method: HTTP method
+    :param url: full URL of the request
+    :param kwargs: passed on to requests.Session.request
+    :return: requests.Response
+    """
+    kwargs.setdefault('timeout', http_timeout)
+    return get_session().request(method, url, **kwargs)
+
+
+def configure_retries(retries=None, rate=None, burst=None):
+    """
+    Change the retry policy of API calls.
+    :param retries: max number of retries of a failed call
+    :param rate: max API requests per second across all workers, 0 for no limit
+    :param burst: max requests sent at once after an idle period
+    :return: None
+    """
+    global max_retries
+    if retries is not None:
+        max_retries = retries
+    rate_limiter.configure(rate=rate, burst=burst)
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """
+    Exponential backoff with jitter, so that workers failing together do not
+    all retry at the same moment.
+    :param attempt: 0 for the first retry
+    :param base: seconds before the first retry
+    :param cap: longest delay
+    :return: seconds to wait
+    """
+    base = backoff_base if base is None else base
+    cap = backoff_max if cap is None else cap
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def get_retry_after(headers):
+    # Seconds to wait from a Retry-After header, either a number of seconds or an HTTP date
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), backoff_max)
+
+
+def make_error(reason=None):
+    # A new error dict for each failed call, callers may add to it
+    error = dict(default_error)
+    if reason:
+        error['reason'] = reason
+    return error
+
+
+def send_request(method, url, retry=True, **kwargs):
+    """
+    Send an API request through the shared rate limiter. Connection errors,
+    timeouts and the statuses in RETRY_STATUSES are retried with backoff,
+    honouring Retry-After. 429 and 503 pause every worker, not just this one.
+    :param method: HTTP method
+    :param url: full URL of the request
+    :param retry: False to send the request only once
+    :param kwargs: passed on to http_request
+    :return: requests.Response, the last one if all retries failed
+    """
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        try:
+            r = http_request(method, url, **kwargs)
+        except (Timeout, ConnectionError) as e:
+            if not retry or attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning('%s from CKAN API, retrying in %.1f secs' % (e.__class__.__name__, delay))
+        else:
+            if r.status_code not in RETRY_STATUSES:
+                rate_limiter.succeeded()
+                return r
+            if not retry or attempt >= max_retries:
+                return r
+            retry_after = get_retry_after(r.headers)
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            if r.status_code in [429, 503]:
+                rate_limiter.throttle(delay)
+            logger.warning('Error %s from CKAN API, retrying in %.1f secs' % (r.status_code, delay))
+        metrics.add_retry('api')
+        time.sleep(delay)
+        attempt += 1
+
+
+def configure_cache(folder, ttl=None, max_bytes=None, offline_mode=None):
+    """
+    Cache the responses of GET requests to the CKAN API on disk. A cached
+    response younger than ttl is used as is. Older ones are revalidated with
+    If-None-Match/If-Modified-Since where the server supports it, so an
+    unchanged response costs a 304 instead of the full payload. The least
+    recently used responses are evicted once the cache exceeds max_bytes.
+    :param folder: cache folder, None to disable the cache
+    :param ttl: seconds a cached response is used without asking the server
+    :param max_bytes: max total size of the cache
+    :param offline_mode: never contact the server, serve GET requests only from the cache
+    :return: None
+    """
+    global cache_folder, cache_ttl, cache_max_bytes, offline, _cache_bytes
+    if ttl is not None:
+        cache_ttl = ttl
+    if max_bytes is not None:
+        cache_max_bytes = max_bytes
+    if offline_mode is not None:
+        offline = offline_mode
+    cache_folder = folder
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+        with _cache_lock:
+            _cache_bytes = sum(e.stat().st_size for e in os.scandir(folder) if e.name.endswith('.json'))
+        logger.info('Caching API responses in %s' % folder)
+
+
+def get_cache_file(url):
+    # Responses depend on the user's access rights, so the API key is part of the key
+    key = '%s\n%s' % (ghub_headers.get('Authorization', ''), url)
+    return os.path.join(cache_folder, hashlib.sha256(key.encode('utf8')).hexdigest() + '.json')
+
+
+def cache_get(url):
+    """
+    Get a cached response. Reading an entry marks it as recently used.
+    :param url: full URL of the GET request
+    :return: dict with the response body, validators and time stored, or None
+    """
+    if not cache_folder:
+        return None
+    cache_file = get_cache_file(url)
+    try:
+        with open(cache_file, encoding='utf8') as f:
+            entry = json.load(f)
+        os.utime(cache_file)
+        return entry
+    except (OSError, JSONDecodeError):
+        return None
+
+
+def cache_put(url, headers, body, entry=None):
+    """
+    Store a response in the cache, evicting old entries if the cache is full.
+    :param url: full URL of the GET request
+    :param headers: response headers, for the validators
+    :param body: decoded JSON response
+    :param entry: existing entry to refresh after a 304, instead of a new body
+    :return: None
+    """
+    global _cache_bytes
+    if not cache_folder:
+        return
+    if entry is None:
+        entry = {'url': url, 'body': body, 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified')}
+    entry['stored'] = time.time()
+    cache_file = get_cache_file(url)
+    tmp_file = '%s.%s.tmp' % (cache_file, threading.get_ident())
+    with open(tmp_file, 'w', encoding='utf8') as f:
+        json.dump(entry, f)
+    with _cache_lock:
+        if os.path.exists(cache_file):
+            _cache_bytes -= os.path.getsize(cache_file)
+        os.replace(tmp_file, cache_file)
+        _cache_bytes += os.path.getsize(cache_file)
+        if _cache_bytes > cache_max_bytes:
+            evict_cache()
+
+
+def evict_cache():
+    # Remove least recently used entries until the cache is 90% of its max size. Call with _cache_lock held.
+    global _cache_bytes
+    entries = sorted((e for e in os.scandir(cache_folder) if e.name.endswith('.json')),
+                     key=lambda e: e.stat().st_mtime)
+    for entry in entries:
+        if _cache_bytes <= cache_max_bytes * 0.9:
+            break
+        size = entry.stat().st_size
+        try:
+            os.remove(entry.path)
+            _cache_bytes -= size
+        except OSError:
+            pass
+    logger.debug('API cache trimmed to %s bytes' % _cache_bytes)
+
 
 class ApiAction(Enum):
     res_show = '/resource_show'
@@ -51,60 +345,85 @@ class ApiAction(Enum):
     tag_add_to_vocab = '/tag_create'
 
 
+# Actions that only read, so a POST can be retried safely
+READ_ACTIONS = [ApiAction.res_show, ApiAction.package_show, ApiAction.package_list,
+                ApiAction.all_datasets, ApiAction.package_search, ApiAction.user_show,
+                ApiAction.datastore_search_sql, ApiAction.tag_list, ApiAction.user_list]
+
+
+def compare_fields(d1, d2, ignore_fields=()):
+    # Returns the set of keys in d1 whose values differ in d2
+    diffs = set()
+    for key, val1 in d1.items():
+        if key in ignore_fields:
+            continue
+        if val1 != d2.get(key):
+            diffs.add(key)
+    return diffs
+
+
 def compare_datasets(ds1, ds2):
     # Returns None if no difference, else set of key names with diffs
     # Detecting diffs: ignore fields like metadata_modified, revision_id, etc
-    ignore_fields = ['resources', 'uuid', 'hash', 'revision_id', 'metadata_modified', 'species_codes', 'readme_updated']
     # Compare dataset level
     if len(ds1) != len(ds2):
         diff = ds1.keys().difference(ds2.keys())
         logger.info('Datasets have different keys: %s' % diff)
         return diff
-    diffs = set()
-    for key, val1 in ds1.items():
-        if key in ignore_fields:
-            continue
-        if val1 != ds2.get(key):
-            diffs.add(key)
+    diffs = compare_fields(ds1, ds2, fingerprints.IGNORE_FIELDS)
     # Check resources
-    res1 = ds1.get('resources')
-    res2 = ds2.get('resources')
+    res1 = ds1.get('resources') or []
+    res2 = ds2.get('resources') or []
     if len(res1) != len(res2):
         logger.info('Datasets have different resource count')
         diffs.add('resource-count')
         return diffs
+    # Match resources by id, so that a reorder is not a change
+    res2_by_id = dict((res.get('id'), res) for res in res2)
     for i in range(len(res1)):
-        for key, value in res1[i].items():
-            if key in ignore_fields:
-                continue
-            if value != res2[i].get(key):
-                diffs.add(key)
+        res_id = res1[i].get('id')
+        other = res2_by_id.get(res_id) if res_id else res2[i]
+        if other is None:
+            diffs.add('resource:%s' % res_id)
+            continue
+        diffs.update(compare_fields(res1[i], other, fingerprints.RES_IGNORE_FIELDS))
     if diffs:
         return diffs
     return None
 
 
 def dataset_has_changed(current_ds, ds_name):
-    # Compare the current dataset (dict) with the last version stored on disk
+    """
+    Compare the current dataset (dict) with the last version stored on disk.
+    The archived version is looked up in the fingerprint index, and its JSON
+    file is only read when the index has no entry for that version of it.
+    :param current_ds: dataset dict from CKAN
+    :param ds_name: dataset name
+    :return: True if the dataset differs from the archived version
+    """
     last_file = os.path.join(settings.meta_archives, '%s.json' % ds_name)
     if not os.path.exists(last_file):
         logger.info('No previous metadata saved')
         return True
-    # Read the json file as a dict
-    try:
-        with open(last_file) as f:
-            last_ds = json.load(f)
-            # Compare datasets
-            diff = compare_datasets(current_ds, last_ds)
-            if diff:
-                logger.warning('Datasets differ in: %s' % diff)
-                return True
-            else:
-                return False
-    except JSONDecodeError:
-        logger.error('Cannot load data from file %s' % last_file)
-        logger.error(traceback.format_exc())
+    index = fingerprints.get_index()
+    mtime = os.path.getmtime(last_file)
+    last_fp = index.get(ds_name, mtime)
+    if last_fp is None:
+        # Read the json file as a dict, once per version of the file
+        try:
+            with open(last_file) as f:
+                last_ds = json.load(f)
+        except JSONDecodeError:
+            logger.error('Cannot load data from file %s' % last_file)
+            logger.error(traceback.format_exc())
+            return True
+        last_fp = index.put(ds_name, last_ds, mtime)
+    # Compare datasets
+    diff = fingerprints.compare_fingerprints(fingerprints.dataset_fingerprints(current_ds), last_fp)
+    if diff:
+        logger.warning('Datasets differ in: %s' % diff)
         return True
+    return False
 
 
 def is_updating(ds_name):
@@ -137,13 +456,12 @@ def save_metadata_to_file(dataset):
 
 
 def ensure_alive():
-    intervals = [0, 10, 60, 300, 600]  # seconds   #, 300, 600
-
-    for interval in intervals:
-
-        if interval > 0:
-            logger.warning('CKAN API down. Waiting %s secs...' % interval)
-        time.sleep(interval)
+    # Up to 5 tries over roughly 15 minutes, with the same backoff as API calls
+    for attempt in range(5):
+        if attempt > 0:
+            interval = backoff_delay(attempt - 1, base=20, cap=600)
+            logger.warning('CKAN API down. Waiting %.0f secs...' % interval)
+            time.sleep(interval)
         is_alive = test_connect()
         if is_alive:
             return is_alive
@@ -157,7 +475,7 @@ def test_connect():
     test_url = settings.ghub_api_url_base + '/package_show?id=bops'
     # Check if we can connect to a test URL and get data
     try:
-        r = requests.get(test_url, headers=ghub_headers)
+        r = send_request('get', test_url, retry=False)
         if r.status_code != 200:
             logger.error('Test URL failed, check the GISHUB_API environment var')
             return False
@@ -177,6 +495,7 @@ def test_connect():
         return False
 
 
+@metrics.timed('api')
 def api_request(api_action, data, method='post', id=None, url_params=None):
     """
     Perform an API request on a specified CKAN API endpoint.
@@ -196,26 +515,47 @@ def api_request(api_action, data, method='post', id=None, url_params=None):
     logger.debug('Waiting for CKAN API...')
     if method.lower() == 'post':
         try:
-            r = requests.post(url, headers=ghub_headers, json=data)
-        except RequestException:
+            r = send_request('post', url, retry=api_action in READ_ACTIONS, json=data)
+        except RequestException as e:
             logger.error('Exception in POST request to CKAN API.')
             logger.error(traceback.format_exc())
-            return default_error
+            return make_error(e.__class__.__name__)
     elif method.lower() == 'get':
+        entry = cache_get(url)
+        if entry and (offline or time.time() - entry['stored'] < cache_ttl):
+            logger.debug('Using cached response for %s' % url)
+            return entry['body']
+        if offline:
+            logger.warning('Offline, and no cached response for %s' % url)
+            return {'error': 'Not available offline'}
+        # Revalidate the cached response, if any
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
         try:
-            r = requests.get(url, headers=ghub_headers)
-        except RequestException:
+            r = send_request('get', url, headers=headers)
+        except RequestException as e:
             logger.error('Exception in GET request to CKAN API.')
             logger.error(traceback.format_exc())
-            return default_error
+            return make_error(e.__class__.__name__)
+        if r.status_code == 304 and entry:
+            logger.debug('Cached response still valid for %s' % url)
+            cache_put(url, r.headers, None, entry=entry)
+            return entry['body']
     else:
         logger.error('Unknown method: %s' % method)
-        return default_error
+        return make_error('Unknown method: %s' % method)
 
+    metrics.add_bytes('api', len(r.content))
     status = r.status_code
     if status in [200, 201, 202, 204, 205]:
         logger.debug('Success!')
-        return r.json()
+        json_resp = r.json()
+        if method.lower() == 'get' and status == 200:
+            cache_put(url, r.headers, json_resp)
+        return json_resp
     else:
         logger.warning('Error %s' % status)
         # Better logging for status codes
@@ -235,9 +575,8 @@ def api_request(api_action, data, method='post', id=None, url_params=None):
             logger.warning(r.json())
         except JSONDecodeError:
             if r.reason:
-                default_error['reason'] = r.reason
                 logger.error('Reason: %s' % r.reason)
-            json_resp = default_error
+            json_resp = make_error(r.reason)
         return json_resp
 
 
@@ -277,10 +616,255 @@ def convert_to_str(input_seq, separator):
 
 # Get a dataset
 def get_dataset(id):
-    resp = api_request(ApiAction.package_show, {'id': id})
+    resp = api_request(ApiAction.package_show, data=None, method='get', id=id)
     return get_result(resp)
 
 
+def find_dataset(id):
+    """
+    Get the metadata of a dataset, telling a dataset that does not exist
+    apart from a lookup that failed, e.g. after a timeout.
+    :param id: dataset name or id
+    :return: dataset dict, {} if CKAN has no such dataset, None if the lookup failed
+    """
+    resp = api_request(ApiAction.package_show, data=None, method='get', id=id)
+    if type(resp.get('result')) is dict:
+        return resp['result']
+    error = resp.get('error')
+    if type(error) is dict and error.get('__type') == 'Not Found Error':
+        return {}
+    return None
+
+
+def get_datasets_bulk(names, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Get metadata for many datasets at once, using package_search with a
+    filter on dataset names instead of one package_show call per dataset.
+    Search results hold the same dataset dicts (with resources) as package_show.
+    :param names: list of dataset names
+    :param chunk_size: number of names per search request
+    :return: dict mapping each dataset name found to its metadata. Names that
+    could not be resolved (e.g. dataset ids, or datasets not in the search
+    index) are left out, and should be fetched with get_dataset.
+    """
+    datasets = {}
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        fq = 'name:(%s)' % ' OR '.join('"%s"' % name for name in chunk)
+        start = 0
+        while True:
+            url_params = '?' + urlencode({'fq': fq, 'include_private': 'True', 'rows': chunk_size,
+                                          'start': start})
+            resp = api_request(ApiAction.package_search, data=None, method='get', url_params=url_params)
+            result = resp.get('result')
+            if type(result) is not dict:
+                logger.warning('Bulk metadata request failed: %s' % resp)
+                break
+            results = result.get('results') or []
+            for ds in results:
+                datasets[ds.get('name')] = ds
+            start += len(results)
+            if not results or start >= result.get('count', 0):
+                break
+    logger.info('Found metadata for %s of %s datasets in bulk' % (len(datasets), len(names)))
+    return datasets
+
+
+def get_datasets_modified_since(since, names=None, group=None):
+    """
+    Find the datasets modified on the GIS Hub at or after a point in time,
+    with one package_search request (more only if over a page changed).
+    :param since: metadata_modified timestamp in UTC, as CKAN writes it
+    :param names: only return these datasets
+    :param group: only return datasets in this group. With names as well, a
+    dataset is returned if it is in either.
+    :return: dict mapping dataset name to its metadata, None if the search failed
+    """
+    fq = 'metadata_modified:[%sZ TO *]' % since.rstrip('Z')
+    # Filter on the server where one filter does it, otherwise on the results below
+    if group and not names:
+        fq += ' AND groups:%s' % group
+    elif names and not group and len(names) <= BULK_CHUNK_SIZE:
+        fq += ' AND name:(%s)' % ' OR '.join('"%s"' % name for name in names)
+    wanted = set(names or [])
+    datasets = {}
+    try:
+        for ds in iter_package_search(fq, sort='metadata_modified asc'):
+            in_group = group and group in [g.get('name') for g in ds.get('groups') or []]
+            if (not names and not group) or ds.get('name') in wanted or in_group:
+                datasets[ds.get('name')] = ds
+    except SearchError as e:
+        logger.warning('Search for modified datasets failed: %s' % e)
+        return None
+    return datasets
+
+
+class SearchError(IOError):
+    # Raised when a page of package_search results cannot be read
+    pass
+
+
+class SearchUnavailable(SearchError):
+    # Raised when reading a page again would not help: it is not cached when
+    # offline, CKAN refused the search, or it still failed after send_request's retries
+    pass
+
+
+def read_search_page(params, info):
+    """
+    Request one page of package_search results and decode the datasets one
+    at a time as they arrive. Pages are cached like other GET requests.
+    :param params: search parameters, with start and rows
+    :param info: dict, info['count'] is set to the total number of results
+    once the page has been read
+    :return: generator of dataset dicts. SearchError is raised if the response
+    ends early, SearchUnavailable if the search fails.
+    """
+    url = settings.ghub_api_url_base + ApiAction.package_search.value + '?' + urlencode(params)
+    entry = cache_get(url)
+    if offline or (entry and time.time() - entry['stored'] < cache_ttl):
+        result = entry['body'].get('result') if entry else None
+        if type(result) is not dict:
+            raise SearchUnavailable('No cached search results for %s' % url)
+        yield from result.get('results') or []
+        info['count'] = result.get('count', 0)
+        return
+
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        r = send_request('get', url, headers=headers, stream=True)
+    except RequestException as e:
+        raise SearchUnavailable('Search failed: %s' % e.__class__.__name__)
+    with r:
+        if r.status_code == 304 and entry:
+            cache_put(url, r.headers, None, entry=entry)
+            result = entry['body']['result']
+            yield from result.get('results') or []
+            info['count'] = result.get('count', 0)
+            return
+        if r.status_code != 200:
+            raise SearchUnavailable('Search failed with error %s' % r.status_code)
+        # Keep the page for the cache, it is at most rows datasets
+        page = [] if cache_folder else None
+        found = {}
+        try:
+            for ds in jsonstream.iter_array(count_bytes(r.iter_content(chunk_size=64 * 1024)),
+                                            ['result', 'results'], found):
+                if page is not None:
+                    page.append(ds)
+                yield ds
+        except (JSONDecodeError, RequestException) as e:
+            raise SearchError('Search results ended early: %s' % e)
+    result = found.get('result')
+    if not found.get('success') or type(result) is not dict:
+        raise SearchUnavailable('Search failed: %s' % found.get('error'))
+    if page is not None:
+        result['results'] = page
+        cache_put(url, r.headers, found)
+    info['count'] = result.get('count', 0)
+
+
+def count_bytes(chunks):
+    # Count the bytes of a streamed API response in the metrics
+    for chunk in chunks:
+        metrics.add_bytes('api', len(chunk))
+        yield chunk
+
+
+def solr_date(value):
+    # A CKAN timestamp as a Solr date, which is kept to the millisecond
+    value = value.rstrip('Z')
+    if '.' in value:
+        value = value[:value.index('.') + 4]
+    return value + 'Z'
+
+
+def keyset_filter(field, ds):
+    # Filter for the search results that sort after a dataset, by field then id
+    value = solr_date(ds[field])
+    return '(%s:{%s TO *] OR (%s:[%s TO %s] AND id:{%s TO *]))' % (field, value, field, value, value, ds['id'])
+
+
+def iter_package_search(fq=None, rows=PAGE_ROWS, prefetch=0, sort='metadata_created asc'):
+    """
+    Iterate over all the results of a package_search, a page of rows
+    datasets at a time, so that any number of datasets can be listed in flat
+    memory. Datasets are decoded one at a time as they arrive. Each page asks
+    for the datasets that sort after the last one of the page before, rather
+    than for an offset, so a dataset deleted during the listing does not
+    shift the pages and make the listing skip one.
+    :param fq: filter query, e.g. 'groups:spills'
+    :param rows: datasets per page, at most 1000 on CKAN
+    :param prefetch: if set, each page is read in a background thread as soon
+    as the one before is, while that one is consumed
+    :param sort: date field to sort on in ascending order, with ties broken
+    by id. Datasets created during the listing come last. A dataset whose
+    date changes during the listing (e.g. modified, when sorting on
+    metadata_modified) is listed again, with its new metadata.
+    :return: generator of dataset dicts. A page that ends early is read
+    again. SearchError is raised if a page cannot be read, so that a listing
+    is never silently incomplete.
+    """
+    field = sort.split()[0]
+    params = {'include_private': 'True', 'rows': rows, 'sort': '%s asc, id asc' % field}
+
+    def page_params(after):
+        # Parameters of the first page, or of the page after a dataset
+        filters = [f for f in [fq and '(%s)' % fq, after and keyset_filter(field, after)] if f]
+        return dict(params, fq=' AND '.join(filters)) if filters else params
+
+    def fetch_page(after):
+        # Read a whole page, in a prefetch thread
+        return list(read_search_page(page_params(after), {}))
+
+    pool = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    future = None
+    # Ids of this page: a page read again after an error does not repeat datasets
+    seen = set()
+    after = None
+    try:
+        while True:
+            for attempt in range(max_retries + 1):
+                received, last = 0, None
+                try:
+                    if pool:
+                        pending, future = future or pool.submit(fetch_page, after), None
+                        page = pending.result()
+                        if len(page) == rows:
+                            future = pool.submit(fetch_page, page[-1])
+                    else:
+                        page = read_search_page(page_params(after), {})
+                    for ds in page:
+                        received += 1
+                        last = ds
+                        if ds.get('id') in seen:
+                            continue
+                        seen.add(ds.get('id'))
+                        yield ds
+                    break
+                except SearchUnavailable:
+                    raise
+                except SearchError as e:
+                    # Only a page that ended early, errors and statuses are retried by send_request
+                    if attempt == max_retries:
+                        raise
+                    delay = backoff_delay(attempt)
+                    logger.warning('%s, reading the page again in %.1f secs' % (e, delay))
+                    metrics.add_retry('api')
+                    time.sleep(delay)
+            if received < rows:
+                break
+            after = last
+            seen = set()
+    finally:
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
 # Get a resource
 def get_resource(res_id):
     resp = api_request(ApiAction.res_show, {'id': res_id})
@@ -322,29 +906,45 @@ def get_resource_id_and_file(data_url):
 def list_datasets():
     # Update to get all dataset+resource metadata, include private datasets
     logger.info('Listing all datasets, patience please...')
-    resp = api_request(ApiAction.all_datasets, data=None, method='get')
-    results = get_result(resp)
-    if type(results) is not list:
-        logger.error('List of datasets (results) is %s, expected a list' % type(results))
-    return results
+    try:
+        return list(iter_package_search(prefetch=1))
+    except SearchError as e:
+        logger.error('Could not list datasets: %s' % e)
+        return []
+
+
+def iter_datasets_in_group(group_name, prefetch=1):
+    """
+    All datasets in a group, with their resources, including private ones.
+    :param group_name: name of the group
+    :param prefetch: read the next page in the background, see iter_package_search()
+    :return: generator of dataset dicts, SearchError is raised if the listing fails
+    """
+    return iter_package_search('groups:%s' % group_name, prefetch=prefetch)
 
 
 def list_datasets_in_group(group_name):
     # Update to get all dataset+resource metadata, include private datasets that belong to a group
     logger.info('Listing all datasets in group, patience please...')
-    url_parameters = '?fq=groups:' + group_name + '&include_private=True' + '&rows=1000'
-    resp = api_request(ApiAction.package_search, url_params=url_parameters, data=None,
-                       method='get')
-    results = get_result(resp)
-    if type(results) is not list:
-        logger.error('List of datasets (results) is %s, expected a list' % type(results))
+    try:
+        results = list(iter_datasets_in_group(group_name))
+    except SearchError as e:
+        logger.error('Could not list datasets of group %s: %s' % (group_name, e))
+        return []
     if len(results) == 0:
         logger.warning('No datasets for group "%s". are you sure this group exists?' % group_name)
     return results
 
 
-def read_composite_field(field, field_name):
-    """ Try to load field as a JSON string """
+def read_composite_field(field, field_name, strict=True):
+    """
+    Try to load field as a JSON string
+    :param field: value of the field
+    :param field_name: name of the field, for logging
+    :param strict: if False, a field that is not JSON is plain text: it is
+    returned as is, and not logged as an error
+    :return: the parsed field, {} if blank
+    """
     field_data = {}
     # If field is blank, return right away
     if not field:
@@ -354,6 +954,8 @@ def read_composite_field(field, field_name):
         field_data = json.loads(field)
         return field_data
     except JSONDecodeError:
+        if not strict:
+            return field
         logger.error('Cannot load data from field %s: %s' % (field_name, field))
         logger.error(traceback.format_exc())
         return field_data
@@ -0,0 +1,254 @@
+"""
+Export of DataStore tables (resources with datastore_active) to local CSV or
+NDJSON files. Tables are read with datastore_search_sql a page at a time,
+keyed on the _id column instead of OFFSET, so every page is a cheap index
+range scan however deep into the table it is. The _id range is split into
+slices that are exported in parallel. Records are decoded and written one
+at a time as they arrive, so memory use does not grow with the table.
+
+_id only ever grows as rows are added, so a table that only had rows
+appended since the last export is brought up to date by fetching the new
+rows. Rows changed in place are not detected, a forced sync exports the
+whole table again.
+"""
+
+import contextvars
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecodeError
+
+from requests.exceptions import RequestException
+
+import settings
+from lib import ckanapi, jsonstream, metrics
+
+logger = settings.setup_logger('datastore')
+
+# Rows per datastore_search_sql request, under the CKAN default limit of 32000
+PAGE_ROWS = 10000
+
+# Slices of a table exported in parallel
+SLICES = 4
+
+# Columns the DataStore adds to every table, not exported
+INTERNAL_COLUMNS = ['_id', '_full_text']
+
+
+class DataStoreError(IOError):
+    # Raised when a DataStore query fails or its response ends early
+    pass
+
+
+def quote_ident(name):
+    # Quote a table or column name for SQL
+    return '"%s"' % name.replace('"', '""')
+
+
+def read_records(sql, found=None):
+    """
+    Run a datastore_search_sql query and decode the records one at a time as
+    they arrive.
+    :param sql: SELECT statement
+    :param found: optional dict, filled with the rest of the response, e.g.
+    found['result']['fields'] once every record has been read
+    :return: generator of record dicts. DataStoreError is raised if the query
+    fails or the response ends early.
+    """
+    url = settings.ghub_api_url_base + ckanapi.ApiAction.datastore_search_sql.value
+    found = {} if found is None else found
+    try:
+        r = ckanapi.send_request('post', url, json={'sql': sql}, stream=True)
+    except RequestException as e:
+        raise DataStoreError('DataStore query failed: %s' % e.__class__.__name__)
+    with r:
+        if r.status_code != 200:
+            raise DataStoreError('DataStore query failed with error %s: %s' % (r.status_code, r.text[:500]))
+        try:
+            yield from jsonstream.iter_array(ckanapi.count_bytes(r.iter_content(chunk_size=64 * 1024)),
+                                             ['result', 'records'], found)
+        except (JSONDecodeError, RequestException) as e:
+            raise DataStoreError('DataStore query results ended early: %s' % e)
+    if not found.get('success'):
+        raise DataStoreError('DataStore query failed: %s' % found.get('error'))
+
+
+def table_columns(res_id):
+    # Names of the columns of a table, in table order, without the internal ones
+    found = {}
+    for _ in read_records('SELECT * FROM %s LIMIT 0' % quote_ident(res_id), found):
+        pass
+    fields = (found.get('result') or {}).get('fields') or []
+    return [field['id'] for field in fields if field.get('id') not in INTERNAL_COLUMNS]
+
+
+def table_stats(res_id, upto=None):
+    """
+    Count the rows of a table, and find its range of _id.
+    :param res_id: resource id, which is the table name
+    :param upto: only count the rows with _id up to this
+    :return: dict with the low and high _id (None for an empty table) and
+    the total number of rows
+    """
+    sql = 'SELECT min(_id) AS low, max(_id) AS high, count(*) AS total FROM %s' % quote_ident(res_id)
+    if upto is not None:
+        sql += ' WHERE _id <= %d' % upto
+    records = list(read_records(sql))
+    if not records:
+        raise DataStoreError('No row count for table %s' % res_id)
+    return {'low': records[0].get('low'), 'high': records[0].get('high'), 'total': int(records[0].get('total') or 0)}
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if type(value) in (dict, list):
+        return json.dumps(value)
+    return value
+
+
+def get_writer(f, fmt, columns):
+    # Function writing one record to a file in the export format
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        return lambda record: writer.writerow([csv_value(record.get(c)) for c in columns])
+    return lambda record: f.write(json.dumps(dict((c, record.get(c)) for c in columns)) + '\n')
+
+
+def export_slice(res_id, columns, after, upto, f, fmt, page_rows=PAGE_ROWS):
+    """
+    Write the rows of a table with after < _id <= upto to a file, in _id
+    order, a page at a time. A page that fails part way is written again.
+    :param res_id: resource id, which is the table name
+    :param columns: columns to export
+    :param after: _id the slice starts after
+    :param upto: last _id of the slice
+    :param f: text file to write to
+    :param fmt: 'csv' or 'ndjson'
+    :param page_rows: rows per query
+    :return: number of rows written
+    """
+    select = 'SELECT %s FROM %s' % (', '.join(quote_ident(c) for c in ['_id'] + columns), quote_ident(res_id))
+    write = get_writer(f, fmt, columns)
+    rows = 0
+    while after < upto:
+        sql = '%s WHERE _id > %d AND _id <= %d ORDER BY _id LIMIT %d' % (select, after, upto, page_rows)
+        for attempt in range(ckanapi.max_retries + 1):
+            pos = f.tell()
+            count, last = 0, after
+            try:
+                for record in read_records(sql):
+                    write(record)
+                    count += 1
+                    last = record['_id']
+                break
+            except DataStoreError as e:
+                if attempt == ckanapi.max_retries:
+                    raise
+                f.seek(pos)
+                f.truncate()
+                delay = ckanapi.backoff_delay(attempt)
+                logger.warning('%s, reading the page again in %.1f secs' % (e, delay))
+                metrics.add_retry('api')
+                time.sleep(delay)
+        rows += count
+        after = last
+        if count < page_rows:
+            break
+    return rows
+
+
+def export_range(res_id, columns, fmt, after, upto, total, f, slices=SLICES, page_rows=PAGE_ROWS):
+    """
+    Write the rows with after < _id <= upto to a file. Large ranges are
+    split into slices of _id, exported in parallel to temporary files and
+    then copied into f in order.
+    :param total: about how many rows are in the range, to decide on slicing
+    :return: number of rows written
+    """
+    slices = max(min(slices, -(-total // page_rows), upto - after), 1)
+    if slices == 1:
+        return export_slice(res_id, columns, after, upto, f, fmt, page_rows)
+
+    bounds = [after + (upto - after) * i // slices for i in range(slices + 1)]
+    slice_files = ['%s.%s' % (f.name, i) for i in range(1, slices)]
+
+    def run_slice(i):
+        # The first slice goes straight into f, the others to their own file
+        if i == 0:
+            return export_slice(res_id, columns, bounds[0], bounds[1], f, fmt, page_rows)
+        with open(slice_files[i - 1], 'w', encoding='utf8', newline='') as slice_f:
+            return export_slice(res_id, columns, bounds[i], bounds[i + 1], slice_f, fmt, page_rows)
+
+    try:
+        with ThreadPoolExecutor(max_workers=slices) as pool:
+            futures = [pool.submit(contextvars.copy_context().run, run_slice, i) for i in range(slices)]
+            rows = sum(future.result() for future in futures)
+        for slice_file in slice_files:
+            with open(slice_file, encoding='utf8', newline='') as slice_f:
+                while True:
+                    chunk = slice_f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+    finally:
+        for slice_file in slice_files:
+            if os.path.exists(slice_file):
+                os.remove(slice_file)
+    return rows
+
+
+def export_table(res_id, target, fmt='csv', state=None, slices=SLICES, page_rows=PAGE_ROWS):
+    """
+    Export a DataStore table to a file, or bring an earlier export up to date.
+    :param res_id: resource id, which is the table name
+    :param target: path of the CSV or NDJSON file
+    :param fmt: 'csv' or 'ndjson'
+    :param state: state returned by the last export of the table to target,
+    None for a full export
+    :param slices: slices of the table exported in parallel
+    :param page_rows: rows per query
+    :return: state of the export, to pass in next time: a dict with the
+    format, columns, last _id and number of rows exported, and the file size
+    """
+    columns = table_columns(res_id)
+    stats = table_stats(res_id)
+    high = stats['high'] or 0
+
+    if state and state.get('format') == fmt and state.get('columns') == columns and \
+            os.path.exists(target) and os.path.getsize(target) == state.get('size'):
+        last_id = state['last_id']
+        if high == last_id and stats['total'] == state['rows']:
+            logger.info('DataStore table %s is up to date' % res_id)
+            return state
+        # No rows deleted up to the last export, so only new rows were added
+        if high > last_id and table_stats(res_id, upto=last_id)['total'] == state['rows']:
+            logger.info('Exporting %s new rows of DataStore table %s' % (stats['total'] - state['rows'], res_id))
+            with open(target, 'a', encoding='utf8', newline='') as f:
+                try:
+                    rows = export_range(res_id, columns, fmt, last_id, high, stats['total'] - state['rows'],
+                                        f, slices, page_rows)
+                except BaseException:
+                    # Leave the file as it was after the last export
+                    f.truncate(state['size'])
+                    raise
+            return dict(state, last_id=high, rows=state['rows'] + rows, size=os.path.getsize(target))
+        logger.info('Rows were deleted from DataStore table %s, exporting all of it' % res_id)
+
+    logger.info('Exporting %s rows of DataStore table %s' % (stats['total'], res_id))
+    part_file = target + '.part'
+    try:
+        with open(part_file, 'w', encoding='utf8', newline='') as f:
+            if fmt == 'csv':
+                csv.writer(f).writerow(columns)
+            rows = 0
+            if stats['low'] is not None:
+                rows = export_range(res_id, columns, fmt, stats['low'] - 1, high, stats['total'], f,
+                                    slices, page_rows)
+        os.replace(part_file, target)
+    finally:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+    return {'format': fmt, 'columns': columns, 'last_id': high, 'rows': rows, 'size': os.path.getsize(target)}
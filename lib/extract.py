@@ -0,0 +1,230 @@
+"""
+Unpacks downloaded zip archives into a folder per dataset. The CRC and size
+of every extracted member are recorded, so that when an archive is
+downloaded again only the members that changed are written. Archives, and
+the changed members of large archives, are extracted in parallel processes.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import time
+import traceback
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from json import JSONDecodeError
+
+import settings
+
+logger = settings.setup_logger('extract')
+
+# Extraction state of an archive, kept in its destination folder
+STATE_FILE = '.gokit_extract.%s.json'
+
+# Changed members are split into batches of about this many bytes, one per process
+BATCH_BYTES = 256 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_extract_folder(downloads_folder, dataset_name):
+    return os.path.join(downloads_folder, dataset_name)
+
+
+def get_state_file(zip_path, dest):
+    return os.path.join(dest, STATE_FILE % os.path.basename(zip_path))
+
+
+def read_state(state_file):
+    try:
+        with open(state_file, encoding='utf8') as f:
+            return json.load(f)
+    except (OSError, JSONDecodeError):
+        return {}
+
+
+def write_state(state_file, state):
+    with open(state_file + '.tmp', 'w', encoding='utf8') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def safe_target(dest, name):
+    """
+    Path a zip member is extracted to, or None if the member would land
+    outside the destination folder (absolute paths, '..').
+    :param dest: real path of the destination folder
+    :param name: member name in the archive
+    :return: path, or None
+    """
+    target = os.path.realpath(os.path.join(dest, name))
+    if os.path.commonpath([dest, target]) != dest or target == dest:
+        return None
+    return target
+
+
+def archive_signature(zip_path):
+    st = os.stat(zip_path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+def plan_extract(zip_path, dest):
+    """
+    Compare an archive with what was extracted from it last time.
+    :param zip_path: local zip file
+    :param dest: destination folder
+    :return: dict with the members to write (name and size), the files to
+    remove, and the previous state, or None if nothing changed
+    """
+    dest = os.path.realpath(dest)
+    state = read_state(get_state_file(zip_path, dest))
+    members = state.get('members', {})
+    if state.get('archive') == archive_signature(zip_path) and all(
+            os.path.exists(os.path.join(dest, name)) and file_signature(os.path.join(dest, name)) == m['file']
+            for name, m in members.items()):
+        return None
+
+    changed = []
+    seen = set()
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            target = safe_target(dest, info.filename)
+            if not target:
+                logger.warning('Skipping %s in %s, it would be extracted outside %s' % (
+                    info.filename, zip_path, dest))
+                continue
+            seen.add(info.filename)
+            last = members.get(info.filename)
+            if last and last['crc'] == info.CRC and last['size'] == info.file_size and \
+                    os.path.exists(target) and file_signature(target) == last['file']:
+                continue
+            changed.append((info.filename, info.file_size))
+    removed = [name for name in members if name not in seen]
+    return {'zip_path': zip_path, 'dest': dest, 'changed': changed, 'removed': removed, 'state': state}
+
+
+def extract_members(zip_path, dest, names):
+    """
+    Extract some members of an archive, streaming each one to a temp file,
+    named after the process, renamed into place. Runs in a worker process.
+    :param zip_path: local zip file
+    :param dest: real path of the destination folder
+    :param names: member names to extract
+    :return: dict of member name to its state entry (crc, size, file)
+    """
+    written = {}
+    with zipfile.ZipFile(zip_path) as zf:
+        for name in names:
+            info = zf.getinfo(name)
+            target = safe_target(dest, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Archives of a dataset share its folder, and two can hold a member of the same name
+            tmp_file = '%s.%s.tmp' % (target, os.getpid())
+            try:
+                # zipfile checks the CRC as the member is read
+                with zf.open(info) as src, open(tmp_file, 'wb') as out:
+                    shutil.copyfileobj(src, out, CHUNK_SIZE)
+                mtime = time.mktime(datetime.datetime(*info.date_time).timetuple())
+                os.utime(tmp_file, (mtime, mtime))
+                os.replace(tmp_file, target)
+            except BaseException:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+            written[name] = {'crc': info.CRC, 'size': info.file_size, 'file': file_signature(target)}
+    return written
+
+
+def split_batches(members, batch_bytes=BATCH_BYTES):
+    # Group (name, size) pairs into batches of about batch_bytes
+    batches = [[]]
+    size = 0
+    for name, member_size in members:
+        if batches[-1] and size + member_size > batch_bytes:
+            batches.append([])
+            size = 0
+        batches[-1].append(name)
+        size += member_size
+    return [batch for batch in batches if batch]
+
+
+def finish_extract(plan, written, complete=True):
+    """
+    Remove files of members that left the archive and save the new state.
+    :param plan: result of plan_extract()
+    :param written: member states returned by extract_members()
+    :param complete: False if some members failed, the archive is then
+    compared member by member again next time
+    :return: None
+    """
+    members = plan['state'].get('members', {})
+    for name in plan['removed']:
+        target = safe_target(plan['dest'], name)
+        if target and os.path.exists(target):
+            os.remove(target)
+        members.pop(name, None)
+    members.update(written)
+    state = {'archive': archive_signature(plan['zip_path']) if complete else None, 'members': members}
+    write_state(get_state_file(plan['zip_path'], plan['dest']), state)
+
+
+def extract_archives(archives, processes=None):
+    """
+    Extract archives, writing only the members that changed since the last
+    extraction.
+    :param archives: list of (key, zip path, destination folder) tuples,
+    the key identifies the archive in the result (e.g. a dataset name)
+    :param processes: number of worker processes, default one per core
+    :return: tuple of the number of bytes written, and the set of keys of
+    archives that could not be extracted
+    """
+    plans = []
+    failed = set()
+    for key, zip_path, dest in archives:
+        try:
+            os.makedirs(dest, exist_ok=True)
+            plan = plan_extract(zip_path, dest)
+        except (OSError, zipfile.BadZipFile):
+            logger.error('Cannot read archive %s' % zip_path)
+            logger.error(traceback.format_exc())
+            failed.add(key)
+            continue
+        if plan is None:
+            logger.info('%s is already extracted' % os.path.basename(zip_path))
+            continue
+        logger.info('Extracting %s of the members of %s to %s' % (
+            len(plan['changed']), os.path.basename(zip_path), dest))
+        plans.append((key, plan))
+    if not plans:
+        return 0, failed
+
+    written = dict((id(plan), {}) for _, plan in plans)
+    extracted = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {}
+        for key, plan in plans:
+            for batch in split_batches(plan['changed']):
+                futures[pool.submit(extract_members, plan['zip_path'], plan['dest'], batch)] = (key, plan)
+        for future in as_completed(futures):
+            key, plan = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                logger.error('Failed to extract %s' % plan['zip_path'])
+                logger.error(traceback.format_exc())
+                failed.add(key)
+                continue
+            written[id(plan)].update(result)
+            extracted += sum(m['size'] for m in result.values())
+    for key, plan in plans:
+        # A partly extracted archive keeps the state of the members that made it
+        finish_extract(plan, written[id(plan)], complete=key not in failed)
+    logger.info('Extracted %s bytes from %s archives' % (extracted, len(plans)))
+    return extracted, failed
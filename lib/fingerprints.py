@@ -0,0 +1,160 @@
+"""
+A compact index of metadata fingerprints, stored next to the archived
+metadata in settings.meta_archives. Each dataset has one fingerprint for its
+own fields and one per resource, keyed by resource id, so checking whether a
+dataset changed is an index lookup instead of parsing its archived JSON.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from json import JSONDecodeError
+
+import settings
+
+logger = settings.setup_logger('fingerprints')
+
+INDEX_FILE = 'fingerprints.json'
+
+# Fields that change without the metadata changing, left out of fingerprints
+IGNORE_FIELDS = ['resources', 'uuid', 'hash', 'revision_id', 'metadata_modified', 'species_codes',
+                 'readme_updated']
+# Resources are matched by id, so their position in the list does not matter
+RES_IGNORE_FIELDS = IGNORE_FIELDS + ['position']
+
+# Seconds between writes of the index while it is being updated, see FingerprintIndex.put
+SAVE_INTERVAL = 5
+
+
+def fingerprint(data, ignore_fields=IGNORE_FIELDS):
+    """
+    Stable hash of a dataset or resource dict: the same fields and values
+    give the same fingerprint, whatever the key order.
+    :param data: dataset or resource dict
+    :param ignore_fields: fields left out
+    :return: hex string
+    """
+    fields = dict((k, v) for k, v in data.items() if k not in ignore_fields)
+    canonical = json.dumps(fields, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode('utf8'), digest_size=12).hexdigest()
+
+
+def dataset_fingerprints(ds):
+    """
+    Fingerprints of a dataset and of each of its resources.
+    :param ds: dataset dict
+    :return: dict with the 'dataset' fingerprint and the 'resources'
+    fingerprints by id (or by position, for resources without an id)
+    """
+    resources = {}
+    for i, res in enumerate(ds.get('resources') or []):
+        resources[res.get('id') or '#%s' % i] = fingerprint(res, RES_IGNORE_FIELDS)
+    return {'dataset': fingerprint(ds), 'resources': resources}
+
+
+def compare_fingerprints(fp1, fp2):
+    """
+    Compare two results of dataset_fingerprints().
+    :return: set of differences, e.g. 'dataset', 'resource-count' or
+    'resource:<id>', empty if the datasets match
+    """
+    diffs = set()
+    if fp1['dataset'] != fp2['dataset']:
+        diffs.add('dataset')
+    res1, res2 = fp1['resources'], fp2['resources']
+    if len(res1) != len(res2):
+        diffs.add('resource-count')
+    for res_id in set(res1) | set(res2):
+        if res1.get(res_id) != res2.get(res_id):
+            diffs.add('resource:%s' % res_id)
+    return diffs
+
+
+class FingerprintIndex(object):
+    """
+    Fingerprints of the archived metadata of each dataset, with the mtime of
+    the archive file they were taken from. Safe to share between threads.
+    :param folder: metadata archive folder
+    """
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, INDEX_FILE)
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.saved = 0
+        self.datasets = self.load()
+        atexit.register(self.save_if_dirty)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, JSONDecodeError):
+            logger.error('Cannot read fingerprint index %s, it will be rebuilt' % self.path)
+            logger.error(traceback.format_exc())
+            return {}
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_file = self.path + '.tmp'
+            with open(tmp_file, 'w', encoding='utf8') as f:
+                json.dump(self.datasets, f, separators=(',', ':'), sort_keys=True)
+            os.replace(tmp_file, self.path)
+            self.dirty = False
+            self.saved = time.time()
+
+    def save_if_dirty(self):
+        if self.dirty:
+            self.save()
+
+    def get(self, ds_name, mtime=None):
+        """
+        Fingerprints of a dataset.
+        :param ds_name: dataset name
+        :param mtime: mtime of the archive file, the entry is only returned
+        if it was taken from that version of the file
+        :return: dict from dataset_fingerprints(), or None
+        """
+        with self.lock:
+            entry = self.datasets.get(ds_name)
+        if not entry or (mtime is not None and entry.get('mtime') != mtime):
+            return None
+        return entry
+
+    def put(self, ds_name, ds, mtime=None):
+        """
+        Store the fingerprints of a dataset. The index is written to disk
+        every SAVE_INTERVAL seconds at most, and on exit.
+        :param ds_name: dataset name
+        :param ds: dataset dict
+        :param mtime: mtime of the archive file the dataset was read from
+        :return: the stored fingerprints
+        """
+        entry = dataset_fingerprints(ds)
+        entry['mtime'] = mtime
+        with self.lock:
+            self.datasets[ds_name] = entry
+            self.dirty = True
+        if time.time() - self.saved > SAVE_INTERVAL:
+            self.save()
+        return entry
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    # The index of settings.meta_archives, loaded on first use
+    global _index
+    with _index_lock:
+        if _index is None or os.path.dirname(_index.path) != settings.meta_archives:
+            _index = FingerprintIndex(settings.meta_archives)
+        return _index
@@ -0,0 +1,155 @@
+"""
+Integrity check of a downloads folder, e.g. before going into the field.
+Every synced file is checked against the size and sha256 it had when it was
+downloaded, and zip archives are tested member by member against their
+CRCs. Files are hashed in parallel processes with large sequential reads,
+and the members of a large archive are split into batches so that one big
+zip keeps every core busy. Hardlinked copies of a stored file are read once.
+"""
+
+import hashlib
+import os
+import time
+import traceback
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import settings
+from lib.extract import split_batches
+
+logger = settings.setup_logger('integrity')
+
+# Bytes read from disk at a time
+READ_SIZE = 8 * 1024 * 1024
+
+# The members of an archive are tested in batches of about this many compressed bytes, one per process
+BATCH_BYTES = 256 * 1024 * 1024
+
+
+def hash_file(path):
+    # sha256 hex digest of a file, read sequentially into one reused buffer
+    sha256 = hashlib.sha256()
+    buf = bytearray(READ_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            sha256.update(view[:n])
+    return sha256.hexdigest()
+
+
+def check_hash(path, expected):
+    """
+    In a worker process: check a file against the sha256 recorded for each
+    of its paths. Hardlinked copies can have been recorded with different
+    hashes, the file is read once for all of them.
+    :param path: path to read the file from
+    :param expected: dict of each path of the file to its expected sha256
+    :return: list of (path, problem) tuples, empty if every hash matches
+    """
+    try:
+        digest = hash_file(path)
+    except OSError as e:
+        return [(p, 'cannot be read: %s' % e) for p in expected]
+    return [(p, 'sha256 is %s, expected %s' % (digest, sha256))
+            for p, sha256 in expected.items() if digest != sha256]
+
+
+def check_members(path, names):
+    # In a worker process: None if the members of an archive match their CRCs, or the problem
+    try:
+        with zipfile.ZipFile(path) as zf:
+            for name in names:
+                try:
+                    # Reading a member to the end checks its CRC
+                    with zf.open(name) as member:
+                        while member.read(READ_SIZE):
+                            pass
+                except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+                    return 'member %s is corrupt: %s' % (name, e)
+    except (OSError, zipfile.BadZipFile) as e:
+        return 'cannot be read as a zip file: %s' % e
+    return None
+
+
+def list_members(path):
+    # (name, compressed size) of the members of an archive that can be tested
+    with zipfile.ZipFile(path) as zf:
+        # Encrypted members cannot be read without their password
+        return [(info.filename, info.compress_size) for info in zf.infolist()
+                if not info.is_dir() and not info.flag_bits & 0x1]
+
+
+def verify_files(files, processes=None, crc=True):
+    """
+    Check files against their expected size and sha256, and test the CRCs
+    of the members of zip archives.
+    :param files: list of dicts with the path of each file, and its size
+    and sha256 if known
+    :param processes: number of worker processes, default one per core
+    :param crc: also test the members of zip archives
+    :return: list of (path, problem) tuples, empty if every file is intact
+    """
+    started = time.time()
+    problems = []
+    # Hardlinks to the same stored file share an inode, which is read once
+    inodes = {}
+    for entry in files:
+        path = entry['path']
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            problems.append((path, 'missing'))
+            continue
+        except OSError as e:
+            problems.append((path, 'cannot be read: %s' % e))
+            continue
+        if entry.get('size') is not None and st.st_size != entry['size']:
+            problems.append((path, 'size is %s bytes, expected %s' % (st.st_size, entry['size'])))
+            continue
+        inode = inodes.setdefault((st.st_dev, st.st_ino), {'path': path, 'size': st.st_size, 'sha256': {},
+                                                          'paths': []})
+        inode['paths'].append(path)
+        if entry.get('sha256'):
+            inode['sha256'][path] = entry['sha256']
+
+    checked = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {}
+        # Largest files first, so that the last file to finish is a small one
+        for inode in sorted(inodes.values(), key=lambda inode: -inode['size']):
+            path = inode['path']
+            checked += inode['size']
+            if inode['sha256']:
+                futures[pool.submit(check_hash, path, inode['sha256'])] = inode
+            if not crc or not zipfile.is_zipfile(path):
+                continue
+            try:
+                members = list_members(path)
+            except (OSError, zipfile.BadZipFile) as e:
+                problems.extend((p, 'cannot be read as a zip file: %s' % e) for p in inode['paths'])
+                continue
+            for batch in split_batches(members, BATCH_BYTES):
+                futures[pool.submit(check_members, path, batch)] = inode
+        for future in as_completed(futures):
+            inode = futures[future]
+            try:
+                problem = future.result()
+            except Exception:
+                logger.error(traceback.format_exc())
+                problem = 'could not be checked'
+            if type(problem) is list:
+                # From check_hash, path by path
+                problems.extend(problem)
+            elif problem:
+                problems.extend((p, problem) for p in inode['paths'])
+
+    elapsed = time.time() - started
+    logger.info('Checked %s files (%.1f GB) in %.1f secs, %.0f MB/s' % (
+        len(files), checked / 1024.0 ** 3, elapsed, checked / 1024.0 ** 2 / max(elapsed, 0.001)))
+    return problems
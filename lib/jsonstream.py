@@ -0,0 +1,134 @@
+"""
+Incremental decoding of large JSON responses. The items of one array in the
+document (e.g. the datasets of a package_search) are decoded and handed out
+one at a time as the response is read, so the whole body is never held in
+memory, raw or decoded.
+"""
+
+import codecs
+import json
+from json import JSONDecodeError
+
+WHITESPACE = ' \t\n\r'
+
+# Characters that can continue a number, e.g. 1 in a chunk and .5 in the next
+NUMBER_CHARS = '0123456789.eE+-'
+
+# Consumed text is dropped from the buffer once it is this long
+COMPACT_SIZE = 64 * 1024
+
+
+class ChunkReader(object):
+    """
+    Text buffer over an iterator of byte chunks, decoded as UTF-8.
+    :param chunks: iterator of bytes, e.g. Response.iter_content()
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.json = json.JSONDecoder()
+
+    def fill(self):
+        # Read the next chunk, False at the end of the document
+        if self.eof:
+            return False
+        if self.pos > COMPACT_SIZE:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            self.buf += self.decoder.decode(b'', final=True)
+            return False
+        self.buf += self.decoder.decode(chunk)
+        return True
+
+    def fill_to(self, size):
+        # Read until size characters are left to consume, False if nothing more could be read
+        filled = False
+        while len(self.buf) - self.pos < size and self.fill():
+            filled = True
+        return filled
+
+    def peek(self):
+        # Next character after whitespace, without consuming it. '' at the end.
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        # Consume the next character, which must be one of chars
+        char = self.peek()
+        if not char or char not in chars:
+            raise JSONDecodeError('Expected one of %r' % chars, self.buf, self.pos)
+        self.pos += 1
+        return char
+
+    def value(self):
+        # Decode the next JSON value, reading more of the document until it is complete
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+            except JSONDecodeError:
+                # Twice as much before trying again, so a large value is decoded a few times, not once per chunk
+                if not self.fill_to(2 * (len(self.buf) - self.pos)):
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if (type(value) in (int, float) and (end == len(self.buf) or self.buf[end] in NUMBER_CHARS) and
+                    not self.eof and self.fill()):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_array(chunks, path, found=None):
+    """
+    Decode the items of the array at path in a JSON document, one at a time.
+    :param chunks: iterator of bytes holding the document
+    :param path: keys leading to the array, e.g. ['result', 'results']
+    :param found: optional dict, filled with the other values on the way,
+    e.g. found['success'] and found['result']['count']. Values after the
+    array are only there once every item has been read.
+    :return: generator of items. JSONDecodeError is raised if the document
+    is not valid JSON or ends early.
+    """
+    reader = ChunkReader(chunks)
+    found = {} if found is None else found
+    yield from walk(reader, list(path), found)
+
+
+def walk(reader, path, found):
+    # Iterate through an object, descending into path
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.pos += 1
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == path[0] and len(path) > 1 and reader.peek() == '{':
+            yield from walk(reader, path[1:], found.setdefault(key, {}))
+        elif key == path[0] and len(path) == 1 and reader.peek() == '[':
+            reader.pos += 1
+            if reader.peek() == ']':
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            found[key] = reader.value()
+        if reader.expect(',}') == '}':
+            return
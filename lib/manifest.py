@@ -0,0 +1,190 @@
+"""
+A local record of what has been synced into a downloads folder. It lets gokit
+skip datasets and resources that have not changed on the GIS Hub since the
+last run, instead of re-downloading the whole list every time.
+"""
+
+import json
+import os
+import threading
+import traceback
+from json import JSONDecodeError
+from urllib.parse import urlparse
+
+import settings
+from lib import ckanapi
+
+logger = settings.setup_logger('manifest')
+
+MANIFEST_FILE = '.gokit_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def remote_state(res, ds_meta=None):
+    """
+    The fields of a CKAN resource that tell us whether its uploaded file has
+    changed. Signed URLs change on every request, so only the path is kept.
+    :param res: resource dict from CKAN
+    :param ds_meta: dataset dict, used as a fallback when the resource has no
+    last_modified or size
+    :return: dict
+    """
+    state = {'last_modified': res.get('last_modified'),
+             'size': res.get('size'),
+             'url': urlparse(res.get('url') or '').path}
+    if not state['last_modified'] and not state['size'] and ds_meta:
+        state['metadata_modified'] = ds_meta.get('metadata_modified')
+    return state
+
+
+class SyncManifest(object):
+    """
+    Sync state of a downloads folder, keyed by dataset name and resource id.
+    Safe to share between sync workers.
+    :param downloads_folder: folder that the manifest file is stored in
+    :param force: treat every dataset and resource as changed
+    """
+
+    def __init__(self, downloads_folder, force=False):
+        self.path = os.path.join(downloads_folder, MANIFEST_FILE)
+        self.force = force
+        self.lock = threading.Lock()
+        self.datasets = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            logger.info('No sync manifest yet, all datasets will be synced')
+            return {}
+        try:
+            with open(self.path, encoding='utf8') as f:
+                data = json.load(f)
+            return data.get('datasets', {})
+        except (OSError, JSONDecodeError):
+            logger.error('Cannot read sync manifest %s, all datasets will be synced' % self.path)
+            logger.error(traceback.format_exc())
+            return {}
+
+    def save(self):
+        # Write to a temp file first, so an interrupted run never leaves a broken manifest
+        with self.lock:
+            data = {'version': MANIFEST_VERSION, 'datasets': self.datasets}
+            tmp_file = self.path + '.tmp'
+            with open(tmp_file, 'w', encoding='utf8') as f:
+                json.dump(data, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.path)
+
+    def get_dataset(self, ds_name):
+        with self.lock:
+            return self.datasets.setdefault(ds_name, {'metadata_modified': None, 'resources': {}})
+
+    def metadata_changed(self, ds_name, ds_meta, metadata_files):
+        """
+        True if the metadata files for a dataset need to be written again.
+        :param ds_name: dataset name
+        :param ds_meta: dataset dict from CKAN
+        :param metadata_files: local metadata files that must exist
+        :return: bool
+        """
+        if self.force:
+            return True
+        entry = self.get_dataset(ds_name)
+        if entry.get('metadata_modified') != ds_meta.get('metadata_modified'):
+            return True
+        return not all(os.path.exists(f) for f in metadata_files)
+
+    def synced_version(self, ds_name):
+        # metadata_modified of a dataset at its last sync, None if never synced
+        with self.lock:
+            return (self.datasets.get(ds_name) or {}).get('metadata_modified')
+
+    def high_water(self):
+        """
+        Latest metadata_modified among the synced datasets: changes made on
+        the GIS Hub before it have been synced.
+        :return: timestamp string, or None if nothing was synced yet
+        """
+        with self.lock:
+            versions = [entry.get('metadata_modified') for entry in self.datasets.values()]
+        versions = [v for v in versions if v]
+        return max(versions) if versions else None
+
+    def synced_files(self):
+        """
+        Files written by past syncs: downloaded resources and exported tables.
+        :return: list of (dataset name, file name, size, sha256) tuples, the
+        sha256 is None for exported tables
+        """
+        files = []
+        with self.lock:
+            for ds_name, entry in sorted(self.datasets.items()):
+                for res in entry.get('resources', {}).values():
+                    files.append((ds_name, res.get('file'), res.get('local_size'), res.get('sha256')))
+                for table in (entry.get('tables') or {}).values():
+                    files.append((ds_name, table.get('file'), table.get('size'), None))
+        return files
+
+    def set_metadata(self, ds_name, ds_meta):
+        entry = self.get_dataset(ds_name)
+        with self.lock:
+            entry['metadata_modified'] = ds_meta.get('metadata_modified')
+
+    def resource_changed(self, ds_name, res, local_file, ds_meta=None):
+        """
+        True if a resource must be downloaded: it is new, its remote state
+        differs from the last sync, or the local copy is missing or resized.
+        :param ds_name: dataset name
+        :param res: resource dict from CKAN
+        :param local_file: path the resource is downloaded to
+        :param ds_meta: dataset dict from CKAN
+        :return: bool
+        """
+        if self.force:
+            return True
+        entry = self.get_dataset(ds_name)['resources'].get(res.get('id'))
+        if not entry:
+            return True
+        diffs = ckanapi.compare_fields(remote_state(res, ds_meta), entry['remote'])
+        if diffs:
+            logger.info('Resource %s changed in: %s' % (res.get('id'), diffs))
+            return True
+        if entry.get('file') != os.path.basename(local_file) or not os.path.exists(local_file):
+            return True
+        return os.path.getsize(local_file) != entry.get('local_size')
+
+    def set_resource(self, ds_name, res, local_file, sha256, ds_meta=None):
+        """
+        Record a resource that has just been downloaded.
+        :param ds_name: dataset name
+        :param res: resource dict from CKAN
+        :param local_file: path of the downloaded file
+        :param sha256: hex digest of the downloaded file
+        :param ds_meta: dataset dict from CKAN
+        :return: None
+        """
+        resources = self.get_dataset(ds_name)['resources']
+        with self.lock:
+            resources[res.get('id')] = {
+                'remote': remote_state(res, ds_meta),
+                'file': os.path.basename(local_file),
+                'local_size': os.path.getsize(local_file),
+                'sha256': sha256,
+                'synced': settings.safe_timestamp()}
+
+    def get_table(self, ds_name, res_id):
+        # State of the last export of a DataStore table, see lib.datastore.export_table
+        with self.lock:
+            return ((self.datasets.get(ds_name) or {}).get('tables') or {}).get(res_id)
+
+    def set_table(self, ds_name, res_id, local_file, state):
+        """
+        Record a DataStore table that has just been exported.
+        :param ds_name: dataset name
+        :param res_id: resource id of the table
+        :param local_file: path of the exported file
+        :param state: state returned by lib.datastore.export_table
+        :return: None
+        """
+        entry = self.get_dataset(ds_name)
+        with self.lock:
+            entry.setdefault('tables', {})[res_id] = dict(
+                state, file=os.path.basename(local_file), synced=settings.safe_timestamp())
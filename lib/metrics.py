@@ -0,0 +1,197 @@
+"""
+Timing and throughput metrics for sync runs. Calls are grouped into phases
+(api, download, disk) and recorded per dataset, so that a slow sync can be
+traced to the GIS Hub API, to S3 or to the local disk. Each run is exported
+as JSON and as a Prometheus textfile, see export().
+"""
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+import settings
+
+logger = settings.setup_logger('metrics')
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900]
+
+# Dataset being synced by the current thread or asyncio task, see dataset()
+current_dataset = contextvars.ContextVar('current_dataset', default=None)
+
+_lock = threading.Lock()
+_run = {}
+
+
+def reset():
+    # Start recording a new run
+    global _run
+    with _lock:
+        _run = {'started': time.time(), 'phases': {}, 'bytes': {}, 'retries': {}, 'datasets': {}}
+
+
+reset()
+
+
+@contextlib.contextmanager
+def dataset(name):
+    # Attribute the metrics recorded inside this context to a dataset
+    token = current_dataset.set(name)
+    try:
+        yield
+    finally:
+        current_dataset.reset(token)
+
+
+def get_dataset_entry(name):
+    # Call with _lock held
+    return _run['datasets'].setdefault(name, {'phases': {}, 'bytes': 0, 'retries': 0})
+
+
+def record(phase_name, seconds):
+    """
+    Record the duration of one call in a phase.
+    :param phase_name: 'api', 'download', 'disk', ...
+    :param seconds: duration of the call
+    :return: None
+    """
+    name = current_dataset.get()
+    with _lock:
+        _run['phases'].setdefault(phase_name, []).append(seconds)
+        if name:
+            phases = get_dataset_entry(name)['phases']
+            phases[phase_name] = phases.get(phase_name, 0) + seconds
+
+
+def add_bytes(direction, count):
+    # Count bytes transferred, direction is e.g. 'download', 'api' or 'disk'
+    name = current_dataset.get()
+    with _lock:
+        _run['bytes'][direction] = _run['bytes'].get(direction, 0) + count
+        if name and direction == 'download':
+            get_dataset_entry(name)['bytes'] += count
+
+
+def add_retry(phase_name):
+    name = current_dataset.get()
+    with _lock:
+        _run['retries'][phase_name] = _run['retries'].get(phase_name, 0) + 1
+        if name:
+            get_dataset_entry(name)['retries'] += 1
+
+
+@contextlib.contextmanager
+def phase(phase_name):
+    # Time the code inside this context as one call in a phase ('api', 'download', 'disk', ...)
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(phase_name, time.time() - start)
+
+
+def timed(phase_name):
+    # Decorator timing every call of a function as one call in a phase
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(phase_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def get_histogram(samples):
+    # Cumulative bucket counts, as in a Prometheus histogram
+    return [(bound, len([s for s in samples if s <= bound])) for bound in BUCKETS]
+
+
+def summarize(summary=None):
+    """
+    Summary of the current run.
+    :param summary: sync summary dict from gokit_sync.sync, mapping outcomes
+    to dataset names
+    :return: dict, as written to the JSON export
+    """
+    with _lock:
+        run = json.loads(json.dumps(_run))
+    phases = {}
+    for phase_name, samples in run['phases'].items():
+        phases[phase_name] = {
+            'count': len(samples), 'seconds': round(sum(samples), 3),
+            'p50': percentile(samples, 0.5), 'p90': percentile(samples, 0.9),
+            'p99': percentile(samples, 0.99), 'max': max(samples),
+            'buckets': get_histogram(samples)}
+    return {
+        'started': run['started'],
+        'duration': round(time.time() - run['started'], 3),
+        'outcomes': dict((k, len(v)) for k, v in (summary or {}).items()),
+        'phases': phases,
+        'bytes': run['bytes'],
+        'retries': run['retries'],
+        'datasets': run['datasets'],
+    }
+
+
+def format_prometheus(report):
+    # Render a summarize() report in the Prometheus text exposition format
+    lines = ['# HELP gokit_phase_seconds Time spent in each sync phase.',
+             '# TYPE gokit_phase_seconds histogram']
+    for phase_name, stats in sorted(report['phases'].items()):
+        for bound, count in stats['buckets']:
+            lines.append('gokit_phase_seconds_bucket{phase="%s",le="%s"} %s' % (phase_name, bound, count))
+        lines.append('gokit_phase_seconds_bucket{phase="%s",le="+Inf"} %s' % (phase_name, stats['count']))
+        lines.append('gokit_phase_seconds_sum{phase="%s"} %s' % (phase_name, stats['seconds']))
+        lines.append('gokit_phase_seconds_count{phase="%s"} %s' % (phase_name, stats['count']))
+    lines += ['# HELP gokit_bytes_total Bytes transferred during the sync.',
+              '# TYPE gokit_bytes_total counter']
+    for direction, count in sorted(report['bytes'].items()):
+        lines.append('gokit_bytes_total{direction="%s"} %s' % (direction, count))
+    lines += ['# HELP gokit_retries_total Retried calls during the sync.',
+              '# TYPE gokit_retries_total counter']
+    for phase_name, count in sorted(report['retries'].items()):
+        lines.append('gokit_retries_total{phase="%s"} %s' % (phase_name, count))
+    lines += ['# HELP gokit_datasets Datasets by sync outcome.',
+              '# TYPE gokit_datasets gauge']
+    for outcome, count in sorted(report['outcomes'].items()):
+        lines.append('gokit_datasets{outcome="%s"} %s' % (outcome, count))
+    lines += ['# HELP gokit_sync_duration_seconds Duration of the last sync.',
+              '# TYPE gokit_sync_duration_seconds gauge',
+              'gokit_sync_duration_seconds %s' % report['duration'],
+              '# HELP gokit_sync_last_run_timestamp_seconds Start time of the last sync.',
+              '# TYPE gokit_sync_last_run_timestamp_seconds gauge',
+              'gokit_sync_last_run_timestamp_seconds %s' % report['started']]
+    return '\n'.join(lines) + '\n'
+
+
+def export(folder, summary=None, basename='gokit_sync'):
+    """
+    Write the metrics of the current run to <basename>.metrics.json and
+    <basename>.prom in a folder. Files are replaced atomically, as expected
+    by the node_exporter textfile collector.
+    :param folder: output folder, normally next to gokit_sync.log
+    :param summary: sync summary dict from gokit_sync.sync
+    :param basename: name of the output files
+    :return: the report dict
+    """
+    report = summarize(summary)
+    outputs = [('%s.metrics.json' % basename, json.dumps(report, indent=2)),
+               ('%s.prom' % basename, format_prometheus(report))]
+    for filename, content in outputs:
+        path = os.path.join(folder, filename)
+        with open(path + '.tmp', 'w', encoding='utf8') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+    logger.info('Sync metrics saved to %s' % os.path.join(folder, outputs[0][0]))
+    return report
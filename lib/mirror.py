@@ -0,0 +1,406 @@
+"""
+A small stand-in for the GIS Hub on the local network. `gokit_sync mirror`
+syncs datasets from the GIS Hub into its downloads folder, and this module
+serves their metadata (the package_show, package_search and resource_show
+subset that gokit_sync uses) and their files over HTTP. Clients pointed at
+the mirror with --hub fetch every change from it, so the uplink carries one
+copy of each change instead of one per laptop.
+
+The mirror syncs with the API key of its operator, who may see private
+datasets and restricted files. Without access keys anyone who can reach the
+mirror is served, so only public datasets and files are.
+"""
+
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+import time
+import traceback
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import JSONDecodeError
+from urllib.parse import parse_qs, urlparse
+
+import settings
+
+logger = settings.setup_logger('mirror')
+
+# Folder in the downloads folder that synced metadata is published to
+MIRROR_FOLDER = '.gokit_mirror'
+
+CHUNK_SIZE = 1024 * 1024
+
+# Seconds between two scans of the mirror folder for changed metadata
+REFRESH_INTERVAL = 1.0
+
+# Most datasets returned by one package_search, as in CKAN
+MAX_ROWS = 1000
+
+
+def get_mirror_folder(downloads_folder):
+    return os.path.join(downloads_folder, MIRROR_FOLDER)
+
+
+def is_private(ds):
+    return ds.get('private') in (True, 'true', 'True')
+
+
+def is_restricted(res):
+    # True if ckanext-restricted limits who can download a resource, e.g. {"level": "only_allowed_users"}
+    value = res.get('restricted')
+    if type(value) is str:
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return bool(value.strip())
+    if type(value) is dict:
+        return value.get('level', 'public') != 'public'
+    return bool(value)
+
+
+def public_view(ds):
+    """
+    A dataset as the mirror shows it to clients without an access key: not
+    at all if it is private, and without the download URL of its restricted
+    resources, as the GIS Hub shows them to users without access.
+    :param ds: dataset dict
+    :return: copy of the dataset, or None
+    """
+    if is_private(ds):
+        return None
+    ds = json.loads(json.dumps(ds))
+    for res in ds.get('resources') or []:
+        if is_restricted(res):
+            res['url'] = ''
+    return ds
+
+
+class Catalog(object):
+    """
+    Datasets published in the mirror folder by gokit_sync.publish_metadata,
+    reloaded as they change. Safe to share between request threads.
+    :param downloads_folder: downloads folder of the mirror
+    """
+
+    def __init__(self, downloads_folder):
+        self.downloads_folder = downloads_folder
+        self.folder = get_mirror_folder(downloads_folder)
+        self.lock = threading.Lock()
+        self.datasets = {}
+        self.mtimes = {}
+        self.ids = {}
+        self.resources = {}
+        self.files = {}
+        # Resource ids and file paths of private datasets and restricted resources
+        self.hidden = set()
+        self.refreshed = 0
+
+    def load(self, path):
+        try:
+            with open(path, encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, JSONDecodeError):
+            logger.error('Cannot read published metadata %s' % path)
+            logger.error(traceback.format_exc())
+            return None
+
+    def refresh(self):
+        # Reload metadata files that changed since the last scan
+        with self.lock:
+            if time.time() - self.refreshed < REFRESH_INTERVAL:
+                return
+            self.refreshed = time.time()
+            if not os.path.isdir(self.folder):
+                return
+            mtimes = {}
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith('.json'):
+                    mtimes[entry.name[:-len('.json')]] = entry.stat().st_mtime_ns
+            if mtimes == self.mtimes:
+                return
+            for name, mtime in mtimes.items():
+                if self.mtimes.get(name) != mtime:
+                    ds = self.load(os.path.join(self.folder, '%s.json' % name))
+                    if ds:
+                        self.datasets[name] = ds
+            for name in set(self.datasets) - set(mtimes):
+                del self.datasets[name]
+            self.mtimes = mtimes
+            self.index()
+
+    def index(self):
+        # Lookups by dataset id, resource id and file URL path
+        self.ids = {}
+        self.resources = {}
+        self.files = {}
+        self.hidden = set()
+        for name, ds in self.datasets.items():
+            self.ids[ds.get('id')] = name
+            for res in ds.get('resources') or []:
+                self.resources[res.get('id')] = res
+                hidden = is_private(ds) or is_restricted(res)
+                if hidden:
+                    self.hidden.add(res.get('id'))
+                if res.get('url_type') == 'upload' and res.get('url'):
+                    path = urlparse(res['url']).path
+                    # Same file name as gokit_sync.get_download_target
+                    self.files[path] = os.path.join(self.downloads_folder, os.path.basename(path))
+                    if hidden:
+                        self.hidden.add(path)
+
+    def dataset(self, name_or_id, public=False):
+        # Dataset by name or id. Only the public view of public datasets if public is set, see public_view()
+        self.refresh()
+        with self.lock:
+            ds = self.datasets.get(name_or_id) or self.datasets.get(self.ids.get(name_or_id))
+        return public_view(ds) if ds and public else ds
+
+    def resource(self, res_id, public=False):
+        self.refresh()
+        with self.lock:
+            if public and res_id in self.hidden:
+                return None
+            return self.resources.get(res_id)
+
+    def file(self, path, public=False):
+        # Local file for the path of a resource URL, None if not mirrored
+        self.refresh()
+        with self.lock:
+            if public and path in self.hidden:
+                return None
+            local_file = self.files.get(path)
+        if local_file and os.path.isfile(local_file):
+            return local_file
+        return None
+
+    def search(self, params, public=False):
+        """
+        package_search over the mirrored datasets. Filters supported in fq
+        and q: name:(...), groups:<name>, metadata_modified:[from TO to] and
+        the filter for the datasets after another, see
+        ckanapi.keyset_filter(). Other terms are ignored.
+        :param params: request parameters
+        :param public: only public datasets, as public_view() shows them
+        :return: result dict, as CKAN returns it
+        """
+        self.refresh()
+        query = '%s %s' % (params.get('fq') or '', params.get('q') or '')
+        # Taken out first, as it also holds a date range
+        keyset = re.search(r'\((\w+):\{(\S+) TO \*\] OR \(\w+:\[\S+ TO \S+\] AND id:\{(\S+) TO \*\]\)\)', query)
+        if keyset:
+            query = query.replace(keyset.group(0), '')
+        with self.lock:
+            datasets = list(self.datasets.values())
+        if public:
+            datasets = [public_view(ds) for ds in datasets if not is_private(ds)]
+        match = re.search(r'name:\(([^)]*)\)', query)
+        if match:
+            wanted = set(n.strip('" ') for n in match.group(1).split(' OR '))
+            datasets = [ds for ds in datasets if ds.get('name') in wanted]
+        match = re.search(r'groups:("?)([\w-]+)\1', query)
+        if match:
+            datasets = [ds for ds in datasets
+                        if match.group(2) in [g.get('name') for g in ds.get('groups') or []]]
+        match = re.search(r'metadata_modified:\[(\S+) TO (\S+)\]', query)
+        if match:
+            since, until = [None if v == '*' else v.rstrip('Z') for v in match.groups()]
+            datasets = [ds for ds in datasets
+                        if (not since or (ds.get('metadata_modified') or '') >= since) and
+                        (not until or (ds.get('metadata_modified') or '') <= until)]
+        if keyset:
+            field, value, last_id = keyset.group(1), keyset.group(2).rstrip('Z'), keyset.group(3)
+            datasets = [ds for ds in datasets if (str(ds.get(field) or '')[:23], ds.get('id')) > (value, last_id)]
+        sort = params.get('sort') or 'name asc'
+        # Sort on each field in turn, e.g. 'metadata_created asc, id asc'
+        for term in reversed(sort.split(',')):
+            field, _, order = term.strip().partition(' ')
+            # Dates to the millisecond, as Solr keeps them
+            length = 23 if field.startswith('metadata_') else None
+            datasets.sort(key=lambda ds: str(ds.get(field) or '')[:length], reverse=order.strip() == 'desc')
+        rows = min(int(params.get('rows', 10)), MAX_ROWS)
+        start = int(params.get('start', 0))
+        return {'count': len(datasets), 'results': datasets[start:start + rows], 'facets': {}, 'sort': sort}
+
+
+def rewrite_urls(ds, base_url):
+    # Copy of a dataset whose uploaded files are downloaded from the mirror
+    ds = json.loads(json.dumps(ds))
+    for res in ds.get('resources') or []:
+        rewrite_url(res, base_url)
+    return ds
+
+
+def rewrite_url(res, base_url):
+    if res.get('url_type') == 'upload' and res.get('url'):
+        # Keep the path, so clients that switch to the mirror see the same resource
+        res['url'] = base_url + urlparse(res['url']).path
+    return res
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('%s %s' % (self.address_string(), format % args))
+
+    def do_HEAD(self):
+        self.handle_request(head=True)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def params(self):
+        # Query string and JSON body parameters
+        parsed = urlparse(self.path)
+        params = dict((k, v[0]) for k, v in parse_qs(parsed.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            try:
+                params.update(json.loads(self.rfile.read(length)) or {})
+            except (ValueError, AttributeError):
+                pass
+        return parsed.path, params
+
+    def base_url(self):
+        return 'http://%s' % (self.headers.get('Host') or '%s:%s' % self.server.server_address[:2])
+
+    def handle_request(self, head=False):
+        path, params = self.params()
+        keys = self.server.access_keys
+        if keys and self.headers.get('Authorization') not in keys:
+            return self.send_json(403, {'success': False, 'error': {'message': 'Access denied'}}, head)
+        catalog = self.server.catalog
+        # Without access keys, clients are anyone on the network
+        public = not keys
+        try:
+            if not path.startswith('/api/'):
+                return self.send_file(path, head, public)
+            action = path.rsplit('/', 1)[-1]
+            if action == 'package_show':
+                ds = catalog.dataset(params.get('id'), public)
+                if not ds:
+                    return self.send_json(404, {'success': False, 'error': {'message': 'Not found', '__type': 'Not Found Error'}}, head)
+                return self.send_json(200, {'success': True, 'result': rewrite_urls(ds, self.base_url())}, head)
+            if action == 'resource_show':
+                res = catalog.resource(params.get('id'), public)
+                if not res:
+                    return self.send_json(404, {'success': False, 'error': {'message': 'Not found', '__type': 'Not Found Error'}}, head)
+                res = rewrite_url(dict(res), self.base_url())
+                return self.send_json(200, {'success': True, 'result': res}, head)
+            if action == 'package_search':
+                result = catalog.search(params, public)
+                result['results'] = [rewrite_urls(ds, self.base_url()) for ds in result['results']]
+                return self.send_json(200, {'success': True, 'result': result}, head)
+            return self.send_json(400, {'success': False, 'error': {
+                'message': 'Action %s is not available on this mirror' % action}}, head)
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {'success': False, 'error': {'message': str(e)}}, head)
+
+    def send_json(self, status, data, head=False):
+        body = json.dumps(data).encode('utf8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_file(self, path, head, public=False):
+        local_file = self.server.catalog.file(path, public)
+        if not local_file:
+            return self.send_json(404, {'success': False, 'error': {'message': 'No such file'}}, head)
+        with open(local_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            # Hardlinked copies of a stored file share the inode, and so the ETag
+            etag = '"%x-%x-%x"' % (st.st_ino, size, st.st_mtime_ns)
+            start, end = 0, size - 1
+            status = 200
+            match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+            if_range = self.headers.get('If-Range')
+            if match and (not if_range or if_range == etag):
+                if match.group(1):
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(int(match.group(2)), size - 1)
+                elif match.group(2):
+                    start = max(size - int(match.group(2)), 0)
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%s' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Type', mimetypes.guess_type(local_file)[0] or 'application/octet-stream')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(st.st_mtime, usegmt=True))
+            self.send_header('Content-Length', str(end - start + 1))
+            if status == 206:
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+            self.end_headers()
+            if head:
+                return
+            f.seek(start)
+            left = end - start + 1
+            try:
+                while left > 0:
+                    chunk = f.read(min(CHUNK_SIZE, left))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    left -= len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                logger.info('Client %s dropped the download of %s' % (self.address_string(), path))
+                self.close_connection = True
+
+
+class MirrorServer(ThreadingHTTPServer):
+    """
+    HTTP server for a Catalog, one thread per connection.
+    :param address: (host, port) to listen on
+    :param catalog: Catalog of the mirrored datasets
+    :param access_keys: keys clients must send as their API key, none to
+    serve anyone the public datasets and files only
+    """
+    daemon_threads = True
+
+    def __init__(self, address, catalog, access_keys=None):
+        ThreadingHTTPServer.__init__(self, address, MirrorHandler)
+        self.catalog = catalog
+        self.access_keys = set(access_keys or [])
+
+
+def serve(downloads_folder, host='127.0.0.1', port=8080, access_keys=None):
+    """
+    Serve a mirror folder in a background thread.
+    :param downloads_folder: downloads folder of the mirror
+    :param host: address to listen on, this machine only by default
+    :param port: port to listen on
+    :param access_keys: keys clients must send as their API key, none to
+    serve anyone the public datasets and files only
+    :return: the running MirrorServer
+    """
+    server = MirrorServer((host, port), Catalog(downloads_folder), access_keys)
+    thread = threading.Thread(target=server.serve_forever, name='mirror', daemon=True)
+    thread.start()
+    logger.info('Serving the mirror at http://%s:%s' % (host, server.server_address[1]))
+    if not access_keys:
+        logger.warning('No access key set, private datasets and restricted files are not served')
+    return server
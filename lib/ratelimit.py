@@ -0,0 +1,89 @@
+"""
+A token bucket shared by all sync workers. Every worker takes a token before
+calling the server, so the whole process stays under one rate. When the
+server asks us to slow down, every worker waits together instead of each one
+retrying on its own schedule.
+"""
+
+import threading
+import time
+
+import settings
+
+logger = settings.setup_logger('ratelimit')
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter, safe to share between threads. Waiting is left
+    to the caller (see reserve()), so it can also be used from asyncio tasks.
+    :param rate: tokens added per second, 0 for no limit
+    :param burst: max tokens that can be taken at once after an idle period
+    :param adaptive: halve the rate when the server pushes back, see throttle(),
+    and creep back up to the configured rate on success
+    """
+
+    def __init__(self, rate=0, burst=1, adaptive=True):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.adaptive = adaptive
+        self.current_rate = rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def configure(self, rate=None, burst=None):
+        with self.lock:
+            if rate is not None:
+                self.rate = self.current_rate = rate
+            if burst is not None:
+                self.burst = max(burst, 1)
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, tokens=1):
+        """
+        Take tokens from the bucket. The bucket can go into debt, so callers
+        are queued in the order they reserved.
+        :param tokens: number of tokens, e.g. 1 per request or 1 per byte
+        :return: seconds the caller must wait before going ahead
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.paused_until - now, 0)
+            if self.current_rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.current_rate)
+                self.tokens -= tokens
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / float(self.current_rate))
+            self.updated = now
+            return wait
+
+    def acquire(self, tokens=1):
+        # Blocking version of reserve()
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle(self, delay):
+        """
+        The server is overloaded or rate limiting us: pause every caller for
+        delay seconds, and lower the rate if adaptive.
+        :param delay: seconds to pause
+        :return: None
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            if self.adaptive and self.rate:
+                self.current_rate = max(self.current_rate / 2.0, self.rate / 16.0)
+                logger.warning('Slowing down to %.2f requests/sec' % self.current_rate)
+
+    def succeeded(self):
+        # Recover the configured rate slowly after a throttle
+        if self.adaptive and self.rate and self.current_rate < self.rate:
+            with self.lock:
+                self.current_rate = min(self.rate, self.current_rate + self.rate / 20.0)
+
+
+# Total download speed in bytes/sec, shared by all downloads. No limit until configured.
+download_bandwidth = TokenBucket(adaptive=False)
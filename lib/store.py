@@ -0,0 +1,271 @@
+"""
+Checksums and a content-addressed store for downloaded files. Every download
+is hashed while it streams, checked against the hash CKAN has for the
+resource (if any), and kept once in downloads/.store under its sha256. The
+file at the usual path in the downloads folder is a hardlink to that copy,
+so the same zip attached to several datasets is downloaded and stored once.
+
+Filesystems without hardlinks (FAT32 and exFAT drives) cannot share a file
+between two paths. There the store holds no copies: each download is moved
+straight into place, and the index records which file in the downloads
+folder has which sha256, so a duplicate is copied from it instead of being
+downloaded again.
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import traceback
+from json import JSONDecodeError
+
+import settings
+
+logger = settings.setup_logger('store')
+
+STORE_FOLDER = '.store'
+INDEX_FILE = 'index.json'
+
+# Algorithm of a bare hex digest in the CKAN hash field, by length
+HASH_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256'}
+
+
+def parse_hash(value):
+    """
+    Read the hash field of a CKAN resource, either a bare hex digest or
+    prefixed with its algorithm, e.g. 'sha256:ab12...' or 'md5:ab12...'.
+    :param value: hash field of the resource
+    :return: (algorithm, hex digest) tuple, or None if there is no usable hash
+    """
+    if not value or type(value) is not str:
+        return None
+    value = value.strip().lower()
+    algorithm = None
+    if ':' in value:
+        algorithm, value = value.split(':', 1)
+    algorithm = algorithm or HASH_LENGTHS.get(len(value))
+    if algorithm not in hashlib.algorithms_guaranteed or not re.fullmatch('[0-9a-f]+', value):
+        return None
+    return algorithm, value
+
+
+def etag_key(etag, size):
+    # Index key of a download by its ETag. Weak ETags say nothing about the bytes.
+    if not etag or etag.startswith('W/') or size is None:
+        return None
+    return 'etag:%s:%s' % (etag, size)
+
+
+class StreamHash(object):
+    """
+    The sha256 of a download, updated chunk by chunk, plus the algorithm of
+    the hash CKAN has for the resource if that is not sha256.
+    :param expected: (algorithm, hex digest) tuple from parse_hash(), or None
+    """
+
+    def __init__(self, expected=None):
+        self.expected = expected
+        self.sha256 = hashlib.sha256()
+        self.other = None
+        if expected and expected[0] != 'sha256':
+            self.other = hashlib.new(expected[0])
+
+    def update(self, chunk):
+        self.sha256.update(chunk)
+        if self.other:
+            self.other.update(chunk)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def matches(self):
+        # True if there is no expected hash, or the download matches it
+        if not self.expected:
+            return True
+        return (self.other or self.sha256).hexdigest() == self.expected[1]
+
+
+class AlreadyStored(Exception):
+    # Raised when a download turns out to be in the store already
+    def __init__(self, sha256):
+        Exception.__init__(self, sha256)
+        self.sha256 = sha256
+
+
+class ContentStore(object):
+    """
+    Files of a downloads folder, stored once by sha256. An index maps other
+    keys (the CKAN hash, the ETag of the download) to the sha256, so that a
+    duplicate can be found before it is downloaded. Safe to share between
+    sync workers.
+    :param downloads_folder: folder that the store is created in
+    """
+
+    def __init__(self, downloads_folder):
+        self.downloads_folder = downloads_folder
+        self.folder = os.path.join(downloads_folder, STORE_FOLDER)
+        self.index_file = os.path.join(self.folder, INDEX_FILE)
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        self.index = self.load()
+        self.hardlinks = self.check_hardlinks()
+        if not self.hardlinks:
+            logger.info('No hardlinks on the drive of %s, files shared by several datasets are copied' %
+                        downloads_folder)
+
+    def check_hardlinks(self):
+        # True if the filesystem of the store supports hardlinks
+        test_file = os.path.join(self.folder, 'link-test')
+        try:
+            open(test_file, 'wb').close()
+            os.link(test_file, test_file + '.link')
+            os.remove(test_file + '.link')
+            return True
+        except OSError:
+            return False
+        finally:
+            if os.path.exists(test_file):
+                os.remove(test_file)
+
+    def load(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, JSONDecodeError):
+            logger.error('Cannot read store index %s, duplicates will be downloaded again' % self.index_file)
+            logger.error(traceback.format_exc())
+            return {}
+
+    def save(self):
+        with self.lock:
+            tmp_file = self.index_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf8') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.index_file)
+
+    def object_path(self, sha256):
+        """
+        File with the contents of a sha256: the stored copy or, without
+        hardlinks, the download in the downloads folder it was saved as.
+        :return: path, or None if no file is known to have these contents
+        """
+        if self.hardlinks:
+            return os.path.join(self.folder, sha256[:2], sha256)
+        with self.lock:
+            record = self.index.get('file:' + sha256)
+        if not record:
+            return None
+        path = os.path.join(self.downloads_folder, record[0])
+        # The file is only used as long as it has not been replaced since
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return path if [st.st_size, st.st_mtime_ns] == record[1:] else None
+
+    def record_file(self, sha256, path):
+        # Without hardlinks: remember which file in the downloads folder has these contents
+        st = os.stat(path)
+        with self.lock:
+            self.index['file:' + sha256] = [os.path.relpath(path, self.downloads_folder),
+                                            st.st_size, st.st_mtime_ns]
+
+    def lookup(self, key):
+        """
+        Find a stored file.
+        :param key: 'sha256:<hex>', or another key given to add()
+        :return: sha256 of the stored file, or None
+        """
+        if not key:
+            return None
+        if key.startswith('sha256:'):
+            sha256 = key.split(':', 1)[1]
+        else:
+            with self.lock:
+                sha256 = self.index.get(key)
+        obj = sha256 and self.object_path(sha256)
+        if obj and os.path.exists(obj):
+            return sha256
+        return None
+
+    def add(self, path, sha256, target, keys=()):
+        """
+        Move a complete download into the store, and put it at its path in
+        the downloads folder. Without hardlinks it is moved straight there.
+        :param path: downloaded file, it is moved
+        :param sha256: hex digest of the file
+        :param target: path of the file in the downloads folder
+        :param keys: other keys the file can be found with, see lookup()
+        :return: None
+        """
+        if self.hardlinks:
+            obj = self.object_path(sha256)
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.replace(path, obj)
+            self.link(sha256, target)
+        else:
+            os.replace(path, target)
+            self.record_file(sha256, target)
+        # sha256 keys are found by path, see lookup()
+        keys = [k for k in keys if k and not k.startswith('sha256:')]
+        with self.lock:
+            self.index.update((k, sha256) for k in keys)
+        self.save()
+
+    def link(self, sha256, target):
+        """
+        Put a stored file at a path in the downloads folder, as a hardlink or,
+        where the filesystem has none, as a copy of the file with the same
+        contents.
+        :param sha256: hex digest of the stored file
+        :param target: path of the file in the downloads folder
+        :return: None
+        """
+        obj = self.object_path(sha256)
+        if os.path.exists(target) and os.path.samefile(obj, target):
+            return
+        tmp_file = target + '.tmp'
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        if self.hardlinks:
+            os.link(obj, tmp_file)
+            os.replace(tmp_file, target)
+            return
+        shutil.copyfile(obj, tmp_file)
+        os.replace(tmp_file, target)
+        self.record_file(sha256, target)
+        self.save()
+
+    def prune(self):
+        """
+        Remove stored files that are no longer linked from the downloads
+        folder, e.g. older versions of a resource, and forget the files that
+        were replaced or removed since they were recorded.
+        :return: number of bytes freed
+        """
+        freed = 0
+        for sub in os.scandir(self.folder):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                # DirEntry.stat() has no link count on Windows. Without
+                # hardlinks, anything stored is left from another drive.
+                st = os.stat(entry.path)
+                if st.st_nlink == 1 or not self.hardlinks:
+                    os.remove(entry.path)
+                    freed += st.st_size
+        with self.lock:
+            index = dict(self.index)
+        # Records of files are checked through the sha256 they name
+        index = dict((k, v) for k, v in index.items()
+                     if self.lookup('sha256:' + (k[5:] if k.startswith('file:') else v)))
+        with self.lock:
+            self.index = index
+        self.save()
+        if freed:
+            logger.info('Removed %s bytes of unused files from the store' % freed)
+        return freed
@@ -0,0 +1,341 @@
+"""
+Delta downloads of zip resources. Uploaded resources are zip files on S3,
+which answers Range requests, so when a local copy of the previous version
+exists we read only the central directory at the end of the remote zip,
+compare it with the local copy, and fetch just the members that changed.
+Unchanged members are copied from the local copy, once their local headers
+in the remote zip are checked too, as the central directory does not
+cover them. The rebuilt file has the same layout as the remote zip, byte
+for byte, and is checked against the ETag where S3 sends the MD5.
+"""
+
+import hashlib
+import io
+import os
+import re
+import struct
+import zipfile
+
+import settings
+from lib import ckanapi
+from lib import metrics
+from lib.ratelimit import download_bandwidth
+
+logger = settings.setup_logger('zipdelta')
+
+# Bytes read from the end of the remote zip on the first request, and at
+# least on later ones. Enough for the central directory of a zip with about a
+# hundred members. zipfile reads a larger one whole, in one more request.
+TAIL_BYTES = 16 * 1024
+
+# Smaller zips are downloaded in full, as the requests of a delta cost about as much
+DELTA_MIN_SIZE = 1024 * 1024
+
+# Local headers of unchanged members closer than this are fetched in one request
+HEADER_GAP = 16 * 1024
+
+# Fall back to a full download when more than this fraction must be fetched
+DELTA_MAX_FRACTION = 0.5
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class DeltaError(IOError):
+    # Raised when the remote file cannot be read in ranges, or changed while reading it
+    pass
+
+
+def get_range(url, headers, start, end, stream=False):
+    """
+    GET an inclusive byte range, checking that the server sent that range.
+    :return: requests.Response
+    """
+    r = ckanapi.http_request('get', url, headers=dict(headers, Range='bytes=%s-%s' % (start, end)),
+                             stream=stream)
+    if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith('bytes %s-' % start):
+        r.close()
+        raise DeltaError('Server did not send bytes %s-%s (status %s)' % (start, end, r.status_code))
+    return r
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Read-only file object over a remote file, fetched with Range requests,
+    so that zipfile can read a remote central directory. The last block read
+    is kept, so the small seeks and reads of zipfile cost one request.
+    :param url: URL of the file
+    :param size: size of the file
+    :param headers: headers sent with each request
+    """
+
+    def __init__(self, url, size, headers):
+        io.RawIOBase.__init__(self)
+        self.url = url
+        self.size = size
+        self.headers = headers
+        self.pos = 0
+        self.block_start = 0
+        self.block = b''
+        self.fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        return self.pos
+
+    def get(self, start, end):
+        # Fetch bytes start to end (inclusive)
+        content = get_range(self.url, self.headers, start, end).content
+        self.fetched += len(content)
+        metrics.add_bytes('download', len(content))
+        download_bandwidth.acquire(len(content))
+        return content
+
+    def load(self, start, end):
+        # Fetch bytes start to end (inclusive) into the block
+        self.block = self.get(start, end)
+        self.block_start = start
+
+    def read_range(self, start, end):
+        # Bytes start to end (exclusive), from the block if it holds them, without replacing it
+        if start >= self.block_start and end <= self.block_start + len(self.block):
+            return self.block[start - self.block_start:end - self.block_start]
+        return self.get(start, end - 1)
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.size - self.pos)
+        if n <= 0:
+            return 0
+        start, end = self.pos, self.pos + n
+        if start < self.block_start or end > self.block_start + len(self.block):
+            # Read at least TAIL_BYTES at a time, ending at the end of the file if close to it
+            load_start = max(min(start, self.size - TAIL_BYTES), 0)
+            self.load(load_start, max(end, min(load_start + TAIL_BYTES, self.size)) - 1)
+        offset = start - self.block_start
+        buffer[:n] = self.block[offset:offset + n]
+        self.pos += n
+        return n
+
+
+def get_spans(zf):
+    """
+    Byte range of each member in a zip: its local header, data and data
+    descriptor, up to the next member or the central directory.
+    :param zf: open ZipFile
+    :return: dict of member name to (ZipInfo, start, end), end exclusive
+    """
+    infos = sorted(zf.infolist(), key=lambda info: info.header_offset)
+    spans = {}
+    for i, info in enumerate(infos):
+        end = infos[i + 1].header_offset if i + 1 < len(infos) else zf.start_dir
+        spans[info.filename] = (info, info.header_offset, end)
+    return spans
+
+
+def same_member(remote, local):
+    # True if the central directory shows that a local member can stand in for a remote one
+    r_info, r_start, r_end = remote
+    l_info, l_start, l_end = local
+    return (r_end - r_start == l_end - l_start and r_info.CRC == l_info.CRC and
+            r_info.compress_size == l_info.compress_size and r_info.file_size == l_info.file_size and
+            r_info.compress_type == l_info.compress_type and r_info.flag_bits == l_info.flag_bits and
+            r_info.date_time == l_info.date_time and r_info.extra == l_info.extra)
+
+
+def read_local_header(f, start):
+    # The local header of a zip member: fixed fields, file name and extra field
+    f.seek(start)
+    fixed = f.read(30)
+    if len(fixed) < 30 or fixed[:4] != b'PK\x03\x04':
+        raise zipfile.BadZipFile('No local header at %s' % start)
+    name_length, extra_length = struct.unpack('<HH', fixed[26:30])
+    return fixed + f.read(name_length + extra_length)
+
+
+def changed_headers(reader, local_zip, remote_spans, reused):
+    """
+    Members whose local header in the remote zip differs from the one in the
+    local copy, e.g. in its extra field, although their central directory
+    entries match. Headers close together are fetched in one request.
+    :param reader: RangeReader over the remote zip
+    :param local_zip: path of the local copy
+    :param remote_spans: spans of the remote zip, see get_spans()
+    :param reused: spans of the local zip for the members to check
+    :return: set of member names
+    """
+    headers = []
+    with open(local_zip, 'rb') as f:
+        for name, (_, start, _) in reused.items():
+            headers.append((remote_spans[name][1], name, read_local_header(f, start)))
+    headers.sort()
+    changed = set()
+    i = 0
+    while i < len(headers):
+        start = headers[i][0]
+        end = start + len(headers[i][2])
+        j = i + 1
+        while j < len(headers) and headers[j][0] - end < HEADER_GAP:
+            end = max(end, headers[j][0] + len(headers[j][2]))
+            j += 1
+        data = reader.read_range(start, min(end, reader.size))
+        for pos, name, header in headers[i:j]:
+            if data[pos - start:pos - start + len(header)] != header:
+                changed.add(name)
+        i = j
+    return changed
+
+
+def list_pieces(remote_spans, start_dir, size, reused):
+    # Pieces of the new file, see plan_delta(), with the reused members copied from their local spans
+    pieces = []
+    pos = 0
+    for name, span in sorted(remote_spans.items(), key=lambda item: item[1][1]):
+        _, start, end = span
+        if start > pos:
+            pieces.append(('remote', pos, start))
+        if name in reused:
+            pieces.append(('local', reused[name][1], reused[name][2]))
+        else:
+            pieces.append(('remote', start, end))
+        pos = end
+    # Central directory and end records
+    pieces.append(('remote', start_dir, size))
+
+    # Merge neighbouring pieces, so each run of changed members is one request
+    merged = []
+    for piece in pieces:
+        if merged and merged[-1][0] == piece[0] and merged[-1][2] == piece[1]:
+            merged[-1] = (piece[0], merged[-1][1], piece[2])
+        elif piece[2] > piece[1]:
+            merged.append(piece)
+    return merged
+
+
+def remote_size(pieces):
+    return sum(end - start for kind, start, end in pieces if kind == 'remote')
+
+
+def plan_delta(reader, local_zip, max_remote=None):
+    """
+    List the pieces of the new file, in order: ('local', start, end) copied
+    from the local zip, or ('remote', start, end) fetched from the server.
+    Members are reused when their central directory entries match and then
+    their local headers, which are only fetched if the delta is worth it.
+    :param reader: RangeReader over the remote zip
+    :param local_zip: path of the local copy
+    :param max_remote: give up if more than this many bytes must be fetched
+    :return: list of pieces, ends exclusive, or None if it gave up
+    """
+    with zipfile.ZipFile(reader) as rz:
+        remote_spans = get_spans(rz)
+        start_dir = rz.start_dir
+    with zipfile.ZipFile(local_zip) as lz:
+        local_spans = get_spans(lz)
+
+    reused = {name: local_spans[name] for name, span in remote_spans.items()
+              if name in local_spans and same_member(span, local_spans[name])}
+    pieces = list_pieces(remote_spans, start_dir, reader.size, reused)
+    if max_remote is not None and remote_size(pieces) > max_remote:
+        return None
+    changed = changed_headers(reader, local_zip, remote_spans, reused)
+    if changed:
+        reused = {name: span for name, span in reused.items() if name not in changed}
+        pieces = list_pieces(remote_spans, start_dir, reader.size, reused)
+    return pieces
+
+
+def fetch_delta(probe, headers, local_zip, part_file, digest, max_fraction=DELTA_MAX_FRACTION):
+    """
+    Rebuild the new version of a zip from its local copy and the changed
+    members of the remote zip.
+    :param probe: dict with the final url, size and validators of the remote
+    file, see gokit_sync.probe_download
+    :param headers: headers for requests to probe['url']
+    :param local_zip: previous version of the file
+    :param part_file: file the new version is written to
+    :param digest: hash object, updated with the new file as it is written
+    :param max_fraction: give up if more than this fraction of the file must
+    be fetched
+    :return: number of bytes fetched, or None if a delta is not worth it or
+    the files are not zips. DeltaError is raised if the download fails.
+    """
+    if probe['size'] < DELTA_MIN_SIZE:
+        return None
+    max_remote = probe['size'] * max_fraction
+    # What the remote zip grew by must be fetched, whatever changed
+    if probe['size'] - os.path.getsize(local_zip) > max_remote:
+        logger.info('The zip grew too much for a delta download (%s bytes, was %s)' % (
+            probe['size'], os.path.getsize(local_zip)))
+        return None
+    headers = dict(headers)
+    validator = probe.get('etag') or probe.get('last_modified')
+    if validator:
+        # If the remote file changes while we read it, the server sends all of it and we stop
+        headers['If-Range'] = validator
+    reader = RangeReader(probe['url'], probe['size'], headers)
+    try:
+        pieces = plan_delta(reader, local_zip, max_remote)
+    except (zipfile.BadZipFile, EOFError, OSError) as e:
+        if isinstance(e, DeltaError):
+            raise
+        logger.info('Cannot compare %s with the remote zip, downloading all of it' % local_zip)
+        return None
+    remote_bytes = remote_size(pieces) if pieces else None
+    if remote_bytes is None or remote_bytes > max_remote:
+        logger.info('Too much of the zip changed for a delta download (%s bytes)' % probe['size'])
+        return None
+    # S3 sends the MD5 of the file as the ETag of a single part upload
+    etag = (probe.get('etag') or '').strip('"')
+    md5 = hashlib.md5() if re.match(r'[0-9a-f]{32}$', etag) else None
+    hashes = [digest, md5] if md5 else [digest]
+
+    logger.info('Fetching %s of %s bytes of the new version' % (remote_bytes, probe['size']))
+    fetched = reader.fetched
+    with open(part_file, 'wb') as out, open(local_zip, 'rb') as local:
+        def write(chunk):
+            out.write(chunk)
+            for h in hashes:
+                h.update(chunk)
+
+        for kind, start, end in pieces:
+            if kind == 'local':
+                local.seek(start)
+                left = end - start
+                while left:
+                    chunk = local.read(min(CHUNK_SIZE, left))
+                    if not chunk:
+                        raise DeltaError('Local copy ended early')
+                    write(chunk)
+                    left -= len(chunk)
+            elif start >= reader.block_start and end <= reader.block_start + len(reader.block):
+                # Already read along with the central directory
+                write(reader.block[start - reader.block_start:end - reader.block_start])
+            else:
+                received = 0
+                with get_range(probe['url'], headers, start, end - 1, stream=True) as r:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        write(chunk)
+                        received += len(chunk)
+                        metrics.add_bytes('download', len(chunk))
+                        download_bandwidth.acquire(len(chunk))
+                if received != end - start:
+                    raise DeltaError('Received %s of %s bytes' % (received, end - start))
+                fetched += received
+        if out.tell() != probe['size']:
+            raise DeltaError('Rebuilt zip is %s bytes, expected %s' % (out.tell(), probe['size']))
+    if md5 and md5.hexdigest() != etag:
+        raise DeltaError('Rebuilt zip does not match the ETag')
+    return fetched
@@ -1,11 +1,22 @@
+import importlib.util
 import logging
 import os
+import sys
 from datetime import datetime
 
 
-hostname = 'https://www.gis-hub.ca'
+# GIS Hub site, or a gokit_sync mirror on the local network, see set_hostname()
+hostname = os.environ.get('GOKIT_HUB', 'https://www.gis-hub.ca').rstrip('/')
 ghub_api_url_base = hostname + '/api/3/action'
 
+
+def set_hostname(url):
+    # Point the API clients at another CKAN site, e.g. http://mirror:8080
+    global hostname, ghub_api_url_base
+    hostname = url.rstrip('/')
+    ghub_api_url_base = hostname + '/api/3/action'
+
+
 # Storage locations and paths
 base_dir = os.path.dirname(os.path.realpath(__file__))
 project_root = os.path.realpath(base_dir)
@@ -28,24 +39,69 @@ screen_fmt = logging.Formatter(
     '%(asctime)s:%(levelname)s:%(module)s(%(lineno)d) - %(message)s'
 )
 
+# Used when several datasets are synced at once. Worker threads are named
+# after the dataset they are syncing, so each line shows which dataset it is for.
+worker_fmt = logging.Formatter(
+    '%(asctime)s:%(levelname)s:%(threadName)s:%(module)s(%(lineno)d) - %(message)s'
+)
+
 LOG_NAME = 'GeoMeta'
 
+# Loggers made by setup_logger() and the format they currently use, see set_log_format()
+loggers = []
+log_format = screen_fmt
+
 
 def setup_logger(name, level=logging.INFO):
     logger = logging.getLogger(name)
     logger.setLevel(level)
     sh = logging.StreamHandler()
-    sh.setFormatter(screen_fmt)
+    sh.setFormatter(log_format)
     sh.setLevel(level)
     if not logger.handlers:
         logger.addHandler(sh)
+    if logger not in loggers:
+        loggers.append(logger)
 
     return logger
 
 
 def add_disk_log(logger, logfile, level=logging.INFO):
+    # Once per file, so that syncing again in the same process does not log every line twice
+    if any(isinstance(h, logging.FileHandler) and h.baseFilename == os.path.abspath(logfile)
+           for h in logger.handlers):
+        return
     fh = logging.FileHandler(logfile)
     fh.setLevel(level)
-    fh.setFormatter(screen_fmt)
+    fh.setFormatter(log_format)
     logger.addHandler(fh)
     logger.info('Logging to %s' % logfile)
+
+
+def set_log_format(fmt):
+    # Switch the formatter on every handler of every logger from setup_logger(),
+    # including those of modules imported later
+    global log_format
+    log_format = fmt
+    for logger in loggers:
+        for handler in logger.handlers:
+            handler.setFormatter(fmt)
+
+
+def lazy_import(name):
+    """
+    Import a module on first use instead of now. Keeps heavy modules, like
+    the networking stack, out of CLI startup until they are needed, e.g. so
+    that --help returns straight away.
+    :param name: full module name, e.g. 'lib.ckanapi'
+    :return: the module, loaded on first attribute access
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module